@@ -23,16 +23,18 @@ class AdminActions:
         return {"success": False, "error": result.get("error", "Erro ao enviar mensagem")}
     
     @staticmethod
-    def get_client_full_history(phone: str):
+    def get_client_full_history(phone: str, before: str = None, limit: int = 100):
+        """Client data plus one page of interactions; pass next_cursor back as before for older ones."""
         client = db.get_client(phone)
         if not client:
             client = db.get_lead(phone)
         
-        interactions = db.get_client_interactions(phone, limit=1000)
+        interactions, next_cursor = db.query_interactions(phone=phone, before=before, limit=limit)
         
         return {
             "client_data": client,
-            "interactions": interactions
+            "interactions": interactions,
+            "next_cursor": next_cursor
         }
     
     @staticmethod
@@ -3,7 +3,8 @@ Multi-Agent Orchestrator - Coordinates multiple specialized agents
 with shared memory and tool capabilities.
 """
 import logging
-from typing import Dict, Optional, List
+from datetime import datetime
+from typing import Dict, Optional, List, Tuple
 from database import db
 from agent_tools import agent_tools
 from agent_sales import sales_agent
@@ -42,34 +43,10 @@ class AgentOrchestrator:
         Returns:
             Dict with response and metadata
         """
-        # Check client status
-        client = db.get_client(phone)
-        
-        if client:
-            # Client exists - route to nutrition agent
-            agent_type = "nutrition"
-            agent = self.agents["nutrition"]
-            
-            # Check for escalation
-            if client.get('needs_human_support') or client.get('status') == 'pending_human':
-                return {
-                    "success": True,
-                    "routed_to": "human",
-                    "message": "Esta conversa foi escalada para atendimento humano."
-                }
-        else:
-            # No client - route to sales agent
-            agent_type = "sales"
-            agent = self.agents["sales"]
-            
-            # Check lead escalation
-            lead = db.get_lead(phone)
-            if lead and (lead.get('needs_human_support') or lead.get('status') == 'pending_human'):
-                return {
-                    "success": True,
-                    "routed_to": "human",
-                    "message": "Esta conversa foi escalada para atendimento humano."
-                }
+        agent_type, escalated = self._select_agent(phone)
+        if escalated:
+            return escalated
+        agent = self.agents[agent_type]
         
         # Process with agent
         try:
@@ -84,6 +61,59 @@ class AgentOrchestrator:
                 "agent_type": agent_type
             }
     
+    async def route_to_agent_async(self, phone: str, message: str, run_sync, sender) -> Dict:
+        """
+        route_to_agent() for the asyncio turn pipeline.
+        
+        Agents with process_message_async() run on the event loop and
+        reply through sender (a whatsapp_api.AsyncWhatsAppAPI); the others
+        run their blocking process_message() through run_sync, a thread
+        adapter, so every agent keeps working. Database reads and writes
+        block too, so they also go through run_sync.
+        """
+        agent_type, escalated = await run_sync(self._select_agent, phone)
+        if escalated:
+            return escalated
+        agent = self.agents[agent_type]
+        
+        try:
+            if hasattr(agent, "process_message_async"):
+                result = await agent.process_message_async(phone, message, sender, run_sync)
+            else:
+                result = await run_sync(agent.process_message, phone, message)
+            result["agent_type"] = agent_type
+            return result
+        except Exception as e:
+            logger.error(f"Agent processing error ({agent_type}): {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "agent_type": agent_type
+            }
+    
+    def _select_agent(self, phone: str) -> Tuple[str, Optional[Dict]]:
+        """Agent type for phone, plus the reply to return instead when the conversation was escalated."""
+        escalated = {
+            "success": True,
+            "routed_to": "human",
+            "message": "Esta conversa foi escalada para atendimento humano."
+        }
+        
+        # Check client status
+        client = db.get_client(phone)
+        
+        if client:
+            # Client exists - route to nutrition agent, unless escalated
+            if client.get('needs_human_support') or client.get('status') == 'pending_human':
+                return "nutrition", escalated
+            return "nutrition", None
+        
+        # No client - route to sales agent, unless the lead was escalated
+        lead = db.get_lead(phone)
+        if lead and (lead.get('needs_human_support') or lead.get('status') == 'pending_human'):
+            return "sales", escalated
+        return "sales", None
+    
     def handoff_agent(self, phone: str, from_agent: str, to_agent: str, reason: str = ""):
         """
         Hand off conversation from one agent to another.
@@ -107,7 +137,7 @@ class AgentOrchestrator:
                     "from": from_agent,
                     "to": to_agent,
                     "reason": reason,
-                    "timestamp": db._load().get("timestamp", "")
+                    "timestamp": datetime.now().isoformat()
                 }
             })
         else:
@@ -33,6 +33,34 @@ Retorne SEMPRE em formato JSON com:
 """
     
     def process_message(self, phone: str, message: str) -> dict:
+        context = self._prepare_context(phone, message)
+        response_json = self.agent.generate_structured_response(
+            self.system_prompt,
+            message,
+            context=context
+        )
+        result = self._handle_response(phone, response_json)
+        whatsapp.send_text(phone, result["response"])
+        return result
+    
+    async def process_message_async(self, phone: str, message: str, sender, run_sync) -> dict:
+        """
+        process_message() for the asyncio pipeline.
+        
+        sender is a whatsapp_api.AsyncWhatsAppAPI; the database work before
+        and after the model call runs through run_sync, off the event loop.
+        """
+        context = await run_sync(self._prepare_context, phone, message)
+        response_json = await self.agent.agenerate_structured_response(
+            self.system_prompt,
+            message,
+            context=context
+        )
+        result = await run_sync(self._handle_response, phone, response_json)
+        await sender.send_text(phone, result["response"])
+        return result
+    
+    def _prepare_context(self, phone: str, message: str) -> str:
         lead = db.get_lead(phone)
         
         if not lead:
@@ -46,23 +74,22 @@ Retorne SEMPRE em formato JSON com:
             f"{'Cliente' if i['direction'] == 'incoming' else 'Agente'}: {i['message']}"
             for i in reversed(recent_interactions[-5:])
         ])
-        
-        response_json = self.agent.generate_structured_response(
-            self.system_prompt,
-            message,
-            context=f"Histórico recente:\n{context}"
-        )
-        
+        return f"Histórico recente:\n{context}"
+    
+    def _handle_response(self, phone: str, response_json: str) -> dict:
+        """Apply the model's action and record the reply; the caller sends it."""
         try:
             result = json.loads(response_json)
             response_text = result.get("response", "")
             action = result.get("action", "continue")
             
             if action == "convert":
-                client_id = db.convert_lead_to_client(phone)
+                with db.transaction(phone):
+                    client_id = db.convert_lead_to_client(phone)
+                    if client_id:
+                        db.update_client(phone, {"agent": "nutrition"})
                 if client_id:
                     response_text += "\n\n✅ Seja bem-vindo(a)! Sua assinatura está ativa. Agora vou te conectar com seu nutricionista personalizado que irá iniciar sua avaliação nutricional completa."
-                    db.update_client(phone, {"agent": "nutrition"})
             
             elif action == "escalate":
                 db.update_lead(phone, {
@@ -74,8 +101,6 @@ Retorne SEMPRE em formato JSON com:
             
             db.add_interaction(phone, "sales", response_text, "outgoing")
             
-            whatsapp.send_text(phone, response_text)
-            
             return {
                 "success": True,
                 "response": response_text,
@@ -84,7 +109,6 @@ Retorne SEMPRE em formato JSON com:
             
         except json.JSONDecodeError:
             fallback_response = "Obrigado pelo contato! Nossa metodologia oferece acompanhamento nutricional personalizado por apenas R$ 47/mês. Gostaria de saber mais detalhes?"
-            whatsapp.send_text(phone, fallback_response)
             db.add_interaction(phone, "sales", fallback_response, "outgoing")
             return {"success": True, "response": fallback_response, "action": "continue"}
 
@@ -192,8 +192,7 @@ class AgentTools:
                     "error": "Client not found"
                 }
             
-            client_id = f"client_{phone}"
-            subscription = db._load().get("subscriptions", {}).get(client_id)
+            subscription = db.get_subscription(phone)
             
             if subscription:
                 return {
@@ -1,5 +1,5 @@
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 from config import AI_INTEGRATIONS_OPENAI_API_KEY, AI_INTEGRATIONS_OPENAI_BASE_URL
 
@@ -20,10 +20,17 @@ client = OpenAI(
     base_url=AI_INTEGRATIONS_OPENAI_BASE_URL
 )
 
+# Non-blocking client for the asyncio turn pipeline (TURN_ENGINE=asyncio, see turn_pipeline)
+async_client = AsyncOpenAI(
+    api_key=AI_INTEGRATIONS_OPENAI_API_KEY,
+    base_url=AI_INTEGRATIONS_OPENAI_BASE_URL
+)
+
 class AIAgent:
     def __init__(self, agent_type: str):
         self.agent_type = agent_type
         self.client = client
+        self.async_client = async_client
     
     @retry(
         stop=stop_after_attempt(7),
@@ -58,6 +65,37 @@ class AIAgent:
         reraise=True
     )
     def generate_structured_response(self, system_prompt: str, user_message: str, context: str = "") -> str:
+        # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
+        # do not change this unless explicitly requested by the user
+        response = self.client.chat.completions.create(
+            model="gpt-5",
+            messages=self._structured_messages(system_prompt, user_message, context),
+            response_format={"type": "json_object"},
+            max_completion_tokens=8192
+        )
+        
+        return response.choices[0].message.content or ""
+    
+    @retry(
+        stop=stop_after_attempt(7),
+        wait=wait_exponential(multiplier=1, min=2, max=128),
+        retry=retry_if_exception(is_rate_limit_error),
+        reraise=True
+    )
+    async def agenerate_structured_response(self, system_prompt: str, user_message: str, context: str = "") -> str:
+        """generate_structured_response() for the asyncio pipeline: waits (and backs off) without a thread."""
+        # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
+        # do not change this unless explicitly requested by the user
+        response = await self.async_client.chat.completions.create(
+            model="gpt-5",
+            messages=self._structured_messages(system_prompt, user_message, context),
+            response_format={"type": "json_object"},
+            max_completion_tokens=8192
+        )
+        
+        return response.choices[0].message.content or ""
+    
+    def _structured_messages(self, system_prompt: str, user_message: str, context: str) -> list:
         messages = [
             {"role": "system", "content": system_prompt}
         ]
@@ -77,14 +115,4 @@ class AIAgent:
             messages.append({"role": "system", "content": f"Contexto adicional:\n{context}"})
         
         messages.append({"role": "user", "content": user_message})
-        
-        # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
-        # do not change this unless explicitly requested by the user
-        response = self.client.chat.completions.create(
-            model="gpt-5",
-            messages=messages,
-            response_format={"type": "json_object"},
-            max_completion_tokens=8192
-        )
-        
-        return response.choices[0].message.content or ""
+        return messages
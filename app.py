@@ -216,10 +216,21 @@ with tab4:
                 
                 st.subheader(f"Conversa com {contact['name']}")
                 
-                interactions = db.get_client_interactions(phone, limit=100)
+                # Older pages are loaded on demand by following the query cursor
+                pages_key = f"chat_pages_{phone}"
+                interactions, older_cursor = db.query_interactions(phone=phone, limit=100)
+                for _ in range(st.session_state.get(pages_key, 1) - 1):
+                    if not older_cursor:
+                        break
+                    page, older_cursor = db.query_interactions(phone=phone, before=older_cursor, limit=100)
+                    interactions.extend(page)
                 
                 if interactions:
-                    st.write(f"**Total de mensagens:** {len(interactions)}")
+                    st.write(f"**Mensagens carregadas:** {len(interactions)}")
+                    
+                    if older_cursor and st.button("⬆️ Carregar mensagens anteriores", key=f"older_{phone}"):
+                        st.session_state[pages_key] = st.session_state.get(pages_key, 1) + 1
+                        st.rerun()
                     
                     chat_container = st.container()
                     with chat_container:
@@ -285,12 +296,25 @@ with tab4:
 with tab5:
     st.header("📝 Histórico de Interações")
     
-    interactions = db.get_recent_interactions(limit=50)
+    if "history_cursors" not in st.session_state:
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    interactions, next_cursor = db.query_interactions(before=cursors[-1], limit=20)
     
     if interactions:
-        st.write(f"**Total de interações:** {len(interactions)}")
+        st.write(f"**Página {len(cursors)}** - {len(interactions)} interações")
         
-        for interaction in interactions[:20]:
+        col_prev, col_next = st.columns(2)
+        with col_prev:
+            if len(cursors) > 1 and st.button("⬅️ Mais recentes"):
+                cursors.pop()
+                st.rerun()
+        with col_next:
+            if next_cursor and st.button("Mais antigas ➡️"):
+                cursors.append(next_cursor)
+                st.rerun()
+        
+        for interaction in interactions:
             timestamp = interaction.get('timestamp', '')
             try:
                 dt = datetime.fromisoformat(timestamp)
@@ -386,7 +410,7 @@ with tab7:
     st.header("⚙️ Buffer & Monitoramento do Sistema")
     
     from buffer_manager import buffer_manager
-    from config import TESTING_MODE, BUFFER_WINDOW_SECONDS
+    from config import TESTING_MODE, BUFFER_WINDOW_SECONDS, BUFFER_WINDOW_MIN_SECONDS, BUFFER_WINDOW_MAX_SECONDS
     
     col1, col2 = st.columns(2)
     
@@ -394,7 +418,14 @@ with tab7:
         st.subheader("📊 Status do Buffer Manager")
         st.write(f"**Status:** {'🟢 Rodando' if buffer_manager.running else '🔴 Parado'}")
         st.write(f"**Modo de Teste:** {'✅ Ativo' if TESTING_MODE else '❌ Desativado'}")
-        st.write(f"**Janela de Buffer:** {BUFFER_WINDOW_SECONDS} segundos")
+        window = buffer_manager.window.metrics()
+        if window["adaptive"]:
+            st.write(f"**Janela de Buffer:** adaptativa, {BUFFER_WINDOW_MIN_SECONDS:g}–{BUFFER_WINDOW_MAX_SECONDS:g} segundos (padrão {BUFFER_WINDOW_SECONDS})")
+        else:
+            st.write(f"**Janela de Buffer:** {BUFFER_WINDOW_SECONDS} segundos")
+        if window["turns"]:
+            st.write(f"**Tempo até a 1ª resposta:** {window['first_reply_avg_s']:.1f}s "
+                     f"(janela fixa: {window['fixed_window_first_reply_avg_s']:.1f}s)")
         
         if st.button("🔄 Forçar Health Check"):
             buffer_manager._run_health_checks()
@@ -402,21 +433,22 @@ with tab7:
     
     with col2:
         st.subheader("📈 Estatísticas")
-        data = db._load()
-        buffers = data.get("message_buffers", {})
+        # Every buffer through the indexed health-check queries: waiting ones by expiry, locked ones by lock time
+        waiting_buffers = db.get_unprocessed_buffers(datetime.max.isoformat())
+        processing_buffers = db.get_stuck_locks(datetime.max.isoformat())
         alerts = db.get_alerts(unresolved_only=True, limit=50)
         
-        st.metric("Buffers Ativos", len([b for b in buffers.values() if not b.get("processing", False)]))
-        st.metric("Buffers Processando", len([b for b in buffers.values() if b.get("processing", False)]))
+        st.metric("Buffers Ativos", len(waiting_buffers))
+        st.metric("Buffers Processando", len(processing_buffers))
         st.metric("Alertas Não Resolvidos", len(alerts))
     
     st.divider()
     
     st.subheader("📋 Buffers Ativos")
-    buffers = data.get("message_buffers", {})
+    buffers = processing_buffers + waiting_buffers
     
     if buffers:
-        for buffer_key, buffer in buffers.items():
+        for buffer in buffers:
             phone = buffer.get("phone", "")
             expires_at = buffer.get("buffer_expires_at", "")
             processing = buffer.get("processing", False)
@@ -501,18 +533,11 @@ with tab7:
     
     with col_x:
         if st.button("🔄 Limpar Buffers Expirados"):
-            from datetime import datetime
-            now = datetime.now()
-            buffers = data.get("message_buffers", {})
             cleared = 0
             
-            for buffer_key, buffer in list(buffers.items()):
-                expires_at = buffer.get("buffer_expires_at")
-                if expires_at:
-                    exp = datetime.fromisoformat(expires_at)
-                    if exp < now and not buffer.get("processing", False):
-                        db.delete_message_buffer(buffer.get("phone"))
-                        cleared += 1
+            for buffer in db.get_unprocessed_buffers(datetime.now().isoformat()):
+                db.delete_message_buffer(buffer.get("phone"))
+                cleared += 1
             
             st.success(f"✅ {cleared} buffers limpos!")
             st.rerun()
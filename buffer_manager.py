@@ -1,17 +1,39 @@
 """
-Message Buffer Manager - Implements 15-second sliding window buffer
-for batching rapid messages before AI processing.
+Message Buffer Manager - Implements a sliding window buffer for batching
+rapid messages before AI processing. The window is adapted to each
+contact's typing cadence (see buffer_window), 15 seconds until it is known.
+
+Buffers are flushed by deadline rather than by polling: every buffer
+write reaches the manager through the database change feed and moves the
+phone's deadline in a DeadlineScheduler, whose worker sleeps until the
+earliest window ends. Due buffers are handed to a pool of BUFFER_WORKERS
+threads, so one slow conversation (model retries, Z-API timeouts) does not
+hold up the others; a phone never has two turns running at once.
+
+With TURN_ENGINE=asyncio the pool is replaced by an AsyncTurnEngine
+(turn_pipeline): each turn is a coroutine awaiting OpenAI and Z-API, so
+far more conversations can wait on the network than there are threads.
+Database calls stay synchronous inside the coroutine; they only touch
+the in-memory store.
 """
+import asyncio
+import functools
+import itertools
+import os
 import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 from database import db
+from buffer_scheduler import DeadlineScheduler
+from buffer_window import AdaptiveWindow
 from config import (
-    BUFFER_WINDOW_SECONDS,
-    BUFFER_CHECK_INTERVAL_SECONDS,
-    BUFFER_LOCK_TIMEOUT_SECONDS
+    BUFFER_RETRY_DELAY_SECONDS,
+    BUFFER_LOCK_TIMEOUT_SECONDS,
+    BUFFER_WORKERS,
+    TURN_ENGINE
 )
 
 logger = logging.getLogger(__name__)
@@ -19,11 +41,27 @@ logger = logging.getLogger(__name__)
 class BufferManager:
     """Manages message buffers with sliding window and locking mechanism."""
     
-    def __init__(self):
+    def __init__(self, database=None, workers: int = BUFFER_WORKERS, engine: str = TURN_ENGINE):
+        self.database = database if database is not None else db
+        self.workers = workers
+        self.engine = engine
         self.running = False
         self.worker_thread: Optional[threading.Thread] = None
         self.health_check_thread: Optional[threading.Thread] = None
         self.lock = threading.Lock()
+        self.scheduler = DeadlineScheduler()
+        self.window = AdaptiveWindow()
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.turn_engine = None
+        self._async_sender = None
+        # Phones queued or running in the pool, and those due again while they were
+        self._busy_phones = set()
+        self._rerun_phones = set()
+        self.queued = 0
+        self.active = 0
+        self.turns = 0
+        self._lock_ids = itertools.count()
     
     def start(self):
         """Start background workers."""
@@ -31,6 +69,23 @@ class BufferManager:
             return
         
         self.running = True
+        # Turns dropped by a previous stop() left their phones marked busy
+        with self.lock:
+            self._busy_phones.clear()
+            self._rerun_phones.clear()
+            self.queued = 0
+        if self.engine == "asyncio":
+            from turn_pipeline import AsyncTurnEngine
+            self.turn_engine = AsyncTurnEngine()
+            self.turn_engine.start()
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="buffer-worker")
+        
+        # Buffer writes from anywhere (add_message, health checks, other processes) move deadlines
+        self._unsubscribe = self.database.subscribe(
+            self._on_buffer_event, types={"buffer_upserted", "buffer_deleted"}
+        )
+        self._schedule_idle_buffers()
         
         # Start buffer checker worker
         self.worker_thread = threading.Thread(target=self._buffer_checker_worker, daemon=True)
@@ -45,8 +100,20 @@ class BufferManager:
     def stop(self):
         """Stop background workers."""
         self.running = False
+        self.scheduler.wake()
+        if self._unsubscribe:
+            self._unsubscribe()
+            self._unsubscribe = None
         if self.worker_thread:
             self.worker_thread.join(timeout=2)
+        if self.executor:
+            # Turns already running finish in the background; queued ones are dropped (their buffers stay due)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.turn_engine:
+            if self._async_sender is not None:
+                # Its HTTP connections belong to the engine's loop
+                self._close_sender()
+            self.turn_engine.stop()
         if self.health_check_thread:
             self.health_check_thread.join(timeout=2)
         logger.info("Buffer manager stopped")
@@ -58,40 +125,61 @@ class BufferManager:
         """
         phone = self._normalize_phone(phone)
         now = datetime.now()
-        expires_at = now + timedelta(seconds=BUFFER_WINDOW_SECONDS)
-        
-        # Get or create buffer
-        buffer_data = db.get_message_buffer(phone)
         
-        if buffer_data:
-            # Check for stuck buffer (retry logic)
-            created_at = datetime.fromisoformat(buffer_data.get('created_at', now.isoformat()))
-            age_seconds = (now - created_at).total_seconds()
+        # Buffer update and message insert are persisted together
+        with self.database.transaction(phone):
+            # A webhook retry of a message already stored: acknowledge without touching the buffer
+            message_id = (metadata or {}).get("message_id")
+            if message_id and not self.database.mark_message_seen(message_id, phone):
+                logger.info(f"Duplicate webhook for message {message_id} from {phone}, ignoring")
+                return {
+                    "success": True,
+                    "buffered": False,
+                    "duplicate": True,
+                    "phone": phone
+                }
             
-            if age_seconds > 120:  # 2 minutes old
-                logger.warning(f"⚠️ Stuck buffer detected for {phone}, resetting")
-                retry_count = buffer_data.get('retry_count', 0) + 1
-                db.create_alert(
-                    type='buffer_stuck',
-                    phone=phone,
-                    details=f"Buffer stuck for {age_seconds:.0f}s, retry #{retry_count}"
-                )
+            # The window after this message, from the contact's cadence so far (recorded once committed)
+            expires_at = now + timedelta(seconds=self.window.peek(phone, message, now.timestamp()))
+            
+            # Get or create buffer
+            buffer_data = self.database.get_message_buffer(phone)
+            
+            if buffer_data:
+                # Check for stuck buffer (retry logic)
+                created_at = datetime.fromisoformat(buffer_data.get('created_at', now.isoformat()))
+                age_seconds = (now - created_at).total_seconds()
+                
+                if age_seconds > 120:  # 2 minutes old
+                    logger.warning(f"⚠️ Stuck buffer detected for {phone}, resetting")
+                    retry_count = buffer_data.get('retry_count', 0) + 1
+                    self.database.create_alert(
+                        type='buffer_stuck',
+                        phone=phone,
+                        details=f"Buffer stuck for {age_seconds:.0f}s, retry #{retry_count}"
+                    )
+                else:
+                    retry_count = buffer_data.get('retry_count', 0)
             else:
-                retry_count = buffer_data.get('retry_count', 0)
-        else:
-            retry_count = 0
-        
-        # Update or create buffer with new expiration
-        db.upsert_message_buffer(
-            phone=phone,
-            last_message_at=now.isoformat(),
-            buffer_expires_at=expires_at.isoformat(),
-            processing=False,
-            retry_count=retry_count
-        )
-        
-        # Save message to database
-        db.add_interaction(phone, "user", message, "incoming", metadata=metadata)
+                retry_count = 0
+            
+            # Save message to database
+            interaction = self.database.add_interaction(phone, "user", message, "incoming", metadata=metadata)
+            
+            # Update or create buffer with new expiration, queueing the message for its turn
+            pending = {"message": message, "timestamp": interaction["timestamp"]}
+            if message_id:
+                pending["message_id"] = message_id
+            self.database.upsert_message_buffer(
+                phone=phone,
+                last_message_at=now.isoformat(),
+                buffer_expires_at=expires_at.isoformat(),
+                processing=False,
+                retry_count=retry_count,
+                pending_message=pending
+            )
+        # Counted in the cadence only now that the write committed (duplicates returned above)
+        self.window.observe(phone, message, now.timestamp())
         
         logger.debug(f"Message buffered for {phone}, expires at {expires_at.isoformat()}")
         
@@ -113,87 +201,229 @@ class BufferManager:
         return phone
     
     def _buffer_checker_worker(self):
-        """Background worker that checks for expired buffers every N seconds."""
+        """Background worker that hands each buffer to the pool as soon as its deadline is due."""
         while self.running:
-            try:
-                self._check_expired_buffers()
-            except Exception as e:
-                logger.error(f"Error in buffer checker: {e}")
+            for phone in self.scheduler.wait_due():
+                self._submit(phone)
+    
+    def _submit(self, phone: str):
+        """Queue a turn for phone, or run it again after the turn already queued or running."""
+        with self.lock:
+            if phone in self._busy_phones:
+                self._rerun_phones.add(phone)
+                return
+            self._busy_phones.add(phone)
+            self.queued += 1
+        try:
+            if self.turn_engine is not None:
+                self.turn_engine.submit(self._run_turn_async, phone)
+            else:
+                self.executor.submit(self._run_turn, phone)
+        except RuntimeError:
+            # Pool shut down by stop(): the buffer stays in the database for the next start
+            with self.lock:
+                self._busy_phones.discard(phone)
+                self.queued -= 1
+    
+    def _run_turn(self, phone: str):
+        self._start_turn()
+        try:
+            self._process_buffer(phone)
+        except Exception as e:
+            logger.error(f"Error in buffer worker for {phone}: {e}")
+        finally:
+            self._finish_turn(phone)
+    
+    async def _run_turn_async(self, phone: str):
+        self._start_turn()
+        try:
+            await self._process_buffer_async(phone)
+        except Exception as e:
+            logger.error(f"Error in async turn for {phone}: {e}")
+        finally:
+            self._finish_turn(phone)
+    
+    def _start_turn(self):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+    
+    def _finish_turn(self, phone: str):
+        with self.lock:
+            self.active -= 1
+            self.turns += 1
+            self._busy_phones.discard(phone)
+            rerun = phone in self._rerun_phones
+            self._rerun_phones.discard(phone)
+        if rerun and self.running:
+            self._submit(phone)
+    
+    @staticmethod
+    def _deadline(buffer: Dict) -> float:
+        """When to flush a buffer (epoch seconds): its window end, or a retry delay after a failure."""
+        deadline = datetime.fromisoformat(buffer['buffer_expires_at']).timestamp()
+        if buffer.get('last_retry_at'):
+            retry_at = datetime.fromisoformat(buffer['last_retry_at']) + timedelta(seconds=BUFFER_RETRY_DELAY_SECONDS)
+            deadline = max(deadline, retry_at.timestamp())
+        return deadline
+    
+    def _on_buffer_event(self, event: Dict):
+        """Change feed callback: keep the phone's deadline in step with its buffer."""
+        buffer = event["record"]
+        phone = buffer["phone"] if buffer else event["key"][len("buffer_"):]
+        if buffer and not buffer.get('processing', False):
+            self.scheduler.schedule(phone, self._deadline(buffer))
+        else:
+            self.scheduler.cancel(phone)
+    
+    def _schedule_idle_buffers(self):
+        """Schedule every buffer waiting in the database (those already due fire at once)."""
+        for buffer in self.database.get_expired_buffers(datetime.max.isoformat()):
+            self.scheduler.schedule(buffer['phone'], self._deadline(buffer))
+    
+    def _process_buffer(self, phone: str):
+        """Flush one buffer whose deadline came up."""
+        buffer = self._claim_buffer(phone)
+        if buffer is None:
+            return
+        flushed_at = time.time()
+        
+        try:
+            messages = self._buffer_messages(phone, buffer)
+            
+            if messages:
+                # Process batched messages
+                self._process_batched_messages(phone, messages)
             
-            time.sleep(BUFFER_CHECK_INTERVAL_SECONDS)
+            # Clear buffer
+            self._complete_buffer(phone, buffer, messages, flushed_at)
+            
+        except Exception as e:
+            self._fail_buffer(phone, buffer, e)
     
-    def _check_expired_buffers(self):
-        """Check for expired buffers and process them."""
-        now = datetime.now()
-        expired_buffers = db.get_expired_buffers(now.isoformat())
+    async def _process_buffer_async(self, phone: str):
+        """_process_buffer() for the asyncio engine; its database calls run on the adapter threads."""
+        run_sync = self.turn_engine.run_sync
+        buffer = await run_sync(self._claim_buffer, phone)
+        if buffer is None:
+            return
+        flushed_at = time.time()
         
-        for buffer in expired_buffers:
-            phone = buffer['phone']
+        try:
+            messages = await run_sync(self._buffer_messages, phone, buffer)
             
-            # Try to acquire lock
-            if not self._acquire_lock(phone):
-                continue  # Another process is handling it
+            if messages:
+                await self._process_batched_messages_async(phone, messages)
             
-            try:
-                # Get all messages for this phone since buffer started
-                buffer_created = datetime.fromisoformat(buffer.get('created_at', now.isoformat()))
-                messages = db.get_messages_since(phone, buffer_created.isoformat())
-                
-                if messages:
-                    # Process batched messages
-                    self._process_batched_messages(phone, messages)
-                
-                # Clear buffer
-                db.delete_message_buffer(phone)
-                
-            except Exception as e:
-                logger.error(f"Error processing buffer for {phone}: {e}")
-                # Release lock on error
-                db.release_buffer_lock(phone)
-                # Increment retry count
-                db.increment_buffer_retry(phone)
+            await run_sync(self._complete_buffer, phone, buffer, messages, flushed_at)
+            
+        except asyncio.CancelledError:
+            # Engine stopping mid-turn: unlock now rather than leave the buffer to the stuck-lock check
+            await run_sync(self.database.release_buffer_lock, phone, buffer['locked_by'])
+            raise
+        except Exception as e:
+            await run_sync(self._fail_buffer, phone, buffer, e)
+    
+    def _claim_buffer(self, phone: str) -> Optional[Dict]:
+        """The buffer, locked for this turn, or None when it is not due or another worker has it."""
+        buffer = self.database.get_message_buffer(phone)
+        if not buffer or buffer.get('processing', False):
+            return None
+        deadline = self._deadline(buffer)
+        if deadline > datetime.now().timestamp():
+            # Extended by a write whose event has not reached us yet
+            self.scheduler.schedule(phone, deadline)
+            return None
+        
+        # Try to acquire lock (the buffer is the version it was taken on)
+        buffer = self._acquire_lock(phone)  # None: another process is handling it
+        if buffer is not None:
+            self.window.close_burst(phone)
+        return buffer
+    
+    def _buffer_messages(self, phone: str, buffer: Dict) -> List[Dict]:
+        """The messages queued in the buffer (buffers without a queue: all messages since it started)."""
+        if 'pending' in buffer:
+            return buffer['pending']
+        buffer_created = buffer.get('created_at') or datetime.now().isoformat()
+        return self.database.get_messages_since(phone, datetime.fromisoformat(buffer_created).isoformat())
+    
+    def _complete_buffer(self, phone: str, buffer: Dict, messages: List[Dict], flushed_at: float):
+        """Clear the messages this turn answered; messages queued meanwhile keep the buffer for another turn."""
+        if messages and messages[0].get('timestamp') and messages[-1].get('timestamp'):
+            self.window.record_turn(
+                first_at=datetime.fromisoformat(messages[0]['timestamp']).timestamp(),
+                last_at=datetime.fromisoformat(messages[-1]['timestamp']).timestamp(),
+                flushed_at=flushed_at,
+                replied_at=time.time()
+            )
+        if 'pending' in buffer:
+            self.database.flush_message_buffer(phone, len(messages), locked_by=buffer['locked_by'])
+        else:
+            self.database.delete_message_buffer(phone)
+    
+    def _fail_buffer(self, phone: str, buffer: Dict, error: Exception):
+        logger.error(f"Error processing buffer for {phone}: {error}")
+        # Count the retry while still locked, so the release reschedules it after the retry delay
+        self.database.increment_buffer_retry(phone)
+        self.database.release_buffer_lock(phone, locked_by=buffer['locked_by'])
     
-    def _acquire_lock(self, phone: str) -> bool:
-        """Atomically acquire lock for buffer processing."""
-        buffer = db.get_message_buffer(phone)
+    def metrics(self) -> Dict:
+        """Pending deadlines, how late the latest-firing one was, worker pool load and window adaptation."""
+        with self.lock:
+            pool = {"workers": self.workers, "queue_depth": self.queued, "active_workers": self.active,
+                    "turns": self.turns}
+        if self.turn_engine is not None:
+            pool["workers"] = 0
+            pool["turn_engine"] = self.turn_engine.metrics()
+        return {**self.scheduler.metrics(), **pool, "window": self.window.metrics()}
+    
+    def _acquire_lock(self, phone: str) -> Optional[Dict]:
+        """
+        Atomically acquire lock for buffer processing.
+        
+        The lock is a compare-and-set against the buffer version we read, so
+        when several workers race for the same buffer (or the same stuck
+        lock) exactly one of them wins. Returns the buffer as it was locked
+        (locked_by is this worker), None when the lock was not acquired.
+        """
+        buffer = self.database.get_message_buffer(phone)
         if not buffer:
-            return False
+            return None
         
         # Check if already locked
+        lock_age = None
         if buffer.get('processing', False):
             locked_at = buffer.get('locked_at')
-            if locked_at:
-                lock_age = (datetime.now() - datetime.fromisoformat(locked_at)).total_seconds()
-                if lock_age > BUFFER_LOCK_TIMEOUT_SECONDS:
-                    logger.warning(f"⚠️ Stuck lock detected for {phone} ({lock_age:.0f}s), forcing unlock")
-                    db.release_buffer_lock(phone)
-                    db.create_alert(
-                        type='buffer_stuck_lock',
-                        phone=phone,
-                        details=f"Lock stuck for {lock_age:.0f}s, forced unlock"
-                    )
-                else:
-                    return False  # Still locked
+            if not locked_at:
+                return None
+            lock_age = (datetime.now() - datetime.fromisoformat(locked_at)).total_seconds()
+            if lock_age <= BUFFER_LOCK_TIMEOUT_SECONDS:
+                return None  # Still locked
         
-        # Try to acquire lock
-        process_id = f"process_{int(time.time() * 1000)}"
-        success = db.acquire_buffer_lock(phone, process_id)
+        # Try to acquire lock (taking over a stuck one in the same step)
+        process_id = f"process_{os.getpid()}_{threading.get_ident()}_{next(self._lock_ids)}"
+        success = self.database.acquire_buffer_lock(phone, process_id, expected_version=buffer.get('version', 0))
         
         if success:
             logger.debug(f"🔒 Lock acquired for {phone} by {process_id}")
-        
-        return success
+            if lock_age is not None:
+                logger.warning(f"⚠️ Stuck lock detected for {phone} ({lock_age:.0f}s), taken over")
+                self.database.create_alert(
+                    type='buffer_stuck_lock',
+                    phone=phone,
+                    details=f"Lock stuck for {lock_age:.0f}s, forced unlock"
+                )
+            buffer.update(processing=True, locked_by=process_id)
+            return buffer
+        return None
     
     def _process_batched_messages(self, phone: str, messages: List[Dict]):
         """Process batched messages through message router."""
         from message_router import router
         from whatsapp_api import whatsapp
         
-        # Combine messages into single text with timestamps
-        message_text = "\n".join([
-            f"[{msg.get('timestamp', '')[:19]}] {msg.get('message', '')}"
-            for msg in messages
-        ])
+        message_text = self._batch_text(messages)
         
         # Send typing indicator
         whatsapp.send_typing_indicator(phone)
@@ -210,12 +440,59 @@ class BufferManager:
             
         except Exception as e:
             logger.error(f"Error routing batched messages for {phone}: {e}")
-            db.create_alert(
+            self.database.create_alert(
                 type='buffer_processing_error',
                 phone=phone,
                 details=f"Error processing batch: {str(e)}"
             )
     
+    async def _process_batched_messages_async(self, phone: str, messages: List[Dict]):
+        """_process_batched_messages() on the event loop, replying through the async Z-API sender."""
+        from message_router import router
+        
+        sender = self._sender()
+        message_text = self._batch_text(messages)
+        
+        await sender.send_typing_indicator(phone)
+        
+        logger.info(f"📦 Processing {len(messages)} batched messages for {phone}")
+        
+        try:
+            result = await router.route_message_async(phone, message_text, self.turn_engine.run_sync, sender)
+            
+            if result.get('success'):
+                await sender.send_viewed_indicator(phone)
+            
+        except Exception as e:
+            logger.error(f"Error routing batched messages for {phone}: {e}")
+            await self.turn_engine.run_sync(functools.partial(
+                self.database.create_alert,
+                type='buffer_processing_error',
+                phone=phone,
+                details=f"Error processing batch: {str(e)}"
+            ))
+    
+    def _sender(self):
+        if self._async_sender is None:
+            from whatsapp_api import AsyncWhatsAppAPI, whatsapp
+            self._async_sender = AsyncWhatsAppAPI(whatsapp)
+        return self._async_sender
+    
+    def _close_sender(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._async_sender.aclose(), self.turn_engine.loop).result(timeout=2)
+        except Exception as e:
+            logger.warning(f"Error closing async Z-API sender: {e}")
+        self._async_sender = None
+    
+    @staticmethod
+    def _batch_text(messages: List[Dict]) -> str:
+        """Combine messages into single text with timestamps."""
+        return "\n".join([
+            f"[{msg.get('timestamp', '')[:19]}] {msg.get('message', '')}"
+            for msg in messages
+        ])
+    
     def _health_check_worker(self):
         """Background worker that runs health checks every 5 minutes."""
         while self.running:
@@ -232,38 +509,38 @@ class BufferManager:
         one_minute_ago = (now - timedelta(minutes=1)).isoformat()
         
         # Check for stuck locks (> 5 minutes)
-        stuck_locks = db.get_stuck_locks(five_minutes_ago)
+        stuck_locks = self.database.get_stuck_locks(five_minutes_ago)
         for lock in stuck_locks:
             logger.warning(f"🔓 Force unlocking stuck lock for {lock['phone']}")
-            db.release_buffer_lock(lock['phone'])
-            db.create_alert(
+            self.database.release_buffer_lock(lock['phone'])
+            self.database.create_alert(
                 type='health_check_stuck_lock',
                 phone=lock['phone'],
                 details="Stuck lock detected and force-unlocked"
             )
         
         # Check for unprocessed buffers (> 1 minute expired)
-        unprocessed = db.get_unprocessed_buffers(one_minute_ago)
+        unprocessed = self.database.get_unprocessed_buffers(one_minute_ago)
         for buffer in unprocessed:
             logger.warning(f"⚡ Force processing expired buffer for {buffer['phone']}")
             # Trigger processing by updating expires_at to now
-            db.upsert_message_buffer(
+            self.database.upsert_message_buffer(
                 phone=buffer['phone'],
                 last_message_at=buffer.get('last_message_at', now.isoformat()),
                 buffer_expires_at=now.isoformat(),
                 processing=False,
                 retry_count=buffer.get('retry_count', 0)
             )
-            db.create_alert(
+            self.database.create_alert(
                 type='health_check_unprocessed',
                 phone=buffer['phone'],
                 details="Expired buffer force-processed"
             )
         
         # Check for high retry counts (>= 5)
-        high_retries = db.get_high_retry_buffers(5)
+        high_retries = self.database.get_high_retry_buffers(5)
         for buffer in high_retries:
-            db.create_alert(
+            self.database.create_alert(
                 type='health_check_high_retries',
                 phone=buffer['phone'],
                 details=f"Buffer has {buffer.get('retry_count', 0)} retries, needs manual review"
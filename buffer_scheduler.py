@@ -0,0 +1,108 @@
+"""
+Deadline scheduler for message buffers.
+
+Each phone has at most one pending deadline (the end of its buffer
+window). Deadlines sit in a heap; scheduling a phone again replaces its
+deadline, and the replaced heap entry is skipped when it surfaces. The
+worker sleeps on a condition until the earliest deadline, or until an
+earlier one is scheduled, so a buffer is flushed as soon as its window
+ends and an idle system does no work at all.
+"""
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+class DeadlineScheduler:
+    """Earliest-deadline-first timers keyed by phone (deadlines are epoch seconds)."""
+    
+    def __init__(self):
+        self._heap: List[Tuple[float, str]] = []
+        self._deadlines: Dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._woken = False
+        self.fired = 0
+        self.lateness_max = 0.0
+    
+    def __len__(self) -> int:
+        return len(self._deadlines)
+    
+    def schedule(self, key: str, deadline: float):
+        """Set (or move) key's deadline."""
+        with self._condition:
+            if self._deadlines.get(key) == deadline:
+                return
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            if self._heap[0] == (deadline, key):
+                # New earliest deadline: the sleeping worker must wake sooner
+                self._condition.notify_all()
+    
+    def cancel(self, key: str):
+        with self._condition:
+            self._deadlines.pop(key, None)
+    
+    def clear(self):
+        with self._condition:
+            self._heap = []
+            self._deadlines = {}
+    
+    def deadline(self, key: str) -> Optional[float]:
+        with self._condition:
+            return self._deadlines.get(key)
+    
+    def wake(self):
+        """Make wait_due() return now, due keys or not (used to stop the worker)."""
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+    
+    def wait_due(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Block until deadlines are due and return their keys, earliest first.
+        
+        Returns an empty list after wake() or once timeout seconds passed.
+        Returned keys are unscheduled; schedule them again to retry.
+        """
+        give_up = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while True:
+                now = time.time()
+                due = self._pop_due(now)
+                if due or self._woken:
+                    self._woken = False
+                    return due
+                wait = self._next_deadline() - now if self._deadlines else None
+                if give_up is not None:
+                    if now >= give_up:
+                        return []
+                    wait = give_up - now if wait is None else min(wait, give_up - now)
+                self._condition.wait(wait)
+    
+    def _pop_due(self, now: float) -> List[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) != deadline:
+                # Replaced or cancelled since it was pushed
+                continue
+            del self._deadlines[key]
+            due.append(key)
+            self.fired += 1
+            self.lateness_max = max(self.lateness_max, now - deadline)
+        return due
+    
+    def metrics(self) -> Dict:
+        with self._condition:
+            return {
+                "pending": len(self._deadlines),
+                "fired": self.fired,
+                "lateness_ms_max": round(self.lateness_max * 1000, 3),
+                "next_due_in_ms": round(max(0.0, self._next_deadline() - time.time()) * 1000, 3) if self._deadlines else None
+            }
+    
+    def _next_deadline(self) -> float:
+        # Stale entries are left on the heap until they surface
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
@@ -0,0 +1,191 @@
+"""
+Adaptive buffer window - how long to wait for a contact's next message.
+
+A fixed BUFFER_WINDOW_SECONDS makes someone who sends one complete
+question wait for nothing, and can still split fast multi-message typists.
+AdaptiveWindow learns each contact's cadence instead: the gaps between
+messages of the same burst and how often a message is followed by
+another one. A burst ends when its buffer is flushed (close_burst()), so
+a reply to the bot starts a new one. After every message it picks the window:
+
+- no history yet: BUFFER_WINDOW_SECONDS;
+- otherwise the contact's 90th percentile gap plus a margin, clamped to
+  [BUFFER_WINDOW_MIN_SECONDS, BUFFER_WINDOW_MAX_SECONDS] (bursty senders
+  get up to the cap);
+- closed early (the minimum) when the contact rarely follows up, and cut
+  to a third when the message looks complete (a sentence ending in ?, !
+  or .) unless the contact usually keeps typing.
+
+Cadences live in memory for the life of the process (so each gunicorn
+worker learns from its own share of the messages). metrics() compares
+the time to first reply with what the fixed window would have given.
+"""
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+from config import BUFFER_ADAPTIVE_WINDOW, BUFFER_WINDOW_MAX_SECONDS, BUFFER_WINDOW_MIN_SECONDS, BUFFER_WINDOW_SECONDS
+
+# Samples needed before a contact's own cadence is trusted
+MIN_SAMPLES = 3
+# Gaps kept per contact, contacts kept in memory, and turns kept for the reply-time metrics
+GAP_SAMPLES = 20
+MAX_CONTACTS = 10000
+TURN_SAMPLES = 1000
+
+def looks_complete(message: str) -> bool:
+    """A message that reads like a whole thought: a few words ending in ?, ! or ."""
+    text = (message or "").strip()
+    return len(text.split()) >= 3 and text[-1] in "?!."
+
+def _quantile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+class _Cadence:
+    """One contact's recent gaps within bursts, and how often its messages were followed up."""
+    __slots__ = ("gaps", "follow_ups", "bursts", "last_at", "closed_at", "window")
+    
+    def __init__(self):
+        self.gaps: Deque[float] = deque(maxlen=GAP_SAMPLES)
+        self.follow_ups = 0
+        self.bursts = 0
+        self.last_at: Optional[float] = None
+        # Last message of the burst a flush closed (last_at is then None)
+        self.closed_at: Optional[float] = None
+        self.window = 0.0
+    
+    def copy(self) -> "_Cadence":
+        cadence = _Cadence()
+        cadence.gaps.extend(self.gaps)
+        cadence.follow_ups = self.follow_ups
+        cadence.bursts = self.bursts
+        cadence.last_at = self.last_at
+        cadence.closed_at = self.closed_at
+        cadence.window = self.window
+        return cadence
+    
+    def follow_up_rate(self) -> Optional[float]:
+        """Share of messages followed by another in the same burst, None until enough is known."""
+        total = self.follow_ups + self.bursts
+        return self.follow_ups / total if total >= MIN_SAMPLES else None
+
+class AdaptiveWindow:
+    """Per-contact buffer window (see module docstring); with adaptive=False it is always the fixed window."""
+    
+    def __init__(self, adaptive: bool = BUFFER_ADAPTIVE_WINDOW, default: float = BUFFER_WINDOW_SECONDS,
+                 minimum: float = BUFFER_WINDOW_MIN_SECONDS, maximum: float = BUFFER_WINDOW_MAX_SECONDS):
+        self.adaptive = adaptive
+        self.default = default
+        self.minimum = minimum
+        self.maximum = max(maximum, default)
+        self.lock = threading.Lock()
+        self._cadences: "OrderedDict[str, _Cadence]" = OrderedDict()
+        self.early_closes = 0
+        self.extensions = 0
+        self.split_bursts = 0
+        self._turns: Deque[tuple] = deque(maxlen=TURN_SAMPLES)
+    
+    def peek(self, phone: str, message: str, now: float) -> float:
+        """
+        The window observe() would return, without recording anything.
+        
+        add_message() needs the window inside its transaction but only
+        records the message with observe() once that transaction commits,
+        so rolled-back writes and webhook retries do not count.
+        """
+        with self.lock:
+            cadence = self._cadences.get(phone)
+            return self._advance(cadence.copy() if cadence else _Cadence(), message, now, record=False)
+    
+    def observe(self, phone: str, message: str, now: float) -> float:
+        """Record a message (now in epoch seconds) and return the window, in seconds, to wait after it."""
+        with self.lock:
+            cadence = self._cadences.pop(phone, None) or _Cadence()
+            self._cadences[phone] = cadence
+            if len(self._cadences) > MAX_CONTACTS:
+                self._cadences.popitem(last=False)
+            return self._advance(cadence, message, now, record=True)
+    
+    def close_burst(self, phone: str):
+        """
+        End the contact's burst: its buffer was flushed for a turn.
+        
+        The next message (typically the reply to the bot's answer) starts a
+        new burst, so the time spent waiting for the bot never counts as a
+        gap inside a burst.
+        """
+        with self.lock:
+            cadence = self._cadences.get(phone)
+            if cadence is not None and cadence.last_at is not None:
+                cadence.closed_at, cadence.last_at = cadence.last_at, None
+    
+    def _advance(self, cadence: _Cadence, message: str, now: float, record: bool) -> float:
+        gap = now - cadence.last_at if cadence.last_at is not None else None
+        if gap is not None and gap <= self.maximum:
+            cadence.follow_ups += 1
+            cadence.gaps.append(gap)
+        else:
+            cadence.bursts += 1
+        previous = cadence.last_at if cadence.last_at is not None else cadence.closed_at
+        if record and previous is not None and cadence.window < now - previous <= self.default:
+            # Arrived after an early close: the fixed window would have batched it with the last turn
+            self.split_bursts += 1
+        cadence.window = self._window(cadence, message, record)
+        cadence.last_at = now
+        cadence.closed_at = None
+        return cadence.window
+    
+    def _window(self, cadence: _Cadence, message: str, record: bool) -> float:
+        if not self.adaptive:
+            return self.default
+        
+        if len(cadence.gaps) >= MIN_SAMPLES:
+            window = min(max(_quantile(cadence.gaps, 0.9) * 1.5 + 1, self.minimum), self.maximum)
+        else:
+            window = self.default
+        
+        follow_up_rate = cadence.follow_up_rate()
+        if follow_up_rate is not None and follow_up_rate < 0.2:
+            window = self.minimum
+        elif looks_complete(message) and (follow_up_rate is None or follow_up_rate < 0.5):
+            window = max(self.minimum, window / 3)
+        
+        if record and window < self.default:
+            self.early_closes += 1
+        elif record and window > self.default:
+            self.extensions += 1
+        return window
+    
+    def record_turn(self, first_at: float, last_at: float, flushed_at: float, replied_at: float):
+        """
+        Record a turn's time to first reply (all epoch seconds).
+        
+        The fixed-window figure is the same turn as if the buffer had been
+        flushed BUFFER_WINDOW_SECONDS after its last message.
+        """
+        processing = replied_at - flushed_at
+        fixed_flush = max(flushed_at, last_at + self.default)
+        with self.lock:
+            self._turns.append((replied_at - first_at, fixed_flush + processing - first_at))
+    
+    def metrics(self) -> Dict:
+        with self.lock:
+            turns = list(self._turns)
+            metrics = {
+                "adaptive": self.adaptive,
+                "contacts": len(self._cadences),
+                "early_closes": self.early_closes,
+                "extensions": self.extensions,
+                "split_bursts": self.split_bursts,
+                "turns": len(turns)
+            }
+        if turns:
+            replies = [reply for reply, _ in turns]
+            fixed = [reply for _, reply in turns]
+            metrics.update({
+                "first_reply_avg_s": round(sum(replies) / len(turns), 3),
+                "first_reply_p90_s": round(_quantile(replies, 0.9), 3),
+                "fixed_window_first_reply_avg_s": round(sum(fixed) / len(turns), 3),
+                "fixed_window_first_reply_p90_s": round(_quantile(fixed, 0.9), 3)
+            })
+        return metrics
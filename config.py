@@ -26,5 +26,63 @@ AI_INTEGRATIONS_OPENAI_BASE_URL = os.environ.get("AI_INTEGRATIONS_OPENAI_BASE_UR
 
 # Buffer configuration
 BUFFER_WINDOW_SECONDS = int(os.environ.get("BUFFER_WINDOW_SECONDS", "15"))
-BUFFER_CHECK_INTERVAL_SECONDS = int(os.environ.get("BUFFER_CHECK_INTERVAL_SECONDS", "3"))
+# Adaptive window (buffer_window): each contact's window is learned from its typing cadence, between
+# BUFFER_WINDOW_MIN_SECONDS and BUFFER_WINDOW_MAX_SECONDS; BUFFER_WINDOW_SECONDS until enough is known, or always when off
+# Cadences are kept in memory per process: each gunicorn worker learns only from the messages its own
+# webhook requests received, so with several workers a contact's cadence is split between them and takes longer to learn
+BUFFER_ADAPTIVE_WINDOW = os.environ.get("BUFFER_ADAPTIVE_WINDOW", "true").lower() == "true"
+BUFFER_WINDOW_MIN_SECONDS = float(os.environ.get("BUFFER_WINDOW_MIN_SECONDS", "3"))
+BUFFER_WINDOW_MAX_SECONDS = float(os.environ.get("BUFFER_WINDOW_MAX_SECONDS", "30"))
+# Delay before a buffer whose processing failed is tried again (BUFFER_CHECK_INTERVAL_SECONDS is the old name)
+BUFFER_RETRY_DELAY_SECONDS = int(os.environ.get("BUFFER_RETRY_DELAY_SECONDS", os.environ.get("BUFFER_CHECK_INTERVAL_SECONDS", "3")))
 BUFFER_LOCK_TIMEOUT_SECONDS = int(os.environ.get("BUFFER_LOCK_TIMEOUT_SECONDS", "60"))
+# Threads flushing buffers; different phones are processed in parallel, one turn per phone at a time
+BUFFER_WORKERS = int(os.environ.get("BUFFER_WORKERS", "8"))
+# Turn engine: "threads" (BUFFER_WORKERS blocking turns) or "asyncio" (turns as coroutines on one event
+# loop, awaiting OpenAI and Z-API without a thread each; agents without an async path run on the adapter threads)
+TURN_ENGINE = os.environ.get("TURN_ENGINE", "threads").lower()
+ASYNC_MAX_TURNS = int(os.environ.get("ASYNC_MAX_TURNS", "200"))
+ASYNC_SYNC_WORKERS = int(os.environ.get("ASYNC_SYNC_WORKERS", "4"))
+
+# Database configuration
+# DATABASE_BACKEND: "json" (data/database.json), "sqlite" (run `python sqlite_database.py` once to migrate)
+# or "sharded" (phones spread over DATABASE_SHARD_COUNT JSON databases under data/shards/)
+DATABASE_BACKEND = os.environ.get("DATABASE_BACKEND", "json").lower()
+DATABASE_JSON_FILE = os.environ.get("DATABASE_JSON_FILE", "data/database.json")
+DATABASE_SQLITE_FILE = os.environ.get("DATABASE_SQLITE_FILE", "data/database.sqlite3")
+DATABASE_SHARD_DIR = os.environ.get("DATABASE_SHARD_DIR", "data/shards")
+DATABASE_SHARD_COUNT = int(os.environ.get("DATABASE_SHARD_COUNT", "16"))
+# Per-phone lock stripes of a JSON database; conversations on different stripes read in parallel
+DATABASE_LOCK_STRIPES = int(os.environ.get("DATABASE_LOCK_STRIPES", "32"))
+# Milliseconds the committer waits to group-commit journal writes into one write + fsync (0 = write-through)
+DATABASE_GROUP_COMMIT_MS = float(os.environ.get("DATABASE_GROUP_COMMIT_MS", "20"))
+DATABASE_JOURNAL_FSYNC = os.environ.get("DATABASE_JOURNAL_FSYNC", "true").lower() == "true"
+# Journal size (bytes) after which it is folded into the snapshot
+DATABASE_JOURNAL_COMPACT_BYTES = int(os.environ.get("DATABASE_JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+# Keep every compacted journal segment (data/journal_archive/) so restores can replay to any point in time
+DATABASE_JOURNAL_ARCHIVE = os.environ.get("DATABASE_JOURNAL_ARCHIVE", "true").lower() == "true"
+
+# Retention: the newest interactions per phone stay live, older ones move to monthly
+# compressed archives (data/archive/) that get_client_interactions still reads
+RETENTION_HOT_INTERACTIONS = int(os.environ.get("RETENTION_HOT_INTERACTIONS", "200"))
+RETENTION_HOT_DAYS = int(os.environ.get("RETENTION_HOT_DAYS", "90"))  # 0 = no age limit
+RETENTION_ARCHIVE_COMPRESSION = os.environ.get("RETENTION_ARCHIVE_COMPRESSION", "gzip")  # gzip | lzma
+# Days append-only logs are kept (0 = forever) and their record caps
+RETENTION_TTL_DAYS = {
+    "system_alerts": int(os.environ.get("RETENTION_ALERTS_TTL_DAYS", "90")),
+    "tool_executions": int(os.environ.get("RETENTION_TOOL_EXECUTIONS_TTL_DAYS", "30")),
+    "approved_responses": int(os.environ.get("RETENTION_APPROVED_RESPONSES_TTL_DAYS", "0"))
+}
+RETENTION_MAX_RECORDS = {
+    "system_alerts": 1000,
+    "tool_executions": 5000
+}
+RETENTION_INTERVAL_SECONDS = int(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+
+# Webhook idempotency: Z-API message IDs remembered in memory (LRU) and in the database for the TTL
+WEBHOOK_DEDUP_LRU_SIZE = int(os.environ.get("WEBHOOK_DEDUP_LRU_SIZE", "10000"))
+WEBHOOK_DEDUP_TTL_HOURS = int(os.environ.get("WEBHOOK_DEDUP_TTL_HOURS", "48"))
+
+# Raw webhook payloads (content-addressed, compressed); unreferenced blobs older than the min age are collected
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", "data/blobs")
+BLOB_GC_MIN_AGE_SECONDS = int(os.environ.get("BLOB_GC_MIN_AGE_SECONDS", "3600"))
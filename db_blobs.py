@@ -0,0 +1,129 @@
+"""
+Content-addressed store for raw webhook payloads.
+
+Each payload is written once, gzip-compressed, to data/blobs/<ab>/<ref>.json.gz
+where ref is a short SHA-256 digest of its canonical JSON. Interactions
+only keep {"payload_ref": ref}; the payload is read back on demand with
+blob_store.get(ref) when debugging. Blobs that no interaction (live or
+archived) refers to any more are removed by collect_garbage().
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional
+from config import BLOB_STORE_DIR, BLOB_GC_MIN_AGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Hex digits of the SHA-256 kept as the reference (128 bits)
+REF_LENGTH = 32
+
+class BlobStore:
+    """Hash-named, compressed payload files; identical payloads are stored once."""
+    
+    def __init__(self, blob_dir: str = BLOB_STORE_DIR):
+        self.blob_dir = blob_dir
+    
+    def _path(self, ref: str) -> str:
+        return os.path.join(self.blob_dir, ref[:2], f"{ref}.json.gz")
+    
+    def put(self, payload: Dict) -> str:
+        """Store payload (if not already stored) and return its reference."""
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+        ref = hashlib.sha256(raw).hexdigest()[:REF_LENGTH]
+        path = self._path(ref)
+        if os.path.exists(path):
+            return ref
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(gzip.compress(raw))
+        # Rename is atomic: a concurrent put of the same payload writes identical bytes
+        os.replace(tmp_file, path)
+        return ref
+    
+    def get(self, ref: str) -> Optional[Dict]:
+        """Load a payload by reference; None if it was never stored or was collected."""
+        try:
+            with gzip.open(self._path(ref), 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+    
+    def refs(self) -> Iterable[str]:
+        """References of every stored blob."""
+        if not os.path.isdir(self.blob_dir):
+            return
+        for prefix in os.listdir(self.blob_dir):
+            directory = os.path.join(self.blob_dir, prefix)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    if name.endswith(".json.gz"):
+                        yield name[:-len(".json.gz")]
+    
+    def gc(self, referenced: Iterable[str], min_age_seconds: float = BLOB_GC_MIN_AGE_SECONDS) -> int:
+        """
+        Remove blobs not in referenced and return how many were removed.
+        
+        Blobs younger than min_age_seconds are kept: the webhook stores the
+        payload just before the interaction that refers to it is committed.
+        """
+        referenced = set(referenced)
+        cutoff = time.time() - min_age_seconds
+        removed = 0
+        for ref in list(self.refs()):
+            if ref in referenced:
+                continue
+            path = self._path(ref)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+def collect_garbage(database, store: Optional["BlobStore"] = None) -> int:
+    """Remove the blobs that no interaction of database refers to."""
+    store = store or blob_store
+    removed = store.gc(database.payload_refs())
+    if removed:
+        logger.info(f"🧹 Removed {removed} unreferenced payload blobs")
+    return removed
+
+def externalize_payloads(database, store: Optional["BlobStore"] = None) -> int:
+    """
+    Move inline "webhook_data" payloads of existing interactions into the store.
+    
+    One-shot migration: each backend rewrites its interactions under its
+    own write lock. Returns the number of interactions rewritten.
+    """
+    store = store or blob_store
+    return database.externalize_payloads(store.put)
+
+# Global blob store instance
+blob_store = BlobStore()
+
+if __name__ == '__main__':
+    import argparse
+    from database import db
+    
+    parser = argparse.ArgumentParser(description="Raw webhook payload store")
+    parser.add_argument("command", choices=["show", "gc", "externalize"],
+                        help="show: print a payload; gc: remove unreferenced blobs; "
+                             "externalize: move inline webhook_data into the store")
+    parser.add_argument("ref", nargs="?", help="show: payload reference")
+    args = parser.parse_args()
+    
+    if args.command == "show":
+        if not args.ref:
+            parser.error("show needs a payload reference")
+        print(json.dumps(blob_store.get(args.ref), indent=2, ensure_ascii=False))
+    elif args.command == "gc":
+        print(collect_garbage(db))
+    else:
+        print(externalize_payloads(db))
@@ -0,0 +1,121 @@
+"""
+Change feed published by the database backends.
+
+Every committed write is described by a typed event:
+    
+    {"seq": 42, "type": "interaction_added", "collection": "interactions",
+     "key": None, "record": {...}}
+
+seq is the durable sequence number of the commit (shared by all events of
+one transaction), so an out-of-process consumer can remember the last seq
+it handled and ask the database for db.events_since(seq).
+"""
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+from db_records import copy_json
+
+logger = logging.getLogger(__name__)
+
+# Append-only collections: one event type per appended record
+APPEND_EVENTS = {
+    "interactions": "interaction_added",
+    "system_alerts": "alert_created",
+    "tool_executions": "tool_executed",
+    "approved_responses": "response_approved"
+}
+
+# Keyed collections: puts are "<name>_upserted", deletes "<name>_deleted"
+RECORD_NAMES = {
+    "clients": "client",
+    "leads": "lead",
+    "diet_plans": "diet_plan",
+    "subscriptions": "subscription",
+    "message_buffers": "buffer",
+    "pdf_documents": "pdf_document",
+    "seen_messages": "seen_message"
+}
+
+class ChangeFeedGapError(LookupError):
+    """Raised when the events after a seq are no longer retained; re-read the full state instead."""
+
+def change_event(seq: int, collection: str, key: Optional[str], record: Optional[Dict]) -> Dict:
+    """Describe one write (append when key is None, delete when record is None) as an event."""
+    if key is None:
+        event_type = APPEND_EVENTS.get(collection, f"{collection}_added")
+    else:
+        name = RECORD_NAMES.get(collection, collection)
+        event_type = f"{name}_deleted" if record is None else f"{name}_upserted"
+    return {
+        "seq": seq,
+        "type": event_type,
+        "collection": collection,
+        "key": key,
+        "record": copy_json(record) if record is not None else None
+    }
+
+class ChangeFeed:
+    """In-process subscribers; events are queued while a write is in progress and dispatched after it."""
+    
+    def __init__(self):
+        self._subscribers: List[tuple] = []
+        self._queued: List[Dict] = []
+        self._queue_lock = threading.Lock()
+        # Held by the one thread delivering events, so they arrive in commit order
+        self._dispatching = threading.Lock()
+    
+    def subscribe(self, callback: Callable[[Dict], None], types: Optional[Iterable[str]] = None) -> Callable[[], None]:
+        """
+        Call callback(event) for every event (or only the given types).
+        
+        Callbacks run right after the commit, one at a time in commit order,
+        in the writing thread (or in a thread already delivering events), so
+        they must be quick; they may read from and write to the database.
+        Returns a function that unsubscribes.
+        """
+        subscriber = (callback, frozenset(types) if types is not None else None)
+        # Copy-on-write so dispatch can iterate without holding a lock
+        self._subscribers = self._subscribers + [subscriber]
+        
+        def unsubscribe():
+            self._subscribers = [s for s in self._subscribers if s is not subscriber]
+        
+        return unsubscribe
+    
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+    
+    def queue(self, events: Iterable[Dict]):
+        if self._subscribers:
+            with self._queue_lock:
+                self._queued.extend(events)
+    
+    def discard_queued(self):
+        with self._queue_lock:
+            self._queued = []
+    
+    def dispatch(self):
+        """Deliver the queued events; if another thread is delivering, it delivers ours too."""
+        while self._queued:
+            if not self._dispatching.acquire(blocking=False):
+                return
+            try:
+                self._deliver()
+            finally:
+                self._dispatching.release()
+    
+    def _deliver(self):
+        while True:
+            with self._queue_lock:
+                events, self._queued = self._queued, []
+            if not events:
+                return
+            for event in events:
+                for callback, types in self._subscribers:
+                    if types is not None and event["type"] not in types:
+                        continue
+                    try:
+                        callback(event)
+                    except Exception as e:
+                        logger.error(f"Change feed subscriber failed on {event['type']}: {e}")
@@ -0,0 +1,267 @@
+"""
+In-memory secondary indexes maintained by Database alongside the document.
+
+Indexes hold references to the same records stored in the document,
+are rebuilt whenever the document is (re)loaded and updated on every write.
+
+Paginated lookups return (page, next_cursor); cursors are opaque strings
+meaning "continue with what comes before this", None when exhausted.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from db_records import NO_TIME, Interaction, from_epoch_us, phone_ids, sort_time, to_epoch_us
+
+def _insort(timestamps: array, records: List, timestamp: int, record):
+    # Records almost always arrive in time order: append is the fast path
+    if not timestamps or timestamps[-1] <= timestamp:
+        timestamps.append(timestamp)
+        records.append(record)
+    else:
+        position = bisect_right(timestamps, timestamp)
+        timestamps.insert(position, timestamp)
+        records.insert(position, record)
+
+def _cursor_time(text: str) -> int:
+    return to_epoch_us(text) if text else NO_TIME
+
+class InteractionIndex:
+    """
+    Time-ordered index over Interaction records, per phone ID and global.
+    
+    Timestamps are kept as epoch microseconds in int64 arrays parallel to
+    the record lists, so lookups bisect machine integers.
+    """
+    
+    def __init__(self):
+        self.rebuild(())
+    
+    def rebuild(self, interactions: Iterable[Interaction]):
+        self._timestamps: Dict[int, array] = {}
+        self._records: Dict[int, List[Interaction]] = {}
+        self._all_timestamps = array("q")
+        self._all_records: List[Interaction] = []
+        for interaction in interactions:
+            self.add(interaction)
+    
+    def add(self, interaction: Interaction):
+        """Insert an interaction keeping the lists ordered by timestamp."""
+        phone_id = interaction.phone_id
+        timestamp = sort_time(interaction.timestamp)
+        if phone_id not in self._timestamps:
+            self._timestamps[phone_id] = array("q")
+            self._records[phone_id] = []
+        _insort(self._timestamps[phone_id], self._records[phone_id], timestamp, interaction)
+        _insort(self._all_timestamps, self._all_records, timestamp, interaction)
+    
+    def remove(self, interaction: Interaction):
+        """Drop an interaction again (a rolled-back append, so it is searched from the newest end)."""
+        lists = [(self._all_timestamps, self._all_records)]
+        if interaction.phone_id in self._records:
+            lists.append((self._timestamps[interaction.phone_id], self._records[interaction.phone_id]))
+        for timestamps, records in lists:
+            for position in range(len(records) - 1, -1, -1):
+                if records[position] is interaction:
+                    del timestamps[position]
+                    del records[position]
+                    break
+    
+    def latest(self, phone: str, limit: int) -> List[Interaction]:
+        """Most recent interactions for phone, newest first."""
+        if limit <= 0:
+            return []
+        return self._records.get(phone_ids.find(phone), [])[-limit:][::-1]
+    
+    def since(self, phone: str, since: int) -> List[Interaction]:
+        """Interactions for phone with timestamp >= since (epoch microseconds), oldest first."""
+        phone_id = phone_ids.find(phone)
+        timestamps = self._timestamps.get(phone_id)
+        if not timestamps:
+            return []
+        return self._records[phone_id][bisect_left(timestamps, since):]
+    
+    def page(self, phone: Optional[str], before: Optional[str], limit: int,
+             predicate: Optional[Callable[[Interaction], bool]] = None) -> Tuple[List[Interaction], Optional[str]]:
+        """
+        Newest-first page of interactions (for one phone, or all) older than `before`.
+        
+        The cursor is "<timestamp>|<n>": the ISO timestamp of the last
+        record returned and how many records with exactly that timestamp
+        were returned so far, so ties are neither repeated nor skipped.
+        """
+        if phone is None:
+            timestamps, records = self._all_timestamps, self._all_records
+        else:
+            phone_id = phone_ids.find(phone)
+            timestamps, records = self._timestamps.get(phone_id, array("q")), self._records.get(phone_id, [])
+        
+        position = len(timestamps)
+        if before:
+            text, _, returned = before.rpartition("|")
+            timestamp = _cursor_time(text)
+            position = max(bisect_left(timestamps, timestamp), bisect_right(timestamps, timestamp) - int(returned))
+        
+        page = []
+        while position > 0 and len(page) < limit:
+            position -= 1
+            if predicate is None or predicate(records[position]):
+                page.append(records[position])
+        
+        if len(page) < limit or position == 0:
+            return page, None
+        timestamp = timestamps[position]
+        text = from_epoch_us(timestamp) if timestamp != NO_TIME else ""
+        return page, f"{text}|{bisect_right(timestamps, timestamp) - position}"
+
+class DeadlineIndex:
+    """
+    Keys ordered by a deadline, for "what is due by now" lookups.
+    
+    Deadlines can be any ordered values (datetimes, epoch microseconds)
+    as long as one index does not mix them. They are kept sorted so due()
+    is a bisect plus a slice of the k due keys; an idle system costs one
+    bisect per poll.
+    """
+    
+    def __init__(self):
+        self._times: List[datetime] = []
+        self._keys: List[str] = []
+        self._deadlines: Dict[str, datetime] = {}
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def clear(self):
+        self._times = []
+        self._keys = []
+        self._deadlines = {}
+    
+    def set(self, key: str, deadline: datetime):
+        """Insert key or move it to a new deadline."""
+        if self._deadlines.get(key) == deadline:
+            return
+        self.discard(key)
+        position = bisect_right(self._times, deadline)
+        self._times.insert(position, deadline)
+        self._keys.insert(position, key)
+        self._deadlines[key] = deadline
+    
+    def discard(self, key: str):
+        deadline = self._deadlines.pop(key, None)
+        if deadline is None:
+            return
+        position = bisect_left(self._times, deadline)
+        while self._keys[position] != key:
+            position += 1
+        del self._times[position]
+        del self._keys[position]
+    
+    def due(self, until: datetime, inclusive: bool = True) -> List[str]:
+        """Keys whose deadline is <= until (< until when not inclusive), earliest first."""
+        end = bisect_right(self._times, until) if inclusive else bisect_left(self._times, until)
+        return self._keys[:end]
+
+class SortedKeyIndex:
+    """Keys of a keyed collection ordered by one field of their records (e.g. created_at)."""
+    
+    def __init__(self):
+        self._entries: List[Tuple[str, str]] = []
+        self._values: Dict[str, str] = {}
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def clear(self):
+        self._entries = []
+        self._values = {}
+    
+    def set(self, key: str, value: str):
+        if self._values.get(key) == value:
+            return
+        self.discard(key)
+        self._values[key] = value
+        entry = (value, key)
+        if not self._entries or self._entries[-1] < entry:
+            self._entries.append(entry)
+        else:
+            self._entries.insert(bisect_left(self._entries, entry), entry)
+    
+    def discard(self, key: str):
+        value = self._values.pop(key, None)
+        if value is not None:
+            del self._entries[bisect_left(self._entries, (value, key))]
+    
+    def page(self, before: Optional[str], limit: int,
+             predicate: Optional[Callable[[str], bool]] = None) -> Tuple[List[str], Optional[str]]:
+        """Newest-first page of keys before the "<value>|<key>" cursor."""
+        position = len(self._entries)
+        if before:
+            value, _, key = before.rpartition("|")
+            position = bisect_left(self._entries, (value, key))
+        
+        keys = []
+        while position > 0 and len(keys) < limit:
+            position -= 1
+            if predicate is None or predicate(self._entries[position][1]):
+                keys.append(self._entries[position][1])
+        
+        if len(keys) < limit or position == 0:
+            return keys, None
+        value, key = self._entries[position]
+        return keys, f"{value}|{key}"
+
+class StatsCounters:
+    """Running totals behind get_conversion_stats, adjusted on every keyed write."""
+    
+    def __init__(self, default_price: float = 0.0):
+        self.default_price = default_price
+        self.clear()
+    
+    def clear(self):
+        self.total_leads = 0
+        self.converted_leads = 0
+        self.active_clients = 0
+        self.active_subscriptions = 0
+        self.monthly_revenue = 0.0
+    
+    def rebuild(self, data: Dict):
+        self.clear()
+        for collection in ("leads", "clients", "subscriptions"):
+            for record in data.get(collection, {}).values():
+                self._count(collection, record, 1)
+    
+    def add(self, collection: str, records: Iterable[Dict]):
+        """Count a collection loaded after the others."""
+        for record in records:
+            self._count(collection, record, 1)
+    
+    def apply(self, collection: str, previous: Optional[Dict], record: Optional[Dict]):
+        """Swap a record's contribution: previous (None on insert) out, record (None on delete) in."""
+        self._count(collection, previous, -1)
+        self._count(collection, record, 1)
+    
+    def _count(self, collection: str, record: Optional[Dict], sign: int):
+        if record is None:
+            return
+        status = record.get("status")
+        if collection == "leads":
+            self.total_leads += sign
+            if status == "converted":
+                self.converted_leads += sign
+        elif collection == "clients":
+            if status == "active":
+                self.active_clients += sign
+        elif collection == "subscriptions" and status == "active":
+            self.active_subscriptions += sign
+            self.monthly_revenue += sign * float(record.get("price", self.default_price))
+    
+    def as_dict(self) -> Dict:
+        return {
+            "total_leads": self.total_leads,
+            "converted_leads": self.converted_leads,
+            "active_clients": self.active_clients,
+            "active_subscriptions": self.active_subscriptions,
+            # Sums of +/- prices accumulate float noise; cents are all that matter
+            "monthly_revenue": round(self.monthly_revenue, 2)
+        }
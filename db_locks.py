@@ -0,0 +1,103 @@
+"""
+Lock striping for the JSON database.
+
+Work on one conversation takes the stripe its phone hashes to, so
+conversations on different stripes do not wait for each other. Work that
+touches every conversation at once (catching up with another process,
+retention, replacing the document) takes all stripes, always in index
+order. Each lock counts how often callers had to wait for it and for how
+long, which metrics() reports.
+"""
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List, Optional
+from config import DATABASE_LOCK_STRIPES
+
+class TimedLock:
+    """Re-entrant lock that records the time callers spent waiting for it."""
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._owner: Optional[int] = None
+        self._depth = 0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def acquire(self):
+        if self._owner == threading.get_ident():
+            self._lock.acquire()
+            self._depth += 1
+            return
+        if not self._lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - started
+            # Counters are only written while holding the lock
+            self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        self.acquisitions += 1
+        self._owner = threading.get_ident()
+        self._depth = 1
+    
+    def release(self):
+        self._depth -= 1
+        if not self._depth:
+            self._owner = None
+        self._lock.release()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+    
+    def held(self) -> bool:
+        """Whether the calling thread holds the lock."""
+        return self._owner == threading.get_ident()
+    
+    def metrics(self) -> Dict:
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_ms_total": round(self.wait_total * 1000, 3),
+            "wait_ms_max": round(self.wait_max * 1000, 3)
+        }
+
+class LockStripes:
+    """A fixed set of TimedLocks; a key always maps to the same stripe."""
+    
+    def __init__(self, count: int = DATABASE_LOCK_STRIPES):
+        self._locks = [TimedLock() for _ in range(max(1, count))]
+    
+    def __len__(self) -> int:
+        return len(self._locks)
+    
+    def index(self, key: str) -> int:
+        """Stripe of a key (crc32, stable across processes unlike hash())."""
+        return zlib.crc32(str(key).encode('utf-8')) % len(self._locks)
+    
+    @contextmanager
+    def hold(self, key: Optional[str] = None):
+        """Hold the stripe of key, or every stripe when key is None."""
+        locks = self._locks if key is None else [self._locks[self.index(key)]]
+        with ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+    
+    def held(self, key: str) -> bool:
+        """Whether the calling thread holds key's stripe."""
+        return self._locks[self.index(key)].held()
+    
+    def holds_any(self) -> bool:
+        return any(lock.held() for lock in self._locks)
+    
+    def metrics(self) -> List[Dict]:
+        """Wait statistics per stripe, in stripe order."""
+        return [{"stripe": i, **lock.metrics()} for i, lock in enumerate(self._locks)]
@@ -0,0 +1,256 @@
+"""
+Compact in-memory records for the JSON backend's hottest collections.
+
+Interactions, message buffers and subscriptions are held as __slots__
+objects instead of dicts. Their timestamps are integer microseconds since
+the epoch, so scans compare ints instead of re-parsing ISO strings, and
+phone numbers are interned to small integer IDs shared by every record of
+a conversation. Records turn back into dicts (to_dict) only at the API
+boundary, in the journal and on disk; the dict view is exactly the record
+that was stored.
+"""
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+EPOCH = datetime(1970, 1, 1)
+
+# Sort key for records without a usable timestamp (they come first, like "" did)
+NO_TIME = -(1 << 63)
+
+class _Missing:
+    """Slot value of a field the record does not have."""
+    __slots__ = ()
+    
+    def __bool__(self) -> bool:
+        return False
+    
+    def __repr__(self) -> str:
+        return "MISSING"
+
+MISSING = _Missing()
+
+def to_epoch_us(value: str) -> int:
+    """Parse an ISO timestamp into microseconds since the epoch (naive local time, like the stored strings)."""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def from_epoch_us(stamp: int) -> str:
+    return (EPOCH + timedelta(microseconds=stamp)).isoformat()
+
+class PhoneIds:
+    """Interns phone numbers to small integer IDs for the life of the process."""
+    
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._phones: List[str] = []
+        self._lock = threading.Lock()
+    
+    def intern(self, phone: str) -> int:
+        phone_id = self._ids.get(phone)
+        if phone_id is None:
+            with self._lock:
+                phone_id = self._ids.get(phone)
+                if phone_id is None:
+                    phone_id = len(self._phones)
+                    self._phones.append(phone)
+                    self._ids[phone] = phone_id
+        return phone_id
+    
+    def find(self, phone: str) -> Optional[int]:
+        """ID of phone, None if no record ever used it (lookups must not grow the table)."""
+        return self._ids.get(phone)
+    
+    def phone(self, phone_id: int) -> str:
+        return self._phones[phone_id]
+    
+    def __len__(self) -> int:
+        return len(self._phones)
+
+# Global registry shared by every database in the process
+phone_ids = PhoneIds()
+
+class CompactRecord:
+    """
+    Base for slotted records built from (and convertible back to) a dict.
+    
+    Subclasses list their fields in __slots__ and the ISO timestamp fields
+    among them in TIMESTAMPS. A missing field holds MISSING; keys without
+    a slot, and timestamps that would not format back to the same string,
+    are kept in `extra` (None when empty).
+    """
+    __slots__ = ("phone_id", "extra")
+    TIMESTAMPS: Tuple[str, ...] = ()
+    
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.FIELDS = tuple(name for name in cls.__slots__ if name not in cls.TIMESTAMPS)
+        cls.KNOWN = frozenset(("phone", *cls.__slots__))
+    
+    def __init__(self, data: Dict):
+        extra = {key: value for key, value in data.items() if key not in self.KNOWN}
+        phone = data.get("phone", MISSING)
+        if isinstance(phone, str):
+            self.phone_id = phone_ids.intern(phone)
+        else:
+            self.phone_id = MISSING
+            if phone is not MISSING:
+                extra["phone"] = phone
+        for name in self.FIELDS:
+            setattr(self, name, data.get(name, MISSING))
+        for name in self.TIMESTAMPS:
+            value = data.get(name, MISSING)
+            stamp = value
+            if value is not MISSING and value is not None:
+                try:
+                    stamp = to_epoch_us(value)
+                except (TypeError, ValueError):
+                    stamp = None
+                if stamp is None or from_epoch_us(stamp) != value:
+                    extra[name] = value
+            setattr(self, name, stamp)
+        self.extra = extra or None
+    
+    @property
+    def phone(self) -> Optional[str]:
+        return self.get("phone")
+    
+    def get(self, key: str, default=None):
+        """Dict-style read of one field, in its dict form."""
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        if key == "phone":
+            return phone_ids.phone(self.phone_id) if self.phone_id is not MISSING else default
+        if key not in self.KNOWN:
+            return default
+        value = getattr(self, key)
+        if value is MISSING:
+            return default
+        if key in self.TIMESTAMPS and value is not None:
+            return from_epoch_us(value)
+        return value
+    
+    def __getitem__(self, key: str):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+    
+    def to_dict(self) -> Dict:
+        data = {}
+        if self.phone_id is not MISSING:
+            data["phone"] = phone_ids.phone(self.phone_id)
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not MISSING:
+                data[name] = value
+        for name in self.TIMESTAMPS:
+            value = getattr(self, name)
+            if value is not MISSING:
+                data[name] = from_epoch_us(value) if value is not None else None
+        if self.extra:
+            data.update(self.extra)
+        return data
+    
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class Interaction(CompactRecord):
+    __slots__ = ("agent", "message", "direction", "payload_ref", "message_id", "source", "timestamp")
+    TIMESTAMPS = ("timestamp",)
+
+class MessageBuffer(CompactRecord):
+    __slots__ = ("processing", "retry_count", "locked_by", "version", "pending",
+                 "last_message_at", "buffer_expires_at", "created_at", "updated_at", "locked_at", "last_retry_at")
+    TIMESTAMPS = ("last_message_at", "buffer_expires_at", "created_at", "updated_at", "locked_at", "last_retry_at")
+
+class Subscription(CompactRecord):
+    __slots__ = ("client_id", "price", "status", "payment_method", "version",
+                 "started_at", "next_billing_date", "created_at", "cancelled_at")
+    TIMESTAMPS = ("started_at", "next_billing_date", "created_at", "cancelled_at")
+
+# Collections stored as compact records by the JSON backend
+RECORD_TYPES = {
+    "interactions": Interaction,
+    "message_buffers": MessageBuffer,
+    "subscriptions": Subscription
+}
+
+def compact(collection: str, record):
+    """The in-memory form of a record about to be stored in collection."""
+    record_type = RECORD_TYPES.get(collection)
+    return record_type(record) if record_type is not None and isinstance(record, dict) else record
+
+def compact_records(collection: str, records):
+    """Convert a whole list or keyed collection to its in-memory form."""
+    if collection not in RECORD_TYPES:
+        return records
+    if isinstance(records, list):
+        return [compact(collection, record) for record in records]
+    return {key: compact(collection, record) for key, record in records.items()}
+
+def copy_json(value):
+    """Copy of a JSON-like value down to its scalars, so no dict or list is shared with the original."""
+    if isinstance(value, dict):
+        return {key: copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_json(item) for item in value]
+    return value
+
+def as_dict(record) -> Dict:
+    """A caller-owned dict copy of a stored record (nested dicts and lists included)."""
+    return copy_json(record.to_dict() if isinstance(record, CompactRecord) else record)
+
+def queue_pending_message(buffer: Dict, message: Optional[Dict]) -> Dict:
+    """
+    The "pending" field of a buffer record after queueing message (if any).
+    
+    A buffer holds the messages waiting for its turn, so a flush reads
+    them from the record instead of the interaction history. The queue
+    starts with the first queued message; buffers without one (written
+    before the queue existed, or by callers that pass no message) keep
+    no "pending" field and are read back from the interactions.
+    """
+    if buffer:
+        if "pending" not in buffer:
+            return {}
+        pending = list(buffer["pending"])
+    elif message is None:
+        return {}
+    else:
+        pending = []
+    if message is not None:
+        pending.append(message)
+    return {"pending": pending}
+
+def remaining_buffer(buffer: Dict, flushed: int) -> Optional[Dict]:
+    """
+    The buffer record left after a turn flushed its first `flushed` pending messages, None if nothing is left.
+    
+    It is unlocked and dated from the messages still pending: it starts at
+    the first of them, and its deadline stays the window set after the last
+    one (add_message moved it while the turn ran).
+    """
+    pending = buffer.get("pending")
+    if pending is None or len(pending) <= flushed:
+        return None
+    rest = pending[flushed:]
+    buffer.pop("last_retry_at", None)
+    buffer.update({
+        "pending": rest,
+        "processing": False,
+        "retry_count": 0,
+        "locked_at": None,
+        "locked_by": None,
+        "created_at": rest[0].get("timestamp", buffer.get("created_at")),
+        "last_message_at": rest[-1].get("timestamp", buffer.get("last_message_at")),
+        "updated_at": datetime.now().isoformat()
+    })
+    return buffer
+
+def sort_time(value) -> int:
+    """A record's timestamp slot as a sort key (NO_TIME when missing or unparsable)."""
+    return value if isinstance(value, int) else NO_TIME
@@ -0,0 +1,227 @@
+"""
+Retention for the database backends: a hot window of interactions per
+phone stays in the live store, older interactions move to compressed
+monthly archive segments, and append-only logs expire after a TTL.
+
+Archive segments are JSON Lines files named interactions-YYYY-MM.jsonl.gz
+(or .xz for lzma). Each archival run appends one more gzip member / xz
+stream, which the readers decode as a single file, so a segment is never
+rewritten. get_client_interactions reads them on demand once a phone's
+live history runs out.
+"""
+import gzip
+import json
+import logging
+import lzma
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from db_blobs import collect_garbage
+from config import (
+    RETENTION_HOT_INTERACTIONS,
+    RETENTION_HOT_DAYS,
+    RETENTION_ARCHIVE_COMPRESSION,
+    RETENTION_TTL_DAYS,
+    RETENTION_MAX_RECORDS,
+    RETENTION_INTERVAL_SECONDS,
+    WEBHOOK_DEDUP_TTL_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+# Time field of each append-only collection, used for archiving and TTLs
+TIMESTAMP_FIELDS = {
+    "interactions": "timestamp",
+    "system_alerts": "created_at",
+    "tool_executions": "timestamp",
+    "approved_responses": "approved_at"
+}
+
+# compression -> (segment extension, compress function, reader)
+COMPRESSORS = {
+    "gzip": (".jsonl.gz", gzip.compress, gzip.open),
+    "lzma": (".jsonl.xz", lzma.compress, lzma.open)
+}
+
+# Decoded segments kept in memory (they are re-read when the file changes)
+SEGMENT_CACHE_SIZE = 4
+
+class InteractionArchive:
+    """Monthly compressed segments of archived interactions."""
+    
+    def __init__(self, archive_dir: str, compression: str = RETENTION_ARCHIVE_COMPRESSION):
+        if compression not in COMPRESSORS:
+            raise ValueError(f"Unknown archive compression {compression!r}; use one of {sorted(COMPRESSORS)}")
+        self.archive_dir = archive_dir
+        self.compression = compression
+        self._cache: "OrderedDict[str, Tuple[tuple, Dict[str, List[Dict]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def write(self, interactions: Iterable[Dict]) -> int:
+        """Append interactions to the segments of their month; returns how many were written."""
+        by_month: Dict[str, List[Dict]] = {}
+        for interaction in interactions:
+            by_month.setdefault(interaction.get("timestamp", "")[:7] or "unknown", []).append(interaction)
+        if not by_month:
+            return 0
+        
+        extension, compress, _ = COMPRESSORS[self.compression]
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for month, records in by_month.items():
+            chunk = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            path = os.path.join(self.archive_dir, f"interactions-{month}{extension}")
+            with open(path, 'ab') as f:
+                f.write(compress(chunk.encode('utf-8')))
+                f.flush()
+                # The live copies are dropped right after this returns
+                os.fsync(f.fileno())
+        return sum(len(records) for records in by_month.values())
+    
+    def read(self, phone: str, limit: int, before: Optional[str] = None, through: Optional[str] = None) -> List[Dict]:
+        """
+        Archived interactions for phone, newest first.
+        
+        Only records older than `before` (the oldest live record) and not
+        newer than `through` (the phone's archive watermark) are returned,
+        so records archived twice after a crash never show up twice.
+        """
+        result = []
+        for _, path in self._segments(upper=(through or before or "")[:7] or None):
+            for record in reversed(self._phone_records(path).get(phone, [])):
+                timestamp = record.get("timestamp", "")
+                if (before is not None and timestamp >= before) or (through is not None and timestamp > through):
+                    continue
+                if result and result[-1] == record:
+                    continue
+                result.append(record)
+                if len(result) >= limit:
+                    return result
+        return result
+    
+    def iter_records(self) -> Iterable[Dict]:
+        """Every archived interaction, segment by segment."""
+        for path in self.segments():
+            for records in self._phone_records(path).values():
+                yield from records
+    
+    def segments(self) -> List[str]:
+        """Paths of every archive segment, oldest month first."""
+        return [path for _, path in reversed(self._segments())]
+    
+    def _segments(self, upper: Optional[str] = None) -> List[Tuple[str, str]]:
+        """(month, path) pairs newest month first, skipping months after upper."""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        segments = []
+        for name in os.listdir(self.archive_dir):
+            for extension, _, _ in COMPRESSORS.values():
+                if name.startswith("interactions-") and name.endswith(extension):
+                    month = name[len("interactions-"):-len(extension)]
+                    if upper is None or month <= upper:
+                        segments.append((month, os.path.join(self.archive_dir, name)))
+        return sorted(segments, reverse=True)
+    
+    def _phone_records(self, path: str) -> Dict[str, List[Dict]]:
+        """Decode a segment into per-phone lists ordered by timestamp (cached by mtime and size)."""
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == signature:
+                self._cache.move_to_end(path)
+                return cached[1]
+        
+        reader = next(reader for extension, _, reader in COMPRESSORS.values() if path.endswith(extension))
+        by_phone: Dict[str, List[Dict]] = {}
+        with reader(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                by_phone.setdefault(record.get("phone"), []).append(record)
+        for records in by_phone.values():
+            records.sort(key=lambda record: record.get("timestamp", ""))
+        
+        with self._lock:
+            self._cache[path] = (signature, by_phone)
+            while len(self._cache) > SEGMENT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return by_phone
+
+def split_hot_window(interactions: List[Dict], now: datetime, hot_per_phone: int = RETENTION_HOT_INTERACTIONS,
+                     hot_days: int = RETENTION_HOT_DAYS) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Split interactions into (hot, cold), both in their original order.
+    
+    An interaction stays hot while it is among the newest hot_per_phone of
+    its phone and, when hot_days > 0, younger than hot_days.
+    """
+    cutoff = (now - timedelta(days=hot_days)).isoformat() if hot_days > 0 else ""
+    newest_first = sorted(range(len(interactions)), key=lambda i: interactions[i].get("timestamp", ""), reverse=True)
+    kept_per_phone: Dict[str, int] = {}
+    cold_positions = set()
+    for position in newest_first:
+        interaction = interactions[position]
+        phone = interaction.get("phone")
+        if kept_per_phone.get(phone, 0) >= hot_per_phone or interaction.get("timestamp", "") < cutoff:
+            cold_positions.add(position)
+        else:
+            kept_per_phone[phone] = kept_per_phone.get(phone, 0) + 1
+    hot = [record for i, record in enumerate(interactions) if i not in cold_positions]
+    cold = [record for i, record in enumerate(interactions) if i in cold_positions]
+    return hot, cold
+
+def expire_records(collection: str, records: List[Dict], now: datetime) -> List[Dict]:
+    """Records of an append-only collection that survive its TTL and record cap."""
+    ttl_days = RETENTION_TTL_DAYS.get(collection, 0)
+    if ttl_days > 0:
+        cutoff = (now - timedelta(days=ttl_days)).isoformat()
+        field = TIMESTAMP_FIELDS[collection]
+        records = [record for record in records if record.get(field, "") >= cutoff]
+    max_records = RETENTION_MAX_RECORDS.get(collection)
+    if max_records is not None and len(records) > max_records:
+        records = records[-max_records:]
+    return records
+
+def expire_seen_messages(seen: Dict[str, Dict], now: datetime) -> Dict[str, Dict]:
+    """Webhook message IDs still inside the dedup TTL."""
+    cutoff = (now - timedelta(hours=WEBHOOK_DEDUP_TTL_HOURS)).isoformat()
+    return {key: record for key, record in seen.items() if record.get("seen_at", "") >= cutoff}
+
+class RetentionJob:
+    """
+    Background thread running database.apply_retention() every interval
+    seconds, then collecting unreferenced payload blobs when given a store.
+    """
+    
+    def __init__(self, database, interval: float = RETENTION_INTERVAL_SECONDS, blob_store=None):
+        self.database = database
+        self.interval = interval
+        self.blob_store = blob_store
+        self._stop = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        logger.info(f"Retention job started (every {self.interval}s)")
+    
+    def stop(self):
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+    
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                summary = self.database.apply_retention()
+                if summary["archived"] or any(summary["expired"].values()):
+                    logger.info(f"🗄️ Retention: {summary}")
+                if self.blob_store is not None:
+                    collect_garbage(self.database, self.blob_store)
+            except Exception as e:
+                logger.error(f"Retention run failed: {e}")
+            self._stop.wait(self.interval)
@@ -0,0 +1,56 @@
+"""
+Idempotent webhook ingestion keyed on the Z-API message ID.
+
+Z-API retries a webhook when it does not get a timely answer, so the same
+WhatsApp message can arrive several times. Recently seen IDs are kept in a
+bounded in-memory LRU so a retry is acknowledged in O(1); the database's
+seen_messages collection (checked inside BufferManager.add_message's
+transaction, expired after WEBHOOK_DEDUP_TTL_HOURS) catches retries that
+reach another worker process or arrive after a restart.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict
+from config import WEBHOOK_DEDUP_LRU_SIZE
+
+class MessageDeduplicator:
+    """Bounded LRU of seen message IDs plus duplicate counters."""
+    
+    def __init__(self, capacity: int = WEBHOOK_DEDUP_LRU_SIZE):
+        self.capacity = capacity
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+    
+    def is_duplicate(self, message_id: str) -> bool:
+        """True if message_id was seen recently by this process."""
+        with self._lock:
+            self.checked += 1
+            if message_id in self._seen:
+                self._seen.move_to_end(message_id)
+                self.duplicates += 1
+                return True
+            return False
+    
+    def remember(self, message_id: str, duplicate: bool = False):
+        """Remember message_id once stored; duplicate=True counts a retry caught by the database."""
+        with self._lock:
+            if duplicate:
+                self.duplicates += 1
+            self._seen[message_id] = None
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.capacity:
+                self._seen.popitem(last=False)
+    
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "duplicate_rate": round(self.duplicates / self.checked, 4) if self.checked else 0.0,
+                "lru_size": len(self._seen)
+            }
+
+# Global deduplicator instance
+message_dedup = MessageDeduplicator()
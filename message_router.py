@@ -23,6 +23,21 @@ class MessageRouter:
         """
         return self.orchestrator.route_to_agent(phone, message, context)
     
+    async def route_message_async(self, phone: str, message: str, run_sync, sender) -> dict:
+        """
+        Route message on the asyncio turn pipeline.
+        
+        Args:
+            phone: Phone number
+            message: Message text (batched from buffer)
+            run_sync: Coroutine function running a blocking call off the event loop
+            sender: whatsapp_api.AsyncWhatsAppAPI used by async-native agents
+        
+        Returns:
+            Dict with response and routing info
+        """
+        return await self.orchestrator.route_to_agent_async(phone, message, run_sync, sender)
+    
     def escalate_to_human(self, phone: str, reason: str = "Cliente solicitou"):
         """
         Escalate conversation to human support.
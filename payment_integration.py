@@ -39,32 +39,28 @@ class PaymentIntegration:
                 }
             
             client_id = f"client_{phone}"
-            data = db._load()
-            
-            # Check if subscription already exists
-            if client_id in data.get("subscriptions", {}):
-                existing = data["subscriptions"][client_id]
-                if existing.get("status") == "active":
+            with db.transaction(phone):
+                # Check if subscription already exists
+                existing = db.get_subscription(phone)
+                if existing and existing.get("status") == "active":
                     return {
                         "success": True,
                         "message": "Subscription already active",
                         "subscription": existing
                     }
-            
-            # Create subscription
-            subscription = {
-                "client_id": client_id,
-                "phone": phone,
-                "price": self.subscription_price,
-                "status": "active",
-                "payment_method": payment_method,
-                "started_at": datetime.now().isoformat(),
-                "next_billing_date": (datetime.now() + timedelta(days=30)).isoformat(),
-                "created_at": datetime.now().isoformat()
-            }
-            
-            data.setdefault("subscriptions", {})[client_id] = subscription
-            db._save(data)
+                
+                # Create subscription
+                subscription = {
+                    "client_id": client_id,
+                    "phone": phone,
+                    "price": self.subscription_price,
+                    "status": "active",
+                    "payment_method": payment_method,
+                    "started_at": datetime.now().isoformat(),
+                    "next_billing_date": (datetime.now() + timedelta(days=30)).isoformat(),
+                    "created_at": datetime.now().isoformat()
+                }
+                db.save_subscription(phone, subscription)
             
             logger.info(f"✅ Subscription created for {phone}")
             
@@ -83,22 +79,17 @@ class PaymentIntegration:
     def cancel_subscription(self, phone: str, reason: str = "") -> Dict:
         """Cancel a subscription."""
         try:
-            client_id = f"client_{phone}"
-            data = db._load()
-            
-            if client_id not in data.get("subscriptions", {}):
+            cancelled = db.update_subscription(phone, {
+                "status": "cancelled",
+                "cancelled_at": datetime.now().isoformat(),
+                "cancellation_reason": reason
+            })
+            if not cancelled:
                 return {
                     "success": False,
                     "error": "Subscription not found"
                 }
             
-            subscription = data["subscriptions"][client_id]
-            subscription["status"] = "cancelled"
-            subscription["cancelled_at"] = datetime.now().isoformat()
-            subscription["cancellation_reason"] = reason
-            
-            db._save(data)
-            
             logger.info(f"❌ Subscription cancelled for {phone}: {reason}")
             
             return {
@@ -161,9 +152,7 @@ class PaymentIntegration:
     def get_subscription_status(self, phone: str) -> Dict:
         """Get subscription status for a phone number."""
         try:
-            client_id = f"client_{phone}"
-            data = db._load()
-            subscription = data.get("subscriptions", {}).get(client_id)
+            subscription = db.get_subscription(phone)
             
             if subscription:
                 return {
@@ -188,23 +177,8 @@ class PaymentIntegration:
     def check_upcoming_renewals(self, days_ahead: int = 7) -> list:
         """Get subscriptions that need renewal in the next N days."""
         try:
-            data = db._load()
-            subscriptions = data.get("subscriptions", {})
-            
-            upcoming = []
             cutoff_date = datetime.now() + timedelta(days=days_ahead)
-            
-            for sub in subscriptions.values():
-                if sub.get("status") != "active":
-                    continue
-                
-                next_billing = sub.get("next_billing_date")
-                if next_billing:
-                    billing_date = datetime.fromisoformat(next_billing)
-                    if billing_date <= cutoff_date:
-                        upcoming.append(sub)
-            
-            return sorted(upcoming, key=lambda x: x.get("next_billing_date", ""))
+            return db.get_subscriptions_due(cutoff_date.isoformat())
             
         except Exception as e:
             logger.error(f"Error checking renewals: {e}")
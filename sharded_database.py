@@ -0,0 +1,444 @@
+"""
+Sharded JSON storage backend - conversations spread over hash buckets.
+
+Every phone maps to one of DATABASE_SHARD_COUNT buckets by a stable hash,
+and each bucket is an ordinary Database (snapshot + journal + version
+file) under data/shards/<bucket>/. A phone's lead, client, subscription,
+buffer, plans, PDFs, alerts and interactions all live in its bucket, so a
+write locks and journals one bucket only and a compaction rewrites one
+bucket's snapshot: concurrent conversations in different buckets no
+longer wait for each other.
+
+Listings merge the buckets' in-memory indexes. Lead and client cursors
+("<created_at>|<key>") mean the same thing in every bucket; interaction
+cursors across all phones are "<timestamp>|<n>" over the merged order.
+"""
+import hashlib
+import heapq
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from database import COLLECTIONS, Database, _entry_events, _key_phone
+from config import DATABASE_SHARD_DIR, DATABASE_SHARD_COUNT
+
+logger = logging.getLogger(__name__)
+
+def shard_index(phone: str, shard_count: int) -> int:
+    """Bucket of a phone (stable across processes and restarts, unlike hash())."""
+    return int(hashlib.sha1(str(phone).encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+class ShardedDatabase:
+    """
+    Database implementation that stores each phone in one of several Database shards.
+    
+    This is deliberately a partial realization of a per-phone layout: the
+    bucket, not the phone, is the unit of files and locking. Phones that
+    share a bucket share its snapshot, journal and global lock (their
+    stripes still keep them apart in memory), and there are no separate
+    listing index files; listings merge the buckets' in-memory indexes.
+    """
+    
+    def __init__(self, shard_dir: str = DATABASE_SHARD_DIR, shard_count: int = DATABASE_SHARD_COUNT,
+                 commit_interval: Optional[float] = None, journal_compact_bytes: Optional[int] = None):
+        self.shard_dir = shard_dir
+        self.shard_count = self._check_layout(shard_dir, shard_count)
+        self.shards = [
+            Database(os.path.join(shard_dir, f"{i:02x}", "database.json"), commit_interval=commit_interval,
+                     journal_compact_bytes=journal_compact_bytes)
+            for i in range(self.shard_count)
+        ]
+        self._local = threading.local()
+    
+    @staticmethod
+    def _check_layout(shard_dir: str, shard_count: int) -> int:
+        """Record the shard count on first use; phones would land in other buckets if it changed."""
+        layout_file = os.path.join(shard_dir, "layout.json")
+        os.makedirs(shard_dir, exist_ok=True)
+        if os.path.exists(layout_file):
+            with open(layout_file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)["shard_count"]
+            if stored != shard_count:
+                raise ValueError(f"{shard_dir} holds {stored} shards but DATABASE_SHARD_COUNT is {shard_count}")
+            return stored
+        with open(layout_file, 'w', encoding='utf-8') as f:
+            json.dump({"shard_count": shard_count}, f)
+        return shard_count
+    
+    def _shard(self, phone: str) -> Database:
+        """Shard holding phone, joined to the transaction open in this thread (if any)."""
+        shard = self.shards[shard_index(phone, self.shard_count)]
+        transaction = getattr(self._local, "transaction", None)
+        if transaction is not None and shard not in transaction[1]:
+            transaction[0].enter_context(shard.transaction(transaction[2]))
+            transaction[1].add(shard)
+        return shard
+    
+    def _shard_for_key(self, collection: str, key: str) -> Database:
+        return self._shard(_key_phone(collection, key))
+    
+    @contextmanager
+    def transaction(self, phone: Optional[str] = None):
+        """
+        Group mutations; each shard touched joins with its own transaction.
+        
+        Atomicity holds per shard, so a transaction should stay within one
+        phone (as every caller's does). Shards are committed, or rolled back
+        if the block raises, when the outermost block exits. With a phone,
+        the shard only holds that phone's lock stripe (see Database.transaction).
+        """
+        if getattr(self._local, "transaction", None) is not None:
+            yield self
+            return
+        with ExitStack() as stack:
+            self._local.transaction = (stack, set(), phone)
+            try:
+                yield self
+            finally:
+                self._local.transaction = None
+    
+    def commit_future(self) -> Future:
+        """Future resolved once every shard's committed transactions are durable."""
+        combined = Future()
+        pending = [shard.commit_future() for shard in self.shards]
+        remaining = [len(pending)]
+        lock = threading.Lock()
+        
+        def on_done(future: Future):
+            with lock:
+                if combined.done():
+                    return
+                if future.exception() is not None:
+                    combined.set_exception(future.exception())
+                    return
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    combined.set_result(None)
+        
+        for future in pending:
+            future.add_done_callback(on_done)
+        return combined
+    
+    def version(self) -> tuple:
+        return tuple(shard.version() for shard in self.shards)
+    
+    def lock_metrics(self) -> Dict:
+        """Lock wait statistics of every shard, in shard order."""
+        return {"shards": [shard.lock_metrics() for shard in self.shards]}
+    
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+    
+    def compact(self):
+        for shard in self.shards:
+            shard.compact()
+    
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+    
+    def backup(self, dest_dir: Optional[str] = None) -> str:
+        """Back up every shard into dest_dir/<bucket>/ (each shard is consistent on its own)."""
+        dest_dir = dest_dir or os.path.join(self.shard_dir, "backups", datetime.now().strftime("%Y%m%d-%H%M%S"))
+        for i, shard in enumerate(self.shards):
+            shard.backup(os.path.join(dest_dir, f"{i:02x}"))
+        return dest_dir
+    
+    def apply_retention(self, now: Optional[datetime] = None) -> Dict:
+        summary = {"archived": 0, "expired": {}}
+        for shard in self.shards:
+            result = shard.apply_retention(now)
+            summary["archived"] += result["archived"]
+            for collection, count in result["expired"].items():
+                summary["expired"][collection] = summary["expired"].get(collection, 0) + count
+        return summary
+    
+    def externalize_payloads(self, put: Callable[[object], str]) -> int:
+        return sum(shard.externalize_payloads(put) for shard in self.shards)
+    
+    def subscribe(self, callback: Callable[[Dict], None], types: Optional[Iterable[str]] = None) -> Callable[[], None]:
+        """Subscribe to every shard's change feed (seq numbers are per shard)."""
+        unsubscribers = [shard.subscribe(callback, types) for shard in self.shards]
+        
+        def unsubscribe():
+            for unsubscribe_shard in unsubscribers:
+                unsubscribe_shard()
+        
+        return unsubscribe
+    
+    def events_since(self, seq: Union[int, str], limit: Optional[int] = None) -> List[Dict]:
+        """
+        Events committed after a composite cursor, every shard's feed merged by commit time.
+        
+        Shards number their commits independently, so an event's "seq" here
+        is a cursor holding each shard's seq as of that event
+        ("<shard 0 seq>.<shard 1 seq>..."). Use it like Database.events_since:
+        pass the seq of the last event handled (0 initially). A shard's
+        events keep their order; across shards they follow the commit
+        timestamps (ties in shard order), and the cursor never skips or
+        repeats an event. Raises ChangeFeedGapError when a shard already
+        compacted requested events away; re-read the state and continue
+        from events_cursor().
+        """
+        seqs = self._cursor_seqs(seq)
+        feeds = [shard._entries_since(shard_seq, limit) for shard, shard_seq in zip(self.shards, seqs)]
+        tagged = [[(i, entry) for entry in feed] for i, feed in enumerate(feeds)]
+        events = []
+        # Within each shard entries are in seq order; stop on a commit boundary, as a shard would
+        for i, entry in heapq.merge(*tagged, key=lambda item: item[1].get("ts", "")):
+            if limit is not None and len(events) >= limit:
+                break
+            seqs[i] = entry["seq"]
+            cursor = ".".join(str(shard_seq) for shard_seq in seqs)
+            for event in _entry_events(entry):
+                event["seq"] = cursor
+                events.append(event)
+        return events
+    
+    def events_cursor(self) -> str:
+        """Composite cursor of everything committed so far (see events_since)."""
+        return ".".join(str(shard.version()[1]) for shard in self.shards)
+    
+    def _cursor_seqs(self, seq: Union[int, str]) -> List[int]:
+        if not seq:
+            return [0] * self.shard_count
+        seqs = [int(part) for part in str(seq).split(".")]
+        if len(seqs) != self.shard_count:
+            raise ValueError(f"Cursor {seq!r} has {len(seqs)} shard seqs, expected {self.shard_count}")
+        return seqs
+    
+    def compare_and_set(self, collection: str, key: str, expected_version: int, updates: Dict) -> bool:
+        return self._shard_for_key(collection, key).compare_and_set(collection, key, expected_version, updates)
+    
+    # Whole-document access (read-only)
+    def _load(self) -> Dict:
+        """Merged copy of every shard's document (see Database._load)."""
+        data = {name: factory() for name, factory in COLLECTIONS.items()}
+        for shard in self.shards:
+            document = shard._load()
+            for name, factory in COLLECTIONS.items():
+                if factory is dict:
+                    data[name].update(document[name])
+                else:
+                    data[name].extend(document[name])
+        for name, factory in COLLECTIONS.items():
+            if factory is list:
+                data[name].sort(key=lambda record: record.get("timestamp") or record.get("created_at")
+                                or record.get("approved_at") or "")
+        return data
+    
+    # Per-phone methods: served by the phone's shard
+    def add_lead(self, phone: str, name: str, source: str = "whatsapp"):
+        return self._shard(phone).add_lead(phone, name, source)
+    
+    def get_lead(self, phone: str) -> Optional[Dict]:
+        return self._shard(phone).get_lead(phone)
+    
+    def update_lead(self, phone: str, updates: Dict):
+        return self._shard(phone).update_lead(phone, updates)
+    
+    def convert_lead_to_client(self, phone: str):
+        return self._shard(phone).convert_lead_to_client(phone)
+    
+    def get_client(self, phone: str) -> Optional[Dict]:
+        return self._shard(phone).get_client(phone)
+    
+    def update_client(self, phone: str, updates: Dict):
+        return self._shard(phone).update_client(phone, updates)
+    
+    def get_subscription(self, phone: str) -> Optional[Dict]:
+        return self._shard(phone).get_subscription(phone)
+    
+    def save_subscription(self, phone: str, subscription: Dict):
+        return self._shard(phone).save_subscription(phone, subscription)
+    
+    def update_subscription(self, phone: str, updates: Dict) -> bool:
+        return self._shard(phone).update_subscription(phone, updates)
+    
+    def save_anamnesis(self, phone: str, anamnesis_data: Dict):
+        return self._shard(phone).save_anamnesis(phone, anamnesis_data)
+    
+    def save_diet_plan(self, phone: str, diet_plan: Dict):
+        return self._shard(phone).save_diet_plan(phone, diet_plan)
+    
+    def add_interaction(self, phone: str, agent: str, message: str, direction: str = "incoming", metadata: Optional[Dict] = None):
+        return self._shard(phone).add_interaction(phone, agent, message, direction, metadata)
+    
+    def get_client_interactions(self, phone: str, limit: int = 50) -> List[Dict]:
+        return self._shard(phone).get_client_interactions(phone, limit)
+    
+    def get_messages_since(self, phone: str, since_iso: str) -> List[Dict]:
+        return self._shard(phone).get_messages_since(phone, since_iso)
+    
+    def upsert_message_buffer(self, phone: str, last_message_at: str, buffer_expires_at: str,
+                              processing: bool = False, retry_count: int = 0, pending_message: Optional[Dict] = None):
+        return self._shard(phone).upsert_message_buffer(phone, last_message_at, buffer_expires_at, processing,
+                                                        retry_count, pending_message)
+    
+    def get_message_buffer(self, phone: str) -> Optional[Dict]:
+        return self._shard(phone).get_message_buffer(phone)
+    
+    def delete_message_buffer(self, phone: str):
+        return self._shard(phone).delete_message_buffer(phone)
+    
+    def flush_message_buffer(self, phone: str, flushed: int, locked_by: Optional[str] = None) -> bool:
+        return self._shard(phone).flush_message_buffer(phone, flushed, locked_by)
+    
+    def acquire_buffer_lock(self, phone: str, process_id: str, expected_version: Optional[int] = None) -> bool:
+        return self._shard(phone).acquire_buffer_lock(phone, process_id, expected_version)
+    
+    def release_buffer_lock(self, phone: str, locked_by: Optional[str] = None):
+        return self._shard(phone).release_buffer_lock(phone, locked_by)
+    
+    def increment_buffer_retry(self, phone: str):
+        return self._shard(phone).increment_buffer_retry(phone)
+    
+    def mark_message_seen(self, message_id: str, phone: Optional[str] = None) -> bool:
+        # With the phone known the check joins the conversation's shard (and its transaction)
+        return self._shard(phone or message_id).mark_message_seen(message_id, phone)
+    
+    def create_alert(self, type: str, phone: str, details: str):
+        return self._shard(phone).create_alert(type, phone, details)
+    
+    def log_tool_execution(self, phone: str, tool_name: str, input_data: Dict, output_data: Dict):
+        return self._shard(phone).log_tool_execution(phone, tool_name, input_data, output_data)
+    
+    def save_pdf_document(self, phone: str, plan_id: str, file_path: str):
+        return self._shard(phone).save_pdf_document(phone, plan_id, file_path)
+    
+    def mark_pdf_sent(self, phone: str, plan_id: str):
+        return self._shard(phone).mark_pdf_sent(phone, plan_id)
+    
+    def save_approved_response(self, phone: str, context: str, response: str, agent: str):
+        return self._shard(phone).save_approved_response(phone, context, response, agent)
+    
+    # Listings: merged across shards
+    def get_all_clients(self) -> List[Dict]:
+        return [client for shard in self.shards for client in shard.get_all_clients()]
+    
+    def get_all_leads(self) -> List[Dict]:
+        return [lead for shard in self.shards for lead in shard.get_all_leads()]
+    
+    def get_active_subscriptions(self) -> List[Dict]:
+        return [subscription for shard in self.shards for subscription in shard.get_active_subscriptions()]
+    
+    def get_subscriptions_due(self, until_iso: str) -> List[Dict]:
+        due = [subscription for shard in self.shards for subscription in shard.get_subscriptions_due(until_iso)]
+        return sorted(due, key=lambda subscription: subscription["next_billing_date"])
+    
+    def payload_refs(self) -> set:
+        return set().union(*(shard.payload_refs() for shard in self.shards))
+    
+    def get_recent_interactions(self, limit: int = 100) -> List[Dict]:
+        return self.query_interactions(limit=limit)[0]
+    
+    def query_interactions(self, phone: Optional[str] = None, direction: Optional[str] = None,
+                           agent: Optional[str] = None, before: Optional[str] = None,
+                           limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Newest-first page of interactions and the cursor for the next page.
+        
+        One phone is served by its shard. Across all phones, every shard is
+        asked for the records at or before the cursor timestamp; the merged
+        order (timestamp, then shard) is deterministic, so the cursor's
+        count of records already returned at that timestamp skips exactly
+        those.
+        """
+        if phone is not None:
+            return self._shard(phone).query_interactions(phone, direction, agent, before, limit)
+        
+        timestamp, returned = None, 0
+        if before:
+            timestamp, _, count = before.rpartition("|")
+            returned = int(count)
+        
+        merged = []
+        more = False
+        for shard in self.shards:
+            page, cursor = shard.query_interactions(None, direction, agent, f"{timestamp}|0" if timestamp else None,
+                                                    limit + returned)
+            merged.extend(page)
+            more = more or cursor is not None
+        # Stable sort: ties keep shard order, then each shard's own order
+        merged.sort(key=lambda interaction: interaction.get("timestamp", ""), reverse=True)
+        page = merged[returned:returned + limit]
+        
+        if not page or not (more or len(merged) > returned + limit):
+            return page, None
+        last = page[-1].get("timestamp", "")
+        ties = sum(1 for interaction in merged[:returned + len(page)] if interaction.get("timestamp", "") == last)
+        return page, f"{last}|{ties}"
+    
+    def query_leads(self, status: Optional[str] = None, before: Optional[str] = None,
+                    limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """Newest-first page of leads by created_at (see Database.query_leads)."""
+        return self._query_created("lead", [shard.query_leads(status, before, limit) for shard in self.shards], limit)
+    
+    def query_clients(self, status: Optional[str] = None, before: Optional[str] = None,
+                      limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """Newest-first page of clients by created_at (see Database.query_clients)."""
+        return self._query_created("client", [shard.query_clients(status, before, limit) for shard in self.shards], limit)
+    
+    def _query_created(self, prefix: str, pages: List[Tuple[List[Dict], Optional[str]]],
+                       limit: int) -> Tuple[List[Dict], Optional[str]]:
+        entries = sorted(
+            ((record.get("created_at", ""), f"{prefix}_{record.get('phone')}", record) for page, _ in pages for record in page),
+            key=lambda entry: entry[:2], reverse=True
+        )
+        more = any(cursor is not None for _, cursor in pages) or len(entries) > limit
+        entries = entries[:limit]
+        cursor = f"{entries[-1][0]}|{entries[-1][1]}" if entries and more else None
+        return [record for _, _, record in entries], cursor
+    
+    def get_conversion_stats(self) -> Dict:
+        """Dashboard totals summed over the shards' maintained counters."""
+        totals = {"total_leads": 0, "converted_leads": 0, "active_clients": 0, "active_subscriptions": 0, "monthly_revenue": 0.0}
+        for shard in self.shards:
+            stats = shard.get_conversion_stats()
+            for name in totals:
+                totals[name] += stats[name]
+        totals["monthly_revenue"] = round(totals["monthly_revenue"], 2)
+        total_leads = totals["total_leads"]
+        totals["conversion_rate"] = (totals["converted_leads"] / total_leads * 100) if total_leads > 0 else 0
+        return totals
+    
+    def rebuild_stats(self) -> Dict:
+        """Rebuild every shard's counters; returns drift per shard as {"<bucket>/<name>": (maintained, recomputed)}."""
+        return {
+            f"{i:02x}/{name}": values
+            for i, shard in enumerate(self.shards) for name, values in shard.rebuild_stats().items()
+        }
+    
+    def get_expired_buffers(self, now_iso: str) -> List[Dict]:
+        buffers = [buffer for shard in self.shards for buffer in shard.get_expired_buffers(now_iso)]
+        return sorted(buffers, key=lambda buffer: buffer.get("buffer_expires_at", ""))
+    
+    def get_stuck_locks(self, threshold_iso: str) -> List[Dict]:
+        buffers = [buffer for shard in self.shards for buffer in shard.get_stuck_locks(threshold_iso)]
+        return sorted(buffers, key=lambda buffer: buffer.get("locked_at") or "")
+    
+    def get_unprocessed_buffers(self, threshold_iso: str) -> List[Dict]:
+        buffers = [buffer for shard in self.shards for buffer in shard.get_unprocessed_buffers(threshold_iso)]
+        return sorted(buffers, key=lambda buffer: buffer.get("buffer_expires_at", ""))
+    
+    def get_high_retry_buffers(self, min_retries: int) -> List[Dict]:
+        return [buffer for shard in self.shards for buffer in shard.get_high_retry_buffers(min_retries)]
+    
+    def get_alerts(self, unresolved_only: bool = True, limit: int = 100) -> List[Dict]:
+        alerts = [alert for shard in self.shards for alert in shard.get_alerts(unresolved_only, limit)]
+        return sorted(alerts, key=lambda alert: alert.get("created_at", ""), reverse=True)[:limit]
+    
+    def get_pdf_documents(self, phone: Optional[str] = None) -> List[Dict]:
+        if phone:
+            return self._shard(phone).get_pdf_documents(phone)
+        docs = [doc for shard in self.shards for doc in shard.get_pdf_documents()]
+        return sorted(docs, key=lambda doc: doc.get("created_at", ""), reverse=True)
+    
+    def get_approved_responses(self, agent: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        responses = [response for shard in self.shards for response in shard.get_approved_responses(agent, limit)]
+        return sorted(responses, key=lambda response: response.get("approved_at", ""), reverse=True)[:limit]
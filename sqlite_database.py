@@ -0,0 +1,855 @@
+"""
+SQLite storage backend - drop-in replacement for the JSON Database.
+
+Every collection of data/database.json becomes a table with the full record
+stored as JSON plus indexed columns for the fields we filter and sort on
+(phone, timestamps, buffer expiry). The database runs in WAL mode so the
+dashboard can read while the webhook writes, and each write only touches
+the affected rows instead of re-serializing the whole history.
+"""
+import json
+import os
+import sqlite3
+import threading
+import logging
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from config import (
+    SUBSCRIPTION_PRICE,
+    RETENTION_HOT_INTERACTIONS,
+    RETENTION_HOT_DAYS,
+    RETENTION_TTL_DAYS,
+    RETENTION_MAX_RECORDS,
+    WEBHOOK_DEDUP_TTL_HOURS
+)
+from db_events import ChangeFeed, ChangeFeedGapError, change_event
+from db_records import queue_pending_message, remaining_buffer
+from db_retention import TIMESTAMP_FIELDS, InteractionArchive
+
+logger = logging.getLogger(__name__)
+
+# Keyed collections: table -> indexed columns (the JSON key is the primary key)
+KEYED_TABLES = {
+    "clients": ["phone", "status", "created_at"],
+    "leads": ["phone", "status", "created_at"],
+    "diet_plans": ["phone", "created_at"],
+    "subscriptions": ["client_id", "status"],
+    "message_buffers": ["phone", "buffer_expires_at", "processing", "locked_at", "retry_count"],
+    "pdf_documents": ["phone", "created_at"],
+    "seen_messages": ["phone", "seen_at"],
+}
+
+# Append-only collections: table -> indexed columns (rowid keeps insertion order)
+LOG_TABLES = {
+    "interactions": ["phone", "direction", "agent", "timestamp"],
+    "system_alerts": ["phone", "type", "resolved", "created_at"],
+    "tool_executions": ["phone", "tool_name", "timestamp"],
+    "approved_responses": ["phone", "agent", "approved_at"],
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_clients_phone ON clients (phone)",
+    "CREATE INDEX IF NOT EXISTS idx_leads_phone ON leads (phone)",
+    "CREATE INDEX IF NOT EXISTS idx_diet_plans_phone ON diet_plans (phone, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_subscriptions_status ON subscriptions (status)",
+    "CREATE INDEX IF NOT EXISTS idx_buffers_expiry ON message_buffers (processing, buffer_expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_buffers_locked ON message_buffers (processing, locked_at)",
+    "CREATE INDEX IF NOT EXISTS idx_pdf_documents_phone ON pdf_documents (phone, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_seen_messages_seen_at ON seen_messages (seen_at)",
+    "CREATE INDEX IF NOT EXISTS idx_interactions_phone_ts ON interactions (phone, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_interactions_ts ON interactions (timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_alerts_resolved_ts ON system_alerts (resolved, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_tool_executions_ts ON tool_executions (timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_approved_agent_ts ON approved_responses (agent, approved_at)",
+]
+
+# Stats counters kept by triggers: table -> {counter: contribution of row ({row} = NEW/OLD)}
+STATS_CONTRIBUTIONS = {
+    "leads": {
+        "total_leads": "1",
+        "converted_leads": "({row}.status = 'converted')",
+    },
+    "clients": {
+        "active_clients": "({row}.status = 'active')",
+    },
+    "subscriptions": {
+        "active_subscriptions": "({row}.status = 'active')",
+        "monthly_revenue": f"(CASE WHEN {{row}}.status = 'active' THEN COALESCE(json_extract({{row}}.data, '$.price'), {SUBSCRIPTION_PRICE}) ELSE 0 END)",
+    },
+}
+
+# Change feed rows kept for events_since(); trimmed every EVENTS_TRIM_EVERY inserts
+MAX_EVENTS = 10000
+EVENTS_TRIM_EVERY = 1000
+
+class SQLiteDatabase:
+    """Database implementation backed by SQLite (WAL mode)."""
+    
+    def __init__(self, db_file: str = "data/database.sqlite3"):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self._feed = ChangeFeed()
+        self.archive = InteractionArchive(os.path.join(os.path.dirname(db_file) or ".", "archive"))
+        self._ensure_data_dir()
+        self._init_db()
+    
+    def _ensure_data_dir(self):
+        os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection (sqlite3 connections are per thread)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+    
+    def _init_db(self):
+        with self._write() as conn:
+            for table, columns in KEYED_TABLES.items():
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, {', '.join(columns)}, data TEXT NOT NULL)")
+            for table, columns in LOG_TABLES.items():
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, {', '.join(columns)}, data TEXT NOT NULL)")
+            for statement in INDEXES:
+                conn.execute(statement)
+            conn.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "type TEXT NOT NULL, collection TEXT NOT NULL, key TEXT, data TEXT)")
+            # Newest archived interaction timestamp per phone (see apply_retention)
+            conn.execute("CREATE TABLE IF NOT EXISTS archived_phones (phone TEXT PRIMARY KEY, archived_through TEXT NOT NULL)")
+            self._create_stats_triggers(conn)
+            if not conn.execute("SELECT 1 FROM stats LIMIT 1").fetchone():
+                self._recount_stats(conn)
+    
+    def _create_stats_triggers(self, conn: sqlite3.Connection):
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        for table, counters in STATS_CONTRIBUTIONS.items():
+            for event, rows in (("INSERT", [("NEW", "+")]), ("DELETE", [("OLD", "-")]),
+                                ("UPDATE", [("OLD", "-"), ("NEW", "+")])):
+                updates = " ".join(
+                    f"UPDATE stats SET value = value {sign} {expression.format(row=row)} WHERE name = '{name}';"
+                    for name, expression in counters.items() for row, sign in rows
+                )
+                conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS stats_{table}_{event.lower()} "
+                    f"AFTER {event} ON {table} BEGIN {updates} END"
+                )
+    
+    def _recount_stats(self, conn: sqlite3.Connection) -> Dict:
+        """Recompute every counter with full scans and store the result."""
+        recounted = {}
+        for table, counters in STATS_CONTRIBUTIONS.items():
+            for name, expression in counters.items():
+                total = conn.execute(f"SELECT COALESCE(SUM({expression.format(row=table)}), 0) FROM {table}").fetchone()[0]
+                recounted[name] = total
+                conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                             (name, total))
+        return recounted
+    
+    @contextmanager
+    def _write(self):
+        """Run a read-modify-write block inside one IMMEDIATE transaction (nested blocks join it)."""
+        with self.lock:
+            conn = self._connect()
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._feed.discard_queued()
+                raise
+            else:
+                conn.execute("COMMIT")
+            self._feed.dispatch()
+    
+    @contextmanager
+    def transaction(self, phone: Optional[str] = None):
+        """Apply several mutations atomically with a single commit (phone is accepted for parity with Database)."""
+        with self._write():
+            yield self
+    
+    def commit_future(self) -> Future:
+        """SQLite commits synchronously, so every returned write is already durable."""
+        future = Future()
+        future.set_result(None)
+        return future
+    
+    def subscribe(self, callback: Callable[[Dict], None], types: Optional[Iterable[str]] = None) -> Callable[[], None]:
+        """Call callback(event) after every commit made through this instance (see db_events)."""
+        return self._feed.subscribe(callback, types)
+    
+    def events_since(self, seq: int, limit: Optional[int] = None) -> List[Dict]:
+        """Events after seq from the events table (seq is the event row id), oldest first."""
+        conn = self._connect()
+        oldest = conn.execute("SELECT MIN(id), MAX(id) FROM events").fetchone()
+        if oldest[0] is not None and seq + 1 < oldest[0] and seq < oldest[1]:
+            raise ChangeFeedGapError(f"Events {seq + 1}..{oldest[0] - 1} were trimmed")
+        sql = "SELECT id, collection, key, data FROM events WHERE id > ? ORDER BY id"
+        params = [seq]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [
+            change_event(row[0], row[1], row[2], json.loads(row[3]) if row[3] is not None else None)
+            for row in conn.execute(sql, params).fetchall()
+        ]
+    
+    def _emit(self, conn: sqlite3.Connection, collection: str, key: Optional[str], record: Optional[Dict]):
+        """Record a change in the events table and queue it for in-process subscribers."""
+        event = change_event(0, collection, key, record)
+        seq = conn.execute(
+            "INSERT INTO events (type, collection, key, data) VALUES (?, ?, ?, ?)",
+            (event["type"], collection, key, json.dumps(record, ensure_ascii=False) if record is not None else None)
+        ).lastrowid
+        if seq % EVENTS_TRIM_EVERY == 0:
+            self._trim(conn, "events", MAX_EVENTS)
+        event["seq"] = seq
+        self._feed.queue([event])
+    
+    def compare_and_set(self, table: str, key: str, expected_version: int, updates: Dict) -> bool:
+        """Apply updates to a record only if its version is still expected_version."""
+        with self._write() as conn:
+            record = self._get(conn, table, key)
+            if record is None or record.get("version", 0) != expected_version:
+                return False
+            record.update(updates)
+            self._put(conn, table, key, record)
+            return True
+    
+    # Row helpers
+    def _put(self, conn: sqlite3.Connection, table: str, key: str, record: Dict):
+        previous = self._get(conn, table, key)
+        # Every write bumps the record version used by compare_and_set()
+        record["version"] = (previous or {}).get("version", 0) + 1
+        self._write_row(conn, table, key, record)
+        self._emit(conn, table, key, record)
+    
+    def _write_row(self, conn: sqlite3.Connection, table: str, key: str, record: Dict):
+        columns = KEYED_TABLES[table]
+        placeholders = ", ".join("?" for _ in columns)
+        assignments = ", ".join(f"{c} = excluded.{c}" for c in columns + ["data"])
+        # Upsert instead of REPLACE so the rowid (insertion order) survives updates
+        conn.execute(
+            f"INSERT INTO {table} (key, {', '.join(columns)}, data) VALUES (?, {placeholders}, ?) "
+            f"ON CONFLICT(key) DO UPDATE SET {assignments}",
+            [key, *[record.get(c) for c in columns], json.dumps(record, ensure_ascii=False)]
+        )
+    
+    def _get(self, conn: sqlite3.Connection, table: str, key: str) -> Optional[Dict]:
+        row = conn.execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _append(self, conn: sqlite3.Connection, table: str, record: Dict):
+        self._insert_log_row(conn, table, record)
+        self._emit(conn, table, None, record)
+    
+    def _insert_log_row(self, conn: sqlite3.Connection, table: str, record: Dict):
+        columns = LOG_TABLES[table]
+        placeholders = ", ".join("?" for _ in columns)
+        conn.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}, data) VALUES ({placeholders}, ?)",
+            [*[record.get(c) for c in columns], json.dumps(record, ensure_ascii=False)]
+        )
+    
+    def _trim(self, conn: sqlite3.Connection, table: str, keep: int):
+        conn.execute(
+            f"DELETE FROM {table} WHERE id <= (SELECT id FROM {table} ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (keep,)
+        )
+    
+    def _select(self, sql: str, params: tuple = ()) -> List[Dict]:
+        rows = self._connect().execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    # Whole-document access: a read-only copy, and the bulk load used by migrate_json_to_sqlite()
+    def _load(self) -> Dict:
+        conn = self._connect()
+        data = {}
+        for table in KEYED_TABLES:
+            rows = conn.execute(f"SELECT key, data FROM {table} ORDER BY rowid").fetchall()
+            data[table] = {key: json.loads(raw) for key, raw in rows}
+        for table in LOG_TABLES:
+            rows = conn.execute(f"SELECT data FROM {table} ORDER BY id").fetchall()
+            data[table] = [json.loads(raw) for (raw,) in rows]
+        return data
+    
+    def _replace_all(self, conn: sqlite3.Connection, data: Dict):
+        for table in KEYED_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+            for key, record in data.get(table, {}).items():
+                self._write_row(conn, table, key, record)
+        for table in LOG_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+            for record in data.get(table, []):
+                self._insert_log_row(conn, table, record)
+    
+    def add_lead(self, phone: str, name: str, source: str = "whatsapp"):
+        lead_id = f"lead_{phone}"
+        with self._write() as conn:
+            self._put(conn, "leads", lead_id, {
+                "phone": phone,
+                "name": name,
+                "source": source,
+                "status": "new",
+                "created_at": datetime.now().isoformat(),
+                "agent": "sales"
+            })
+        return lead_id
+    
+    def get_lead(self, phone: str) -> Optional[Dict]:
+        return self._get(self._connect(), "leads", f"lead_{phone}")
+    
+    def update_lead(self, phone: str, updates: Dict):
+        lead_id = f"lead_{phone}"
+        with self._write() as conn:
+            lead = self._get(conn, "leads", lead_id)
+            if lead is not None:
+                lead.update(updates)
+                lead["updated_at"] = datetime.now().isoformat()
+                self._put(conn, "leads", lead_id, lead)
+    
+    def convert_lead_to_client(self, phone: str):
+        lead_id = f"lead_{phone}"
+        with self._write() as conn:
+            lead = self._get(conn, "leads", lead_id)
+            if lead is None:
+                return None
+            client_id = f"client_{phone}"
+            self._put(conn, "clients", client_id, {
+                "phone": phone,
+                "name": lead.get("name", ""),
+                "status": "active",
+                "created_at": datetime.now().isoformat(),
+                "anamnesis_completed": False,
+                "diet_plan_generated": False
+            })
+            self._put(conn, "subscriptions", client_id, {
+                "client_id": client_id,
+                "price": SUBSCRIPTION_PRICE,
+                "status": "active",
+                "started_at": datetime.now().isoformat()
+            })
+            lead["status"] = "converted"
+            self._put(conn, "leads", lead_id, lead)
+            return client_id
+    
+    def get_client(self, phone: str) -> Optional[Dict]:
+        return self._get(self._connect(), "clients", f"client_{phone}")
+    
+    def update_client(self, phone: str, updates: Dict):
+        client_id = f"client_{phone}"
+        with self._write() as conn:
+            client = self._get(conn, "clients", client_id)
+            if client is not None:
+                client.update(updates)
+                client["updated_at"] = datetime.now().isoformat()
+                self._put(conn, "clients", client_id, client)
+    
+    def get_subscription(self, phone: str) -> Optional[Dict]:
+        return self._get(self._connect(), "subscriptions", f"client_{phone}")
+    
+    def save_subscription(self, phone: str, subscription: Dict):
+        """Create or replace the phone's subscription."""
+        with self._write() as conn:
+            self._put(conn, "subscriptions", f"client_{phone}", dict(subscription))
+    
+    def update_subscription(self, phone: str, updates: Dict) -> bool:
+        """Apply updates to the phone's subscription; False if it has none."""
+        client_id = f"client_{phone}"
+        with self._write() as conn:
+            subscription = self._get(conn, "subscriptions", client_id)
+            if subscription is None:
+                return False
+            subscription.update(updates)
+            self._put(conn, "subscriptions", client_id, subscription)
+            return True
+    
+    def save_anamnesis(self, phone: str, anamnesis_data: Dict):
+        client_id = f"client_{phone}"
+        with self._write() as conn:
+            client = self._get(conn, "clients", client_id)
+            if client is not None:
+                client["anamnesis"] = anamnesis_data
+                client["anamnesis_completed"] = True
+                client["anamnesis_date"] = datetime.now().isoformat()
+                self._put(conn, "clients", client_id, client)
+    
+    def save_diet_plan(self, phone: str, diet_plan: Dict):
+        client_id = f"client_{phone}"
+        plan_id = f"plan_{phone}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        with self._write() as conn:
+            self._put(conn, "diet_plans", plan_id, {
+                "client_id": client_id,
+                "phone": phone,
+                "plan": diet_plan,
+                "created_at": datetime.now().isoformat()
+            })
+            client = self._get(conn, "clients", client_id)
+            if client is not None:
+                client["diet_plan_generated"] = True
+                client["latest_plan_id"] = plan_id
+                self._put(conn, "clients", client_id, client)
+        return plan_id
+    
+    def add_interaction(self, phone: str, agent: str, message: str, direction: str = "incoming", metadata: Optional[Dict] = None):
+        interaction = {
+            "phone": phone,
+            "agent": agent,
+            "message": message,
+            "direction": direction,
+            "timestamp": datetime.now().isoformat()
+        }
+        if metadata:
+            interaction.update(metadata)
+        with self._write() as conn:
+            self._append(conn, "interactions", interaction)
+        return interaction
+    
+    def get_client_interactions(self, phone: str, limit: int = 50) -> List[Dict]:
+        """Newest interactions for phone, continuing into the archive once live history runs out."""
+        interactions = self._select(
+            "SELECT data FROM interactions WHERE phone = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (phone, limit)
+        )
+        if len(interactions) < limit:
+            row = self._connect().execute("SELECT archived_through FROM archived_phones WHERE phone = ?", (phone,)).fetchone()
+            if row:
+                before = interactions[-1]["timestamp"] if interactions else None
+                interactions.extend(self.archive.read(phone, limit - len(interactions), before=before, through=row[0]))
+        return interactions
+    
+    def payload_refs(self) -> set:
+        """Raw payload references (see db_blobs) held by live and archived interactions."""
+        rows = self._connect().execute(
+            "SELECT json_extract(data, '$.payload_ref') FROM interactions WHERE json_extract(data, '$.payload_ref') IS NOT NULL"
+        ).fetchall()
+        refs = {row[0] for row in rows}
+        refs.update(i["payload_ref"] for i in self.archive.iter_records() if "payload_ref" in i)
+        return refs
+    
+    def apply_retention(self, now: Optional[datetime] = None) -> Dict:
+        """
+        Archive interactions outside each phone's hot window and expire old log rows (see Database.apply_retention).
+        
+        The cold rows are deleted, the archive watermark moved and old log
+        rows expired in one write transaction; the archive is appended
+        just before it commits.
+        """
+        now = now or datetime.now()
+        hot_cutoff = (now - timedelta(days=RETENTION_HOT_DAYS)).isoformat() if RETENTION_HOT_DAYS > 0 else ""
+        with self._write() as conn:
+            rows = conn.execute(
+                "DELETE FROM interactions WHERE id IN (SELECT id FROM (SELECT id, timestamp, ROW_NUMBER() OVER "
+                "(PARTITION BY phone ORDER BY timestamp DESC, id DESC) AS position FROM interactions) "
+                "WHERE position > ? OR timestamp < ?) RETURNING id, data",
+                (RETENTION_HOT_INTERACTIONS, hot_cutoff)
+            ).fetchall()
+            cold = [json.loads(data) for _, data in sorted(rows)]
+            conn.executemany(
+                "INSERT INTO archived_phones (phone, archived_through) VALUES (?, ?) ON CONFLICT(phone) "
+                "DO UPDATE SET archived_through = MAX(archived_through, excluded.archived_through)",
+                [(interaction.get("phone"), interaction.get("timestamp", "")) for interaction in cold]
+            )
+            
+            expired = {}
+            for table in ("system_alerts", "tool_executions", "approved_responses"):
+                before = conn.total_changes
+                ttl_days = RETENTION_TTL_DAYS.get(table, 0)
+                if ttl_days > 0:
+                    cutoff = (now - timedelta(days=ttl_days)).isoformat()
+                    conn.execute(f"DELETE FROM {table} WHERE {TIMESTAMP_FIELDS[table]} < ?", (cutoff,))
+                if table in RETENTION_MAX_RECORDS:
+                    self._trim(conn, table, RETENTION_MAX_RECORDS[table])
+                expired[table] = conn.total_changes - before
+            seen_cutoff = (now - timedelta(hours=WEBHOOK_DEDUP_TTL_HOURS)).isoformat()
+            expired["seen_messages"] = conn.execute("DELETE FROM seen_messages WHERE seen_at < ?", (seen_cutoff,)).rowcount
+            
+            # Archived (and fsynced) last, so only the COMMIT follows: a failing statement rolls back with
+            # nothing archived, and copies left by a failed COMMIT are past the watermark, which read() skips
+            self.archive.write(cold)
+        return {"archived": len(cold), "expired": expired}
+    
+    def externalize_payloads(self, put: Callable[[object], str]) -> int:
+        """Replace inline "webhook_data" payloads of live interactions with put(payload) references."""
+        with self._write() as conn:
+            rows = conn.execute(
+                "SELECT id, data FROM interactions WHERE json_extract(data, '$.webhook_data') IS NOT NULL"
+            ).fetchall()
+            updates = []
+            for row_id, raw in rows:
+                interaction = json.loads(raw)
+                interaction["payload_ref"] = put(interaction.pop("webhook_data"))
+                updates.append((json.dumps(interaction, ensure_ascii=False), row_id))
+            conn.executemany("UPDATE interactions SET data = ? WHERE id = ?", updates)
+        return len(updates)
+    
+    def get_all_clients(self) -> List[Dict]:
+        return self._select("SELECT data FROM clients ORDER BY rowid")
+    
+    def get_all_leads(self) -> List[Dict]:
+        return self._select("SELECT data FROM leads ORDER BY rowid")
+    
+    def get_active_subscriptions(self) -> List[Dict]:
+        return self._select("SELECT data FROM subscriptions WHERE status = 'active' ORDER BY rowid")
+    
+    def get_subscriptions_due(self, until_iso: str) -> List[Dict]:
+        """Active subscriptions whose next_billing_date is at or before until_iso, soonest first."""
+        return self._select(
+            "SELECT data FROM subscriptions WHERE status = 'active' "
+            "AND json_extract(data, '$.next_billing_date') <= ? "
+            "ORDER BY json_extract(data, '$.next_billing_date')",
+            (datetime.fromisoformat(until_iso).isoformat(),)
+        )
+    
+    def get_recent_interactions(self, limit: int = 100) -> List[Dict]:
+        return self.query_interactions(limit=limit)[0]
+    
+    def query_interactions(self, phone: Optional[str] = None, direction: Optional[str] = None,
+                           agent: Optional[str] = None, before: Optional[str] = None,
+                           limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """Newest-first page of interactions and the "<timestamp>|<id>" cursor for the next page."""
+        filters = {"phone": phone, "direction": direction, "agent": agent}
+        return self._page("interactions", "timestamp", "id", filters, before, limit)
+    
+    def query_leads(self, status: Optional[str] = None, before: Optional[str] = None,
+                    limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        return self._page("leads", "created_at", "key", {"status": status}, before, limit)
+    
+    def query_clients(self, status: Optional[str] = None, before: Optional[str] = None,
+                      limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        return self._page("clients", "created_at", "key", {"status": status}, before, limit)
+    
+    def _page(self, table: str, order_column: str, tie_column: str, filters: Dict,
+              before: Optional[str], limit: int) -> Tuple[List[Dict], Optional[str]]:
+        """Keyset pagination on (order_column, tie_column), newest first."""
+        where = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        if before:
+            value, _, tie = before.rpartition("|")
+            where.append(f"({order_column}, {tie_column}) < (?, ?)")
+            params += [value, int(tie) if tie_column == "id" else tie]
+        sql = f"SELECT {order_column}, {tie_column}, data FROM {table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order_column} DESC, {tie_column} DESC LIMIT ?"
+        rows = self._connect().execute(sql, [*params, limit]).fetchall()
+        page = [json.loads(row[2]) for row in rows]
+        cursor = f"{rows[-1][0]}|{rows[-1][1]}" if len(rows) == limit else None
+        return page, cursor
+    
+    def get_conversion_stats(self) -> Dict:
+        """Dashboard totals, read from the trigger-maintained stats table."""
+        stats = self._read_stats(self._connect())
+        total_leads = stats["total_leads"]
+        return {
+            "total_leads": total_leads,
+            "converted_leads": stats["converted_leads"],
+            "conversion_rate": (stats["converted_leads"] / total_leads * 100) if total_leads > 0 else 0,
+            "active_clients": stats["active_clients"],
+            "active_subscriptions": stats["active_subscriptions"],
+            "monthly_revenue": stats["monthly_revenue"]
+        }
+    
+    def rebuild_stats(self) -> Dict:
+        """Recount the stats table from scratch; returns drifted counters as {name: (maintained, recomputed)}."""
+        with self._write() as conn:
+            maintained = self._read_stats(conn)
+            self._recount_stats(conn)
+            recomputed = self._read_stats(conn)
+        return {
+            name: (maintained[name], recomputed[name])
+            for name in recomputed if maintained[name] != recomputed[name]
+        }
+    
+    def _read_stats(self, conn: sqlite3.Connection) -> Dict:
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        for name in stats:
+            stats[name] = round(stats[name], 2) if name == "monthly_revenue" else int(stats[name])
+        return stats
+    
+    # Message Buffer Methods
+    def upsert_message_buffer(self, phone: str, last_message_at: str, buffer_expires_at: str,
+                             processing: bool = False, retry_count: int = 0, pending_message: Optional[Dict] = None):
+        """
+        Create or update message buffer, queueing pending_message (see db_records.queue_pending_message).
+        
+        A buffer locked by a running turn stays locked: a message arriving
+        mid-turn only moves the deadline and joins the pending list, and
+        the lock owner releases it in flush_message_buffer().
+        """
+        buffer_key = f"buffer_{phone}"
+        with self._write() as conn:
+            existing = self._get(conn, "message_buffers", buffer_key) or {}
+            self._put(conn, "message_buffers", buffer_key, {
+                "phone": phone,
+                "last_message_at": last_message_at,
+                "buffer_expires_at": buffer_expires_at,
+                "processing": existing.get("processing", False) or processing,
+                "retry_count": retry_count,
+                "created_at": existing.get("created_at", datetime.now().isoformat()),
+                "updated_at": datetime.now().isoformat(),
+                "locked_at": existing.get("locked_at"),
+                "locked_by": existing.get("locked_by"),
+                **queue_pending_message(existing, pending_message)
+            })
+    
+    def get_message_buffer(self, phone: str) -> Optional[Dict]:
+        """Get message buffer for phone."""
+        return self._get(self._connect(), "message_buffers", f"buffer_{phone}")
+    
+    def delete_message_buffer(self, phone: str):
+        """Delete message buffer."""
+        with self._write() as conn:
+            if conn.execute("DELETE FROM message_buffers WHERE key = ?", (f"buffer_{phone}",)).rowcount:
+                self._emit(conn, "message_buffers", f"buffer_{phone}", None)
+    
+    def flush_message_buffer(self, phone: str, flushed: int, locked_by: Optional[str] = None) -> bool:
+        """Drop the first flushed pending messages once their turn is done (see Database.flush_message_buffer)."""
+        buffer_key = f"buffer_{phone}"
+        with self._write() as conn:
+            buffer = self._get(conn, "message_buffers", buffer_key)
+            if buffer is None or (locked_by is not None and buffer.get("locked_by") != locked_by):
+                return False
+            remaining = remaining_buffer(buffer, flushed)
+            if remaining is None:
+                conn.execute("DELETE FROM message_buffers WHERE key = ?", (buffer_key,))
+                self._emit(conn, "message_buffers", buffer_key, None)
+                return False
+            self._put(conn, "message_buffers", buffer_key, remaining)
+            return True
+    
+    # Webhook Idempotency Methods
+    def mark_message_seen(self, message_id: str, phone: Optional[str] = None) -> bool:
+        """Record a provider message ID; False if it was already seen (a webhook retry)."""
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM seen_messages WHERE key = ?", (message_id,)).fetchone():
+                return False
+            self._put(conn, "seen_messages", message_id, {
+                "message_id": message_id,
+                "phone": phone,
+                "seen_at": datetime.now().isoformat()
+            })
+            return True
+    
+    def get_expired_buffers(self, now_iso: str) -> List[Dict]:
+        """Get all expired buffers that are not processing."""
+        return self._select(
+            "SELECT data FROM message_buffers WHERE processing = 0 AND buffer_expires_at <= ? ORDER BY buffer_expires_at",
+            (now_iso,)
+        )
+    
+    def acquire_buffer_lock(self, phone: str, process_id: str, expected_version: Optional[int] = None) -> bool:
+        """Atomically acquire lock for buffer (see Database.acquire_buffer_lock)."""
+        buffer_key = f"buffer_{phone}"
+        with self._write() as conn:
+            if expected_version is None:
+                buffer = self._get(conn, "message_buffers", buffer_key)
+                if not buffer or buffer.get("processing", False):
+                    return False
+                expected_version = buffer.get("version", 0)
+            now = datetime.now().isoformat()
+            return self.compare_and_set("message_buffers", buffer_key, expected_version, {
+                "processing": True,
+                "locked_at": now,
+                "locked_by": process_id,
+                "updated_at": now
+            })
+    
+    def release_buffer_lock(self, phone: str, locked_by: Optional[str] = None):
+        """Release lock for buffer (with locked_by, only if that worker holds it)."""
+        buffer_key = f"buffer_{phone}"
+        with self._write() as conn:
+            buffer = self._get(conn, "message_buffers", buffer_key)
+            if buffer is not None and (locked_by is None or buffer.get("locked_by") == locked_by):
+                buffer["processing"] = False
+                buffer["locked_at"] = None
+                buffer["locked_by"] = None
+                buffer["updated_at"] = datetime.now().isoformat()
+                self._put(conn, "message_buffers", buffer_key, buffer)
+    
+    def increment_buffer_retry(self, phone: str):
+        """Increment retry count for buffer."""
+        buffer_key = f"buffer_{phone}"
+        with self._write() as conn:
+            buffer = self._get(conn, "message_buffers", buffer_key)
+            if buffer is not None:
+                buffer["retry_count"] = buffer.get("retry_count", 0) + 1
+                buffer["last_retry_at"] = datetime.now().isoformat()
+                buffer["updated_at"] = datetime.now().isoformat()
+                self._put(conn, "message_buffers", buffer_key, buffer)
+    
+    def get_messages_since(self, phone: str, since_iso: str) -> List[Dict]:
+        """Get all messages for phone since timestamp."""
+        return self._select(
+            "SELECT data FROM interactions WHERE phone = ? AND direction = 'incoming' AND timestamp >= ? "
+            "ORDER BY timestamp, id",
+            (phone, since_iso)
+        )
+    
+    def get_stuck_locks(self, threshold_iso: str) -> List[Dict]:
+        """Get buffers with stuck locks."""
+        return self._select(
+            "SELECT data FROM message_buffers WHERE processing = 1 AND locked_at IS NOT NULL AND locked_at < ?",
+            (threshold_iso,)
+        )
+    
+    def get_unprocessed_buffers(self, threshold_iso: str) -> List[Dict]:
+        """Get buffers that expired but weren't processed."""
+        return self._select(
+            "SELECT data FROM message_buffers WHERE processing = 0 AND buffer_expires_at < ?",
+            (threshold_iso,)
+        )
+    
+    def get_high_retry_buffers(self, min_retries: int) -> List[Dict]:
+        """Get buffers with high retry counts."""
+        return self._select(
+            "SELECT data FROM message_buffers WHERE retry_count >= ?",
+            (min_retries,)
+        )
+    
+    # System Alerts Methods
+    def create_alert(self, type: str, phone: str, details: str):
+        """Create system alert."""
+        alert = {
+            "type": type,
+            "phone": phone,
+            "details": details,
+            "created_at": datetime.now().isoformat(),
+            "resolved": False
+        }
+        with self._write() as conn:
+            self._append(conn, "system_alerts", alert)
+        return alert
+    
+    def get_alerts(self, unresolved_only: bool = True, limit: int = 100) -> List[Dict]:
+        """Get system alerts."""
+        where = "WHERE resolved = 0 " if unresolved_only else ""
+        return self._select(
+            f"SELECT data FROM system_alerts {where}ORDER BY created_at DESC, id DESC LIMIT ?",
+            (limit,)
+        )
+    
+    # Tool Executions Methods
+    def log_tool_execution(self, phone: str, tool_name: str, input_data: Dict, output_data: Dict):
+        """Log tool execution for audit."""
+        execution = {
+            "phone": phone,
+            "tool_name": tool_name,
+            "input": input_data,
+            "output": output_data,
+            "timestamp": datetime.now().isoformat()
+        }
+        with self._write() as conn:
+            self._append(conn, "tool_executions", execution)
+        return execution
+    
+    # PDF Documents Methods
+    def save_pdf_document(self, phone: str, plan_id: str, file_path: str):
+        """Save PDF document record."""
+        doc_key = f"pdf_{phone}_{plan_id}"
+        with self._write() as conn:
+            self._put(conn, "pdf_documents", doc_key, {
+                "phone": phone,
+                "plan_id": plan_id,
+                "file_path": file_path,
+                "created_at": datetime.now().isoformat(),
+                "sent_at": None
+            })
+        return doc_key
+    
+    def mark_pdf_sent(self, phone: str, plan_id: str):
+        """Mark PDF as sent."""
+        doc_key = f"pdf_{phone}_{plan_id}"
+        with self._write() as conn:
+            doc = self._get(conn, "pdf_documents", doc_key)
+            if doc is not None:
+                doc["sent_at"] = datetime.now().isoformat()
+                self._put(conn, "pdf_documents", doc_key, doc)
+    
+    def get_pdf_documents(self, phone: Optional[str] = None) -> List[Dict]:
+        """Get PDF documents, optionally filtered by phone."""
+        if phone:
+            return self._select(
+                "SELECT data FROM pdf_documents WHERE phone = ? ORDER BY created_at DESC",
+                (phone,)
+            )
+        return self._select("SELECT data FROM pdf_documents ORDER BY created_at DESC")
+    
+    # Approved Responses Methods
+    def save_approved_response(self, phone: str, context: str, response: str, agent: str):
+        """Save approved response for learning."""
+        approved = {
+            "phone": phone,
+            "context": context,
+            "response": response,
+            "agent": agent,
+            "approved_at": datetime.now().isoformat()
+        }
+        with self._write() as conn:
+            self._append(conn, "approved_responses", approved)
+        return approved
+    
+    def get_approved_responses(self, agent: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        """Get approved responses, optionally filtered by agent."""
+        if agent:
+            return self._select(
+                "SELECT data FROM approved_responses WHERE agent = ? ORDER BY approved_at DESC, id DESC LIMIT ?",
+                (agent, limit)
+            )
+        return self._select(
+            "SELECT data FROM approved_responses ORDER BY approved_at DESC, id DESC LIMIT ?",
+            (limit,)
+        )
+
+def migrate_json_to_sqlite(json_file: str, sqlite_file: str, overwrite: bool = False) -> Dict[str, int]:
+    """
+    One-shot migration of a JSON database file into a SQLite database.
+    
+    Args:
+        json_file: Path to the existing data/database.json
+        sqlite_file: Path of the SQLite database to create or fill
+        overwrite: Replace existing SQLite contents instead of refusing
+    
+    Returns:
+        Dict with the number of migrated records per collection
+    """
+    # Imported here: database imports this module when DATABASE_BACKEND is sqlite
+    from database import Database
+    # Opened as a database, not read as a snapshot: writes since the last compaction are only in the journal
+    source = Database(json_file)
+    try:
+        data = source._load()
+    finally:
+        source.close()
+    
+    target = SQLiteDatabase(sqlite_file)
+    with target._write() as conn:
+        if not overwrite:
+            for table in list(KEYED_TABLES) + list(LOG_TABLES):
+                if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    raise ValueError(f"{sqlite_file} already contains data (table '{table}'); pass overwrite=True to replace it")
+        target._replace_all(conn, data)
+    
+    counts = {table: len(data.get(table, {})) for table in list(KEYED_TABLES) + list(LOG_TABLES)}
+    logger.info(f"✅ Migrated {json_file} to {sqlite_file}: {counts}")
+    return counts
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Migrate the JSON database to SQLite")
+    parser.add_argument("json_file", nargs="?", default="data/database.json")
+    parser.add_argument("sqlite_file", nargs="?", default="data/database.sqlite3")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing SQLite contents")
+    args = parser.parse_args()
+    
+    for table, count in migrate_json_to_sqlite(args.json_file, args.sqlite_file, args.overwrite).items():
+        print(f"{table}: {count}")
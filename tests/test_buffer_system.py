@@ -5,9 +5,13 @@ import unittest
 import os
 import tempfile
 import shutil
+import threading
+import time
 from datetime import datetime, timedelta
 from database import Database
 from buffer_manager import BufferManager
+from buffer_scheduler import DeadlineScheduler
+from buffer_window import AdaptiveWindow
 
 class TestBufferSystem(unittest.TestCase):
     
@@ -16,10 +20,11 @@ class TestBufferSystem(unittest.TestCase):
         self.test_dir = tempfile.mkdtemp()
         self.db_file = os.path.join(self.test_dir, "test_db.json")
         self.db = Database(db_file=self.db_file)
-        self.buffer_manager = BufferManager()
+        self.buffer_manager = BufferManager(database=self.db)
     
     def tearDown(self):
         """Clean up test database."""
+        self.db.close()
         shutil.rmtree(self.test_dir)
         if self.buffer_manager.running:
             self.buffer_manager.stop()
@@ -86,6 +91,30 @@ class TestBufferSystem(unittest.TestCase):
         success3 = self.db.acquire_buffer_lock(phone, "test_process3")
         self.assertTrue(success3)
     
+    def test_buffer_lock_compare_and_set(self):
+        """Test lock acquisition only succeeds against the version that was read."""
+        phone = "+14079897162"
+        self.db.upsert_message_buffer(
+            phone=phone,
+            last_message_at=datetime.now().isoformat(),
+            buffer_expires_at=datetime.now().isoformat(),
+            processing=False
+        )
+        
+        # Two workers read the same version: only the first one wins
+        version = self.db.get_message_buffer(phone)["version"]
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "worker_1", expected_version=version))
+        self.assertFalse(self.db.acquire_buffer_lock(phone, "worker_2", expected_version=version))
+        
+        # Taking over a (stuck) lock also races on its version
+        locked = self.db.get_message_buffer(phone)
+        self.assertEqual(locked["locked_by"], "worker_1")
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "worker_3", expected_version=locked["version"]))
+        self.assertFalse(self.db.acquire_buffer_lock(phone, "worker_4", expected_version=locked["version"]))
+        self.assertEqual(self.db.get_message_buffer(phone)["locked_by"], "worker_3")
+        
+        self.assertFalse(self.db.compare_and_set("message_buffers", "buffer_missing", 1, {"processing": False}))
+    
     def test_message_batching(self):
         """Test that multiple messages are batched."""
         phone = "+14079897162"
@@ -99,6 +128,84 @@ class TestBufferSystem(unittest.TestCase):
         incoming = [i for i in interactions if i["direction"] == "incoming"]
         self.assertEqual(len(incoming), 3)
     
+    def test_pending_messages_survive_the_turn(self):
+        """Test a flush reads the buffer's own queue and keeps messages that arrived during the turn."""
+        phone = "+14079897162"
+        for i in range(2):
+            self.buffer_manager.add_message(phone, f"Message {i}")
+        self._expire_buffer(phone)
+        
+        self.db.get_messages_since = None  # the history is not read
+        buffer = self.buffer_manager._claim_buffer(phone)
+        messages = self.buffer_manager._buffer_messages(phone, buffer)
+        self.assertEqual([m["message"] for m in messages], ["Message 0", "Message 1"])
+        # The flush ended the contact's burst
+        self.assertIsNone(self.buffer_manager.window._cadences[phone].last_at)
+        
+        self.buffer_manager.add_message(phone, "Message 2")
+        self.buffer_manager._complete_buffer(phone, buffer, messages, time.time())
+        buffer = self.db.get_message_buffer(phone)
+        self.assertEqual([m["message"] for m in buffer["pending"]], ["Message 2"])
+        self.assertEqual(buffer["created_at"], buffer["pending"][0]["timestamp"])
+        self.assertFalse(buffer["processing"])
+        
+        # The queue is part of the durable buffer record
+        self.db.close()
+        self.db = Database(db_file=self.db_file)
+        self.assertEqual([m["message"] for m in self.db.get_message_buffer(phone)["pending"]], ["Message 2"])
+        self.assertFalse(self.db.flush_message_buffer(phone, 1))
+        self.assertIsNone(self.db.get_message_buffer(phone))
+    
+    def _expire_buffer(self, phone: str):
+        buffer = self.db.get_message_buffer(phone)
+        self.db.upsert_message_buffer(phone, buffer["last_message_at"], datetime.now().isoformat(),
+                                      retry_count=buffer["retry_count"])
+    
+    def test_message_during_turn_keeps_the_lock(self):
+        """Test a message arriving mid-turn does not let a second manager claim the buffer."""
+        phone = "+14079897162"
+        other = BufferManager(database=self.db)
+        self.buffer_manager.add_message(phone, "m1")
+        self._expire_buffer(phone)
+        
+        claimed = self.buffer_manager._claim_buffer(phone)
+        self.assertEqual([m["message"] for m in claimed["pending"]], ["m1"])
+        self.buffer_manager.add_message(phone, "m2")
+        self._expire_buffer(phone)
+        
+        buffer = self.db.get_message_buffer(phone)
+        self.assertTrue(buffer["processing"])
+        self.assertEqual(buffer["locked_by"], claimed["locked_by"])
+        self.assertIsNone(other._claim_buffer(phone))
+        
+        # Only the lock owner can release it
+        self.assertFalse(self.db.flush_message_buffer(phone, 1, locked_by="someone_else"))
+        self.db.release_buffer_lock(phone, locked_by="someone_else")
+        self.assertEqual(self.db.get_message_buffer(phone)["locked_by"], claimed["locked_by"])
+    
+    def test_messages_queued_mid_turn_go_to_the_next_turn_only(self):
+        """Test the next turn, on another manager, gets only what arrived after the first turn claimed."""
+        phone = "+14079897162"
+        other = BufferManager(database=self.db)
+        rescheduled = []
+        self.db.subscribe(lambda event: rescheduled.append(event["record"]), types={"buffer_upserted"})
+        self.buffer_manager.add_message(phone, "m1")
+        self._expire_buffer(phone)
+        
+        claimed = self.buffer_manager._claim_buffer(phone)
+        self.buffer_manager.add_message(phone, "m2")
+        self.assertIsNone(other._claim_buffer(phone))
+        self.buffer_manager._complete_buffer(phone, claimed, claimed["pending"], time.time())
+        
+        # Released by its owner with the remaining messages, which puts it back on the schedule
+        self.assertFalse(rescheduled[-1]["processing"])
+        self.assertEqual([m["message"] for m in rescheduled[-1]["pending"]], ["m2"])
+        self._expire_buffer(phone)
+        second = other._claim_buffer(phone)
+        self.assertEqual([m["message"] for m in second["pending"]], ["m2"])
+        other._complete_buffer(phone, second, second["pending"], time.time())
+        self.assertIsNone(self.db.get_message_buffer(phone))
+    
     def test_retry_counting(self):
         """Test retry count increment."""
         phone = "+14079897162"
@@ -115,6 +222,179 @@ class TestBufferSystem(unittest.TestCase):
         
         buffer = self.db.get_message_buffer(phone)
         self.assertEqual(buffer["retry_count"], 1)
+    
+    def test_buffer_flushed_at_its_deadline(self):
+        """Test an expiring buffer is processed right away, without waiting for a poll."""
+        phone = "+14079897162"
+        processed = threading.Event()
+        self.buffer_manager._process_batched_messages = lambda p, messages: processed.set()
+        self.buffer_manager.start()
+        
+        started = time.time()
+        self.db.upsert_message_buffer(
+            phone=phone,
+            last_message_at=datetime.now().isoformat(),
+            buffer_expires_at=(datetime.now() + timedelta(milliseconds=200)).isoformat(),
+            processing=False
+        )
+        self.db.add_interaction(phone, "user", "oi", "incoming")
+        self.assertTrue(processed.wait(2))
+        self.assertGreaterEqual(time.time() - started, 0.19)
+        self.assertLess(time.time() - started, 1.5)
+        for _ in range(100):
+            if self.db.get_message_buffer(phone) is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.db.get_message_buffer(phone))
+        self.assertEqual(self.buffer_manager.metrics()["pending"], 0)
+    
+    def test_pool_runs_phones_in_parallel_one_turn_each(self):
+        """Test a slow phone does not hold up others and never runs two turns at once."""
+        slow, fast = "+14079897162", "+14079897163"
+        release, fast_done = threading.Event(), threading.Event()
+        running, overlaps, turns = set(), [], []
+        lock = threading.Lock()
+        
+        def process(phone):
+            with lock:
+                if phone in running:
+                    overlaps.append(phone)
+                running.add(phone)
+            if phone == slow:
+                release.wait(2)
+            else:
+                fast_done.set()
+            with lock:
+                running.discard(phone)
+                turns.append(phone)
+        
+        self.buffer_manager._process_buffer = process
+        self.buffer_manager.start()
+        self.buffer_manager._submit(slow)
+        self.buffer_manager._submit(slow)
+        self.buffer_manager._submit(fast)
+        self.assertTrue(fast_done.wait(2))
+        for _ in range(200):
+            metrics = self.buffer_manager.metrics()
+            if metrics["active_workers"] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(metrics["active_workers"], 1)
+        self.assertEqual(metrics["queue_depth"], 0)
+        
+        release.set()
+        for _ in range(200):
+            if len(turns) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(turns), [slow, slow, fast])
+        self.assertEqual(overlaps, [])
+    
+    def test_only_committed_messages_shape_the_window(self):
+        """Test webhook retries and rolled-back writes are not counted in the contact's cadence."""
+        phone = "+14079897170"
+        self.buffer_manager.add_message(phone, "oi", metadata={"message_id": "m1"})
+        self.buffer_manager.add_message(phone, "oi", metadata={"message_id": "m1"})
+        cadence = self.buffer_manager.window._cadences[phone]
+        self.assertEqual((cadence.bursts, cadence.follow_ups), (1, 0))
+        
+        def fail(*args, **kwargs):
+            raise RuntimeError("boom")
+        
+        self.db.upsert_message_buffer = fail
+        with self.assertRaises(RuntimeError):
+            self.buffer_manager.add_message(phone, "tudo bem?")
+        self.assertEqual((cadence.bursts, cadence.follow_ups), (1, 0))
+        self.assertEqual(len(self.db.get_client_interactions(phone)), 1)
+        
+        del self.db.upsert_message_buffer
+        self.buffer_manager.add_message(phone, "tudo bem?")
+        self.assertEqual((cadence.bursts, cadence.follow_ups), (1, 1))
+
+class TestDeadlineScheduler(unittest.TestCase):
+    
+    def test_rescheduling_moves_the_deadline(self):
+        """Test a key fires once, at its latest deadline, earliest keys first."""
+        scheduler = DeadlineScheduler()
+        now = time.time()
+        scheduler.schedule("a", now + 60)
+        scheduler.schedule("b", now - 1)
+        scheduler.schedule("a", now - 2)
+        scheduler.schedule("c", now + 60)
+        scheduler.cancel("c")
+        self.assertEqual(scheduler.wait_due(timeout=0), ["a", "b"])
+        self.assertEqual(scheduler.wait_due(timeout=0.05), [])
+        self.assertEqual(len(scheduler), 0)
+        
+        waiter = threading.Thread(target=lambda: self.assertEqual(scheduler.wait_due(), ["d"]))
+        waiter.start()
+        time.sleep(0.05)
+        scheduler.schedule("d", time.time() + 0.05)
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive())
+
+class TestAdaptiveWindow(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up a window of 3-30 s around the fixed 15 s."""
+        self.window = AdaptiveWindow(adaptive=True, default=15, minimum=3, maximum=30)
+    
+    def test_window_follows_the_contact_cadence(self):
+        """Test complete questions close early, lone messages get the minimum and bursty senders an extension."""
+        self.assertEqual(self.window.observe("+1", "oi", 0), 15)
+        self.assertEqual(self.window.observe("+2", "Quanto custa o plano mensal?", 0), 5)
+        
+        # One message every few minutes: nothing to wait for
+        for n in range(4):
+            window = self.window.observe("+3", "oi", n * 600)
+        self.assertEqual(window, 3)
+        
+        # Messages 12 s apart: wait past the fixed window instead of splitting them
+        for n in range(6):
+            window = self.window.observe("+4", "e também", n * 12)
+        self.assertEqual(window, 19)
+        self.assertEqual(AdaptiveWindow(adaptive=False, default=15).observe("+4", "Quanto custa o plano?", 0), 15)
+        
+        metrics = self.window.metrics()
+        self.assertGreaterEqual(metrics["early_closes"], 2)
+        self.assertGreaterEqual(metrics["extensions"], 1)
+    
+    def test_replies_to_the_bot_start_a_new_burst(self):
+        """Test a prompt back-and-forth closes early instead of growing to the maximum window."""
+        windows = []
+        now = 0
+        for _ in range(6):
+            windows.append(self.window.observe("+8", "oi", now))
+            self.window.close_burst("+8")
+            # Flushed after the window, answered a few seconds later, replied to a few seconds after that
+            now += windows[-1] + 10
+        self.assertEqual(windows, [15, 15, 3, 3, 3, 3])
+        metrics = self.window.metrics()
+        self.assertEqual(metrics["extensions"], 0)
+        self.assertEqual(metrics["early_closes"], 4)
+    
+    def test_peek_does_not_record(self):
+        """Test peek() returns the window observe() will return without changing the cadence."""
+        for n in range(3):
+            self.window.observe("+6", "e também", n * 12)
+        before = self.window.metrics()
+        self.assertEqual(self.window.peek("+6", "e também", 36), self.window.peek("+6", "e também", 36))
+        self.assertEqual(self.window.metrics(), before)
+        self.assertEqual(self.window.peek("+7", "oi", 0), 15)
+        self.assertNotIn("+7", self.window._cadences)
+        self.assertEqual(self.window.peek("+6", "e também", 36), self.window.observe("+6", "e também", 36))
+    
+    def test_first_reply_compared_with_fixed_window(self):
+        """Test turns record time to first reply next to what the fixed window would have taken."""
+        self.window.record_turn(first_at=100, last_at=100, flushed_at=105, replied_at=107)
+        metrics = self.window.metrics()
+        self.assertEqual(metrics["first_reply_avg_s"], 7)
+        self.assertEqual(metrics["fixed_window_first_reply_avg_s"], 17)
+        
+        # An early close followed by a message the fixed window would have kept
+        self.window.observe("+5", "Qual o horário de atendimento?", 0)
+        self.window.observe("+5", "obrigado", 8)
+        self.assertEqual(self.window.metrics()["split_bursts"], 1)
 
 if __name__ == '__main__':
     unittest.main()
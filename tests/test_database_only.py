@@ -70,6 +70,7 @@ print(f"\n{'='*40}")
 print(f"Passou: {passed}/10")
 print(f"Falhou: {errors}/10")
 
+db.close()
 shutil.rmtree(temp_dir)
 print(f"🧹 Database temporário limpo")
 
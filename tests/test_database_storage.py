@@ -0,0 +1,310 @@
+"""
+Tests for the JSON database storage engine (in-memory document, persistence).
+"""
+import unittest
+import os
+import json
+import time
+import tempfile
+import shutil
+import multiprocessing
+from database import Database, CorruptDatabaseError, read_snapshot
+
+def _increment_retries(db_file, phone, times):
+    db = Database(db_file=db_file, commit_interval=0.005)
+    for _ in range(times):
+        db.increment_buffer_retry(phone)
+    db.close()
+
+class TestDatabaseStorage(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.test_dir, "test_db.json")
+        self.db = Database(db_file=self.db_file, commit_interval=0)
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def _read_disk(self):
+        return read_snapshot(self.db_file)
+    
+    def test_reads_served_from_memory_until_flush(self):
+        """Test writes are visible immediately and persisted on flush."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        
+        self.assertEqual(self.db.get_lead(phone)["name"], "Teste")
+        self.assertEqual(self._read_disk()["leads"], {})
+        
+        self.db.flush()
+        self.assertIn(f"lead_{phone}", self._read_disk()["leads"])
+    
+    def test_flush_only_on_change(self):
+        """Test the file is not rewritten when nothing is dirty."""
+        self.db.add_lead("+5511999998888", "Teste")
+        self.db.flush()
+        mtime = os.stat(self.db_file).st_mtime_ns
+        
+        self.db.get_lead("+5511999998888")
+        self.db.flush()
+        self.assertEqual(os.stat(self.db_file).st_mtime_ns, mtime)
+    
+    def test_returned_records_are_copies(self):
+        """Test callers cannot mutate the cached document by accident."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        lead = self.db.get_lead(phone)
+        lead["name"] = "Changed"
+        self.assertEqual(self.db.get_lead(phone)["name"], "Teste")
+        
+        # Nested values too, both ways: what was passed in and what comes back
+        anamnesis = {"goals": ["perder peso"]}
+        self.db.convert_lead_to_client(phone)
+        self.db.save_anamnesis(phone, anamnesis)
+        anamnesis["goals"].append("passed in")
+        self.db.get_client(phone)["anamnesis"]["goals"].append("returned")
+        self.db.get_all_clients()[0]["anamnesis"]["goals"].clear()
+        self.assertEqual(self.db.get_client(phone)["anamnesis"], {"goals": ["perder peso"]})
+        
+        self.db.upsert_message_buffer(phone, "2025-10-30T12:00:00", "2025-10-30T12:00:15",
+                                      pending_message={"message": "oi", "timestamp": "2025-10-30T12:00:00"})
+        self.db.get_message_buffer(phone)["pending"][0]["message"] = "changed"
+        self.db.get_message_buffer(phone)["pending"].append({"message": "extra"})
+        self.assertEqual([m["message"] for m in self.db.get_message_buffer(phone)["pending"]], ["oi"])
+        
+        self.db.add_interaction(phone, "sales", "oi", metadata={"metadata": {"tags": ["a"]}})
+        self.db.get_client_interactions(phone)[0]["metadata"]["tags"].append("b")
+        self.assertEqual(self.db.get_client_interactions(phone)[0]["metadata"], {"tags": ["a"]})
+    
+    def test_reload_on_external_write(self):
+        """Test a write by another process is picked up, keeping unflushed local changes."""
+        other = Database(db_file=self.db_file, commit_interval=0)
+        self.db.add_interaction("+5511000000000", "sales", "local", "incoming")
+        
+        # Guarantee a different mtime even on coarse-grained filesystems
+        time.sleep(0.01)
+        other.add_lead("+5511911111111", "Dashboard")
+        other.flush()
+        
+        self.assertIsNotNone(self.db.get_lead("+5511911111111"))
+        self.assertEqual(len(self.db.get_client_interactions("+5511000000000")), 1)
+        other.close()
+    
+    def test_appends_go_to_journal(self):
+        """Test append-only collections do not rewrite the snapshot."""
+        self.db.flush()
+        mtime = os.stat(self.db_file).st_mtime_ns
+        self.db.add_interaction("+5511999998888", "sales", "oi", "incoming")
+        self.db.create_alert("test", "+5511999998888", "details")
+        self.db.log_tool_execution("+5511999998888", "tool", {}, {})
+        self.db.flush()
+        
+        self.assertEqual(os.stat(self.db_file).st_mtime_ns, mtime)
+        with open(self.db.journal_file, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 3)
+    
+    def test_journal_replay_after_crash(self):
+        """Test a restart replays the journal and drops only a torn last line."""
+        phone = "+5511999998888"
+        for i in range(3):
+            self.db.add_interaction(phone, "sales", f"msg {i}", "incoming")
+        with open(self.db.journal_file, "ab") as f:
+            f.write(b'{"seq": 99, "c": "interactions", "r": {"phone"')
+        
+        recovered = Database(db_file=self.db_file, commit_interval=0)
+        messages = [i["message"] for i in recovered.get_client_interactions(phone)]
+        self.assertEqual(messages, ["msg 2", "msg 1", "msg 0"])
+        recovered.close()
+    
+    def test_compaction_folds_journal_into_snapshot(self):
+        """Test compaction writes the journal into the snapshot and truncates it."""
+        phone = "+5511999998888"
+        self.db.add_interaction(phone, "sales", "oi", "incoming")
+        self.db.compact()
+        
+        self.assertEqual(os.path.getsize(self.db.journal_file), 0)
+        self.assertEqual(len(self._read_disk()["interactions"]), 1)
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(len(reopened.get_client_interactions(phone)), 1)
+        reopened.close()
+    
+    def test_corrupted_snapshot_is_not_replaced_by_empty_database(self):
+        """Test a corrupted snapshot raises instead of silently loading nothing."""
+        with open(self.db_file, "w", encoding="utf-8") as f:
+            f.write('{"clients": {')
+        with self.assertRaises(CorruptDatabaseError):
+            Database(db_file=self.db_file, commit_interval=0)
+    
+    def test_collections_load_on_first_use(self):
+        """Test a cold read only parses the collection it needs, journaled appends included."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        self.db.add_interaction(phone, "sales", "old", "incoming")
+        self.db.compact()
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(reopened.get_lead(phone)["name"], "Teste")
+        reopened.add_interaction(phone, "sales", "new", "incoming")
+        self.assertFalse(reopened._data.loaded("interactions"))
+        
+        messages = [i["message"] for i in reopened.get_client_interactions(phone)]
+        self.assertEqual(messages, ["new", "old"])
+        reopened.close()
+    
+    def test_compaction_rewrites_only_changed_collections(self):
+        """Test untouched collection files are kept and unloaded appends are copied forward."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        self.db.add_interaction(phone, "sales", "old", "incoming")
+        self.db.compact()
+        leads_file = self.db._files["leads"]
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        reopened.add_interaction(phone, "sales", "new", "incoming")
+        reopened.compact()
+        self.assertEqual(reopened._files["leads"], leads_file)
+        self.assertFalse(reopened._data.loaded("interactions"))
+        self.assertEqual(len(os.listdir(reopened.collections_dir)), 2)
+        self.assertEqual([i["message"] for i in self._read_disk()["interactions"]], ["old", "new"])
+        reopened.close()
+    
+    def test_single_file_snapshot_is_split_on_compaction(self):
+        """Test a database.json from before the split still loads and is converted."""
+        self.db.close()
+        with open(self.db_file, "w", encoding="utf-8") as f:
+            json.dump({"_meta": {"journal_seq": 0}, "leads": {"lead_1": {"phone": "1", "name": "Antigo"}}}, f)
+        
+        self.db = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(self.db.get_lead("1")["name"], "Antigo")
+        self.db.compact()
+        with open(self.db_file, encoding="utf-8") as f:
+            self.assertIn("_collections", json.load(f))
+        self.assertEqual(self._read_disk()["leads"]["lead_1"]["name"], "Antigo")
+    
+    def test_transaction_persists_once(self):
+        """Test several appends in a transaction become one journal line."""
+        phone = "+5511999998888"
+        with self.db.transaction():
+            self.db.add_interaction(phone, "user", "oi", "incoming")
+            self.db.create_alert("test", phone, "details")
+            self.assertEqual(len(self.db.get_client_interactions(phone)), 1)
+        
+        with open(self.db.journal_file, encoding="utf-8") as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(len(json.loads(lines[0])["ops"]), 2)
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(len(reopened.get_client_interactions(phone)), 1)
+        self.assertEqual(len(reopened.get_alerts()), 1)
+        reopened.close()
+    
+    def test_transaction_rollback(self):
+        """Test a failing transaction leaves no trace in memory or on disk."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.convert_lead_to_client(phone)
+                self.db.add_interaction(phone, "sales", "welcome", "outgoing")
+                raise RuntimeError("boom")
+        
+        self.assertIsNone(self.db.get_client(phone))
+        self.assertEqual(self.db.get_lead(phone)["status"], "new")
+        self.assertEqual(self.db.get_client_interactions(phone), [])
+        with open(self.db.journal_file, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 1)
+    
+    def test_keyed_writes_replayed_from_journal(self):
+        """Test puts and deletes survive a crash without a snapshot rewrite."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        self.db.upsert_message_buffer(phone, "2025-10-30T12:00:00", "2025-10-30T12:00:15")
+        self.db.delete_message_buffer(phone)
+        
+        recovered = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(recovered.get_lead(phone)["name"], "Teste")
+        self.assertIsNone(recovered.get_message_buffer(phone))
+        self.assertEqual(self._read_disk()["leads"], {})
+        recovered.close()
+    
+    def test_group_commit_coalesces_writes(self):
+        """Test commits queued within the interval share one journal write."""
+        db = Database(db_file=os.path.join(self.test_dir, "group.json"), commit_interval=0.05)
+        future = None
+        for i in range(5):
+            db.add_interaction("+5511999998888", "user", f"msg {i}", "incoming")
+            future = db.commit_future()
+            self.assertFalse(future.done())
+        
+        self.assertEqual(future.result(timeout=5), 5)
+        with open(db.journal_file, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 5)
+        self.assertTrue(db.commit_future().done())
+        db.close()
+    
+    def test_write_through_without_interval(self):
+        """Test commit_interval=0 persists before the mutation returns."""
+        db = Database(db_file=os.path.join(self.test_dir, "sync.json"), commit_interval=0)
+        db.add_lead("+5511999998888", "Teste")
+        self.assertTrue(db.commit_future().done())
+        with open(db.journal_file, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 1)
+        db.close()
+    
+    def test_version_changes_on_commit_and_compaction(self):
+        """Test the version token moves on every commit and generation bumps on compaction."""
+        before = self.db.version()
+        self.db.add_lead("+5511999998888", "Teste")
+        after_commit = self.db.version()
+        self.assertEqual(after_commit[0], before[0])
+        self.assertEqual(after_commit[1], before[1] + 1)
+        
+        self.db.compact()
+        self.assertEqual(self.db.version()[0], before[0] + 1)
+        self.assertEqual(self.db.version(), self.db.version())
+    
+    def test_concurrent_processes_do_not_lose_updates(self):
+        """Test read-modify-writes from several processes are serialized by the file lock."""
+        phone = "+5511999998888"
+        self.db.upsert_message_buffer(phone, "2025-10-30T12:00:00", "2025-10-30T12:00:15")
+        
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=_increment_retries, args=(self.db_file, phone, 50))
+            for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for _ in range(50):
+            self.db.increment_buffer_retry(phone)
+        for worker in workers:
+            worker.join(timeout=30)
+            self.assertEqual(worker.exitcode, 0)
+        
+        self.assertEqual(self.db.get_message_buffer(phone)["retry_count"], 200)
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        self.assertEqual(reopened.get_message_buffer(phone)["retry_count"], 200)
+        reopened.close()
+    
+    def test_torn_journal_tail_is_repaired_by_next_writer(self):
+        """Test a line left half-written by a crashed process does not swallow the next commit."""
+        phone = "+5511999998888"
+        self.db.add_interaction(phone, "sales", "before", "incoming")
+        with open(self.db.journal_file, "ab") as f:
+            f.write(b'{"seq": 99, "c": "interactions", "r": {"phone"')
+        self.db.add_interaction(phone, "sales", "after", "incoming")
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        messages = [i["message"] for i in reopened.get_client_interactions(phone)]
+        self.assertEqual(messages, ["after", "before"])
+        reopened.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests for the content-addressed payload blob store.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from db_blobs import BlobStore, collect_garbage, externalize_payloads
+
+class TestBlobStore(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test store and database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.test_dir, "blobs"))
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.phone = "+5511999998888"
+    
+    def tearDown(self):
+        """Clean up test store and database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_put_is_content_addressed(self):
+        """Test equal payloads share one blob regardless of key order."""
+        ref = self.store.put({"phone": self.phone, "message": {"text": "oi"}})
+        self.assertEqual(self.store.put({"message": {"text": "oi"}, "phone": self.phone}), ref)
+        self.assertNotEqual(self.store.put({"phone": self.phone, "message": {"text": "tchau"}}), ref)
+        
+        self.assertEqual(self.store.get(ref)["message"]["text"], "oi")
+        self.assertEqual(len(list(self.store.refs())), 2)
+        self.assertIsNone(self.store.get("0" * 32))
+    
+    def test_gc_keeps_live_and_archived_references(self):
+        """Test only blobs no interaction refers to are collected."""
+        old = (datetime.now() - timedelta(days=365)).isoformat()
+        archived_ref = self.store.put({"message": "archived"})
+        live_ref = self.store.put({"message": "live"})
+        orphan_ref = self.store.put({"message": "orphan"})
+        self.db.add_interaction(self.phone, "user", "archived", metadata={"payload_ref": archived_ref, "timestamp": old})
+        self.db.add_interaction(self.phone, "user", "live", metadata={"payload_ref": live_ref})
+        self.db.apply_retention()
+        
+        self.assertEqual(self.store.gc(self.db.payload_refs()), 0)
+        self.assertEqual(self.store.gc(self.db.payload_refs(), min_age_seconds=0), 1)
+        self.assertEqual(set(self.store.refs()), {archived_ref, live_ref})
+        self.assertIsNone(self.store.get(orphan_ref))
+    
+    def test_externalize_inline_payloads(self):
+        """Test existing interactions lose webhook_data and gain a reference."""
+        self.db.add_interaction(self.phone, "user", "oi", metadata={"webhook_data": {"phone": self.phone}})
+        self.assertEqual(externalize_payloads(self.db, self.store), 1)
+        
+        interaction = self.db.get_client_interactions(self.phone)[0]
+        self.assertNotIn("webhook_data", interaction)
+        self.assertEqual(self.store.get(interaction["payload_ref"]), {"phone": self.phone})
+        self.assertEqual(collect_garbage(self.db, self.store), 0)
+        
+        self.db.close()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.assertNotIn("webhook_data", self.db.get_client_interactions(self.phone)[0])
+        self.assertEqual(externalize_payloads(self.db, self.store), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+Tests for the database change feed.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from database import Database
+from db_events import ChangeFeedGapError
+from sqlite_database import SQLiteDatabase
+
+class TestChangeFeed(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.test_dir, "test_db.json")
+        self.db = Database(db_file=self.db_file, commit_interval=0)
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_subscribers_receive_committed_events(self):
+        """Test typed events are delivered after commit and never for rolled back writes."""
+        phone = "+5511999998888"
+        events = []
+        unsubscribe = self.db.subscribe(events.append)
+        buffer_events = []
+        self.db.subscribe(buffer_events.append, types={"buffer_upserted", "buffer_deleted"})
+        
+        with self.db.transaction():
+            self.db.add_interaction(phone, "user", "oi", "incoming")
+            self.db.upsert_message_buffer(phone, "2025-10-30T12:00:00", "2025-10-30T12:00:15")
+            self.assertEqual(events, [])
+        self.assertEqual([e["type"] for e in events], ["interaction_added", "buffer_upserted"])
+        self.assertEqual(events[0]["seq"], events[1]["seq"])
+        self.assertEqual(events[1]["key"], f"buffer_{phone}")
+        
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.create_alert("test", phone, "details")
+                raise RuntimeError("boom")
+        self.assertEqual(len(events), 2)
+        
+        self.db.delete_message_buffer(phone)
+        self.assertEqual([e["type"] for e in buffer_events], ["buffer_upserted", "buffer_deleted"])
+        
+        unsubscribe()
+        self.db.create_alert("test", phone, "details")
+        self.assertEqual(len(events), 3)
+    
+    def test_writes_from_other_process_are_delivered(self):
+        """Test events journaled by another instance reach subscribers on the next read."""
+        events = []
+        self.db.subscribe(events.append)
+        other = Database(db_file=self.db_file, commit_interval=0)
+        other.add_lead("+5511911111111", "Dashboard")
+        
+        self.assertIsNotNone(self.db.get_lead("+5511911111111"))
+        self.assertEqual([e["type"] for e in events], ["lead_upserted"])
+        
+        # Also across a compaction by the other instance
+        other.add_interaction("+5511911111111", "sales", "oi", "outgoing")
+        other.compact()
+        self.db.get_lead("+5511911111111")
+        self.assertEqual([e["type"] for e in events], ["lead_upserted", "interaction_added"])
+        other.close()
+    
+    def test_events_since_survives_one_compaction(self):
+        """Test durable reads span the previous journal segment and report gaps."""
+        phone = "+5511999998888"
+        start = self.db.version()[1]
+        self.db.add_lead(phone, "Teste")
+        self.db.add_interaction(phone, "user", "oi", "incoming")
+        self.db.compact()
+        self.db.create_alert("test", phone, "details")
+        
+        events = self.db.events_since(start)
+        self.assertEqual([e["type"] for e in events], ["lead_upserted", "interaction_added", "alert_created"])
+        self.assertEqual(self.db.events_since(events[-1]["seq"]), [])
+        self.assertEqual(len(self.db.events_since(start, limit=1)), 1)
+        
+        self.db.compact()
+        self.db.add_interaction(phone, "user", "again", "incoming")
+        self.db.compact()
+        with self.assertRaises(ChangeFeedGapError):
+            self.db.events_since(start)
+    
+    def test_events_since_rejects_old_cursors(self):
+        """Test a cursor older than the retained journal raises instead of returning a partial list."""
+        phone = "+5511999998888"
+        start = self.db.version()[1]
+        self.db.add_lead(phone, "Teste")
+        self.db.compact()
+        shutil.copy(self.db.journal_prev_file, os.path.join(self.test_dir, "stale"))
+        self.db.add_interaction(phone, "user", "oi", "incoming")
+        self.db.compact()
+        self.db.create_alert("test", phone, "details")
+        
+        # The retained segments start at the cursor but skip the interaction in between
+        shutil.copy(os.path.join(self.test_dir, "stale"), self.db.journal_prev_file)
+        with self.assertRaises(ChangeFeedGapError):
+            self.db.events_since(start)
+        
+        with self.assertRaises(ChangeFeedGapError):
+            self.db.events_since(self.db.version()[1] + 5)
+
+class TestSQLiteChangeFeed(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = SQLiteDatabase(db_file=os.path.join(self.test_dir, "test.sqlite3"))
+    
+    def tearDown(self):
+        """Clean up test database."""
+        shutil.rmtree(self.test_dir)
+    
+    def test_subscribe_and_events_since(self):
+        """Test the SQLite backend publishes the same event types and keeps them durable."""
+        phone = "+5511999998888"
+        events = []
+        self.db.subscribe(events.append)
+        self.db.add_interaction(phone, "user", "oi", "incoming")
+        self.db.upsert_message_buffer(phone, "2025-10-30T12:00:00", "2025-10-30T12:00:15")
+        self.db.delete_message_buffer(phone)
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.create_alert("test", phone, "details")
+                raise RuntimeError("boom")
+        
+        types = ["interaction_added", "buffer_upserted", "buffer_deleted"]
+        self.assertEqual([e["type"] for e in events], types)
+        self.assertEqual([e["type"] for e in self.db.events_since(0)], types)
+        self.assertEqual([e["type"] for e in self.db.events_since(events[0]["seq"])], types[1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Tests for the in-memory database indexes.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from db_indexes import DeadlineIndex, InteractionIndex, SortedKeyIndex
+from db_records import Interaction, to_epoch_us
+
+class TestInteractionIndex(unittest.TestCase):
+    
+    def test_latest_and_since(self):
+        """Test per-phone ordering with out-of-order inserts."""
+        index = InteractionIndex()
+        base = datetime(2025, 10, 30, 12, 0, 0)
+        for minutes in (0, 2, 1, 3):
+            index.add(Interaction({"phone": "+1", "timestamp": (base + timedelta(minutes=minutes)).isoformat(), "m": minutes}))
+        index.add(Interaction({"phone": "+2", "timestamp": base.isoformat(), "m": 99}))
+        
+        self.assertEqual([i["m"] for i in index.latest("+1", 3)], [3, 2, 1])
+        since = index.since("+1", to_epoch_us((base + timedelta(minutes=1)).isoformat()))
+        self.assertEqual([i["m"] for i in since], [1, 2, 3])
+        self.assertEqual(index.latest("+3", 10), [])
+    
+    def test_page_walks_ties_without_repeats(self):
+        """Test cursor pages cover every record once, even with equal timestamps."""
+        index = InteractionIndex()
+        for m in range(7):
+            index.add(Interaction({"phone": "+1", "timestamp": "2025-10-30T12:00:00" if m < 4 else f"2025-10-30T12:00:0{m}", "m": m}))
+        
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = index.page("+1", cursor, 2)
+            seen.extend(i["m"] for i in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [6, 5, 4, 3, 2, 1, 0])
+        
+        odd, _ = index.page(None, None, 2, lambda i: i["m"] % 2 == 1)
+        self.assertEqual([i["m"] for i in odd], [5, 3])
+
+class TestDeadlineIndex(unittest.TestCase):
+    
+    def test_due_and_reschedule(self):
+        """Test due keys come back earliest first and moves/discards apply."""
+        index = DeadlineIndex()
+        base = datetime(2025, 10, 30, 12, 0, 0)
+        index.set("a", base + timedelta(seconds=10))
+        index.set("b", base)
+        index.set("c", base + timedelta(seconds=5))
+        
+        self.assertEqual(index.due(base + timedelta(seconds=5)), ["b", "c"])
+        self.assertEqual(index.due(base + timedelta(seconds=5), inclusive=False), ["b"])
+        
+        index.set("b", base + timedelta(seconds=20))
+        index.discard("c")
+        index.discard("missing")
+        self.assertEqual(index.due(base + timedelta(seconds=15)), ["a"])
+        self.assertEqual(len(index), 2)
+
+class TestSortedKeyIndex(unittest.TestCase):
+    
+    def test_pages_newest_first(self):
+        """Test keyset pages by value with the key breaking ties."""
+        index = SortedKeyIndex()
+        index.set("lead_a", "2025-10-01")
+        index.set("lead_b", "2025-10-03")
+        index.set("lead_c", "2025-10-02")
+        index.set("lead_d", "2025-10-02")
+        
+        keys, cursor = index.page(None, 2)
+        self.assertEqual(keys, ["lead_b", "lead_d"])
+        keys, cursor = index.page(cursor, 2)
+        self.assertEqual(keys, ["lead_c", "lead_a"])
+        self.assertIsNone(cursor)
+        
+        index.discard("lead_b")
+        self.assertEqual(index.page(None, 10, lambda key: key != "lead_a")[0], ["lead_d", "lead_c"])
+
+class TestDatabaseInteractionIndex(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.test_dir, "test_db.json")
+        self.db = Database(db_file=self.db_file, commit_interval=0)
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_messages_since_only_incoming(self):
+        """Test get_messages_since filters by phone, time and direction."""
+        phone = "+5511999998888"
+        self.db.add_interaction(phone, "sales", "before", "incoming")
+        since = datetime.now().isoformat()
+        self.db.add_interaction(phone, "user", "in 1", "incoming")
+        self.db.add_interaction(phone, "sales", "reply", "outgoing")
+        self.db.add_interaction("+5511000000000", "user", "other phone", "incoming")
+        self.db.add_interaction(phone, "user", "in 2", "incoming")
+        
+        messages = self.db.get_messages_since(phone, since)
+        self.assertEqual([m["message"] for m in messages], ["in 1", "in 2"])
+    
+    def test_index_rebuilt_on_load(self):
+        """Test the index is rebuilt from snapshot and journal on startup."""
+        phone = "+5511999998888"
+        self.db.add_interaction(phone, "sales", "snapshot", "incoming")
+        self.db.compact()
+        self.db.add_interaction(phone, "sales", "journal", "incoming")
+        
+        reopened = Database(db_file=self.db_file, commit_interval=0)
+        messages = [i["message"] for i in reopened.get_client_interactions(phone, limit=10)]
+        self.assertEqual(messages, ["journal", "snapshot"])
+        reopened.close()
+    
+    def test_buffer_deadline_indexes(self):
+        """Test expired/unprocessed/stuck lookups follow buffer updates and locks."""
+        now = datetime.now()
+        past = (now - timedelta(seconds=120)).isoformat()
+        future = (now + timedelta(seconds=15)).isoformat()
+        self.db.upsert_message_buffer("+1", past, past)
+        self.db.upsert_message_buffer("+2", past, future)
+        
+        self.assertEqual([b["phone"] for b in self.db.get_expired_buffers(now.isoformat())], ["+1"])
+        self.assertEqual([b["phone"] for b in self.db.get_unprocessed_buffers(now.isoformat())], ["+1"])
+        
+        self.assertTrue(self.db.acquire_buffer_lock("+1", "p1"))
+        self.assertEqual(self.db.get_expired_buffers(now.isoformat()), [])
+        self.assertEqual(self.db.get_stuck_locks((now - timedelta(seconds=60)).isoformat()), [])
+        later = (now + timedelta(seconds=60)).isoformat()
+        self.assertEqual([b["phone"] for b in self.db.get_stuck_locks(later)], ["+1"])
+        
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.delete_message_buffer("+1")
+                raise RuntimeError("boom")
+        self.assertEqual([b["phone"] for b in self.db.get_stuck_locks(later)], ["+1"])
+        
+        self.db.delete_message_buffer("+1")
+        self.assertEqual(self.db.get_stuck_locks(later), [])
+        self.assertEqual([b["phone"] for b in self.db.get_expired_buffers(later)], ["+2"])
+    
+    def test_query_interactions_and_leads(self):
+        """Test paginated queries filter and continue from the cursor."""
+        phone = "+5511999998888"
+        for i in range(5):
+            self.db.add_interaction(phone, "sales", f"in {i}", "incoming")
+            self.db.add_interaction(phone, "sales", f"out {i}", "outgoing")
+        self.db.add_interaction("+5511000000000", "nutrition", "other", "incoming")
+        
+        page, cursor = self.db.query_interactions(phone=phone, direction="incoming", limit=3)
+        self.assertEqual([i["message"] for i in page], ["in 4", "in 3", "in 2"])
+        page, cursor = self.db.query_interactions(phone=phone, direction="incoming", before=cursor, limit=3)
+        self.assertEqual([i["message"] for i in page], ["in 1", "in 0"])
+        self.assertIsNone(cursor)
+        
+        page, _ = self.db.query_interactions(agent="nutrition")
+        self.assertEqual([i["message"] for i in page], ["other"])
+        self.assertEqual(self.db.get_recent_interactions(limit=1)[0]["message"], "other")
+        
+        for i in range(3):
+            self.db.add_lead(f"+551100000000{i}", f"Lead {i}")
+        self.db.update_lead("+5511000000001", {"status": "qualified"})
+        leads, cursor = self.db.query_leads(limit=2)
+        self.assertEqual([l["name"] for l in leads], ["Lead 2", "Lead 1"])
+        self.assertEqual([l["name"] for l in self.db.query_leads(before=cursor)[0]], ["Lead 0"])
+        self.assertEqual([l["name"] for l in self.db.query_leads(status="qualified")[0]], ["Lead 1"])
+    
+    def test_stats_counters_follow_writes(self):
+        """Test maintained stats match a full recount after inserts, updates, rollbacks and _save."""
+        for i in range(3):
+            self.db.add_lead(f"+551100000000{i}", f"Lead {i}")
+        self.db.convert_lead_to_client("+5511000000000")
+        self.db.convert_lead_to_client("+5511000000001")
+        self.db.update_client("+5511000000001", {"status": "inactive"})
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.convert_lead_to_client("+5511000000002")
+                raise RuntimeError("boom")
+        
+        self.db.update_subscription("+5511000000001", {"price": 97.00})
+        
+        stats = self.db.get_conversion_stats()
+        self.assertEqual(stats["total_leads"], 3)
+        self.assertEqual(stats["converted_leads"], 2)
+        self.assertEqual(stats["active_clients"], 1)
+        self.assertEqual(stats["active_subscriptions"], 2)
+        self.assertEqual(stats["monthly_revenue"], 47.00 + 97.00)
+        self.assertEqual(self.db.rebuild_stats(), {})
+        
+        self.db._counters.total_leads += 5
+        self.assertEqual(self.db.rebuild_stats(), {"total_leads": (8, 3)})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Tests for per-phone lock striping in the JSON database.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+import threading
+from database import Database
+from db_locks import LockStripes
+
+class TestLockStriping(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database with two phones on different stripes."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.phone = "+5511999990000"
+        self.other = next(f"+55119999900{i:02d}" for i in range(1, 100)
+                          if self.db.stripes.index(f"+55119999900{i:02d}") != self.db.stripes.index(self.phone))
+        for phone in (self.phone, self.other):
+            self.db.add_lead(phone, "Lead")
+            self.db.add_interaction(phone, "user", "oi", "incoming")
+        # Loading a collection the first time waits for the global lock
+        self.db.get_recent_interactions()
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def _in_thread(self, target) -> threading.Thread:
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+    
+    def test_other_phones_read_during_a_transaction(self):
+        """Test a transaction only blocks readers of its own phone."""
+        entered, release = threading.Event(), threading.Event()
+        
+        def hold_transaction():
+            with self.db.transaction(self.phone):
+                self.db.update_lead(self.phone, {"status": "qualified"})
+                entered.set()
+                release.wait(5)
+        
+        writer = self._in_thread(hold_transaction)
+        self.assertTrue(entered.wait(5))
+        
+        other_reads = []
+        reader = self._in_thread(lambda: other_reads.extend([self.db.get_lead(self.other),
+                                                             self.db.get_client_interactions(self.other)]))
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(other_reads[1][0]["message"], "oi")
+        
+        own_reads = []
+        blocked = self._in_thread(lambda: own_reads.append(self.db.get_lead(self.phone)))
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        writer.join(5)
+        blocked.join(5)
+        self.assertEqual(own_reads[0]["status"], "qualified")
+        
+        stripe = self.db.stripes.metrics()[self.db.stripes.index(self.phone)]
+        self.assertGreaterEqual(stripe["contended"], 1)
+        self.assertGreater(stripe["wait_ms_total"], 0)
+        self.assertIn("global", self.db.lock_metrics())
+    
+    def test_transaction_stays_within_its_phone(self):
+        """Test changes to another phone are refused and rolled back appends leave no trace."""
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction(self.phone):
+                self.db.add_interaction(self.phone, "user", "primeira", "incoming")
+                self.db.add_interaction(self.other, "user", "outra", "incoming")
+        
+        self.assertEqual([i["message"] for i in self.db.get_client_interactions(self.phone)], ["oi"])
+        self.assertEqual(len(self.db.get_recent_interactions()), 2)
+        
+        with self.db.transaction():
+            self.db.update_lead(self.phone, {"status": "qualified"})
+            self.db.update_lead(self.other, {"status": "qualified"})
+        self.assertEqual(self.db.get_lead(self.other)["status"], "qualified")
+
+class TestLockStripes(unittest.TestCase):
+    
+    def test_keys_map_to_stable_stripes(self):
+        """Test the same key always uses the same stripe and hold() without a key takes them all."""
+        stripes = LockStripes(8)
+        self.assertEqual(stripes.index("+5511999990000"), LockStripes(8).index("+5511999990000"))
+        with stripes.hold():
+            self.assertTrue(all(stripes.held(str(i)) for i in range(20)))
+        self.assertFalse(stripes.holds_any())
+
+if __name__ == '__main__':
+    unittest.main()
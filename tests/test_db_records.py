@@ -0,0 +1,67 @@
+"""
+Tests for the compact in-memory records of the JSON backend.
+"""
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from sqlite_database import SQLiteDatabase
+from db_records import Interaction, MessageBuffer, phone_ids, to_epoch_us
+
+class TestCompactRecords(unittest.TestCase):
+    
+    def test_dict_view_round_trips(self):
+        """Test the dict view is exactly what was stored, odd timestamps included."""
+        stored = {"phone": "+5511999998888", "agent": "sales", "message": "oi", "direction": "incoming",
+                  "timestamp": "2025-10-30T12:00:00.123456", "payload_ref": "ab" * 16, "buffered": True}
+        interaction = Interaction(stored)
+        self.assertEqual(interaction.to_dict(), stored)
+        self.assertEqual(interaction.timestamp, to_epoch_us("2025-10-30T12:00:00.123456"))
+        self.assertEqual(interaction["buffered"], True)
+        self.assertIsNone(interaction.get("agent_id"))
+        
+        odd = MessageBuffer({"phone": "+5511999998888", "buffer_expires_at": "2025-10-30 12:00:15", "locked_at": None})
+        self.assertEqual(odd.to_dict(), {"phone": "+5511999998888", "buffer_expires_at": "2025-10-30 12:00:15", "locked_at": None})
+        self.assertEqual(odd.buffer_expires_at, to_epoch_us("2025-10-30T12:00:15"))
+    
+    def test_phones_are_interned_and_records_are_smaller(self):
+        """Test records of one conversation share a phone ID and take less memory than dicts."""
+        records = [{"phone": "+5511999997777", "agent": "sales", "message": f"msg {i}", "direction": "incoming",
+                    "timestamp": datetime(2025, 10, 30, 12, 0, i).isoformat()} for i in range(2)]
+        first, second = Interaction(records[0]), Interaction(records[1])
+        self.assertEqual(first.phone_id, second.phone_id)
+        self.assertEqual(phone_ids.phone(first.phone_id), "+5511999997777")
+        self.assertLess(sys.getsizeof(first) + sys.getsizeof(first.timestamp),
+                        sys.getsizeof(records[0]) + sys.getsizeof(records[0]["timestamp"]))
+
+class TestSubscriptionsDue(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test databases."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.sqlite_db = SQLiteDatabase(db_file=os.path.join(self.test_dir, "test.sqlite3"))
+    
+    def tearDown(self):
+        """Clean up test databases."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_due_subscriptions_soonest_first(self):
+        """Test only active subscriptions billing by the cutoff are returned, in billing order."""
+        now = datetime.now()
+        for db in (self.db, self.sqlite_db):
+            for phone, days, status in (("+1", 5, "active"), ("+2", 2, "active"), ("+3", 20, "active"), ("+4", 1, "cancelled")):
+                db.add_lead(phone, "Lead")
+                db.convert_lead_to_client(phone)
+                db.compare_and_set("subscriptions", f"client_{phone}", 1,
+                                   {"status": status, "next_billing_date": (now + timedelta(days=days)).isoformat()})
+            
+            due = db.get_subscriptions_due((now + timedelta(days=7)).isoformat())
+            self.assertEqual([s["client_id"] for s in due], ["client_+2", "client_+1"])
+
+if __name__ == '__main__':
+    unittest.main()
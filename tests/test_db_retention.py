@@ -0,0 +1,113 @@
+"""
+Tests for interaction archival and TTL retention.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from sqlite_database import SQLiteDatabase
+from db_retention import InteractionArchive, split_hot_window
+
+class TestInteractionArchive(unittest.TestCase):
+    
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+    
+    def test_monthly_segments_read_newest_first(self):
+        """Test appended runs and both compressions read back as one history."""
+        for compression in ("gzip", "lzma"):
+            archive = InteractionArchive(os.path.join(self.test_dir, compression), compression)
+            archive.write([{"phone": "+1", "timestamp": "2025-08-31T10:00:00", "m": 0},
+                           {"phone": "+2", "timestamp": "2025-09-01T10:00:00", "m": 99}])
+            archive.write([{"phone": "+1", "timestamp": "2025-09-02T10:00:00", "m": 1},
+                           {"phone": "+1", "timestamp": "2025-09-03T10:00:00", "m": 2}])
+            
+            self.assertEqual(len(archive.segments()), 2)
+            self.assertEqual([r["m"] for r in archive.read("+1", 10)], [2, 1, 0])
+            self.assertEqual([r["m"] for r in archive.read("+1", 2, before="2025-09-03T10:00:00")], [1, 0])
+            self.assertEqual([r["m"] for r in archive.read("+1", 10, through="2025-09-02T10:00:00")], [1, 0])
+    
+    def test_split_hot_window(self):
+        """Test the newest records per phone stay hot and old ones go cold."""
+        now = datetime(2025, 10, 30)
+        interactions = [
+            {"phone": "+1", "timestamp": (now - timedelta(days=days)).isoformat(), "m": days}
+            for days in (200, 3, 2, 1)
+        ] + [{"phone": "+2", "timestamp": now.isoformat(), "m": 0}]
+        
+        hot, cold = split_hot_window(interactions, now, hot_per_phone=2, hot_days=90)
+        self.assertEqual([(i["phone"], i["m"]) for i in hot], [("+1", 2), ("+1", 1), ("+2", 0)])
+        self.assertEqual([i["m"] for i in cold], [200, 3])
+
+class TestDatabaseRetention(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test databases."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.sqlite_db = SQLiteDatabase(db_file=os.path.join(self.test_dir, "sqlite", "test.sqlite3"))
+        self.phone = "+5511999998888"
+    
+    def tearDown(self):
+        """Clean up test databases."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def _check_archival(self, db):
+        old = datetime.now() - timedelta(days=365)
+        for i in range(3):
+            db.add_interaction(self.phone, "sales", f"old {i}", "incoming",
+                               metadata={"timestamp": (old + timedelta(minutes=i)).isoformat()})
+        db.add_interaction(self.phone, "sales", "recent", "incoming")
+        db.create_alert("test", self.phone, "details")
+        
+        summary = db.apply_retention()
+        self.assertEqual(summary["archived"], 3)
+        self.assertEqual(len(db.query_interactions(phone=self.phone)[0]), 1)
+        messages = [i["message"] for i in db.get_client_interactions(self.phone, limit=10)]
+        self.assertEqual(messages, ["recent", "old 2", "old 1", "old 0"])
+        self.assertEqual([i["message"] for i in db.get_client_interactions(self.phone, limit=2)], ["recent", "old 2"])
+        self.assertEqual(db.apply_retention()["archived"], 0)
+        
+        summary = db.apply_retention(now=datetime.now() + timedelta(days=365))
+        self.assertEqual(summary["expired"]["system_alerts"], 1)
+        self.assertEqual(db.get_alerts(), [])
+        self.assertEqual(len(db.get_client_interactions(self.phone, limit=10)), 4)
+    
+    def test_json_archival_and_ttl(self):
+        """Test the JSON backend archives, reads through the archive and expires alerts."""
+        self._check_archival(self.db)
+        
+        reopened = Database(db_file=self.db.db_file, commit_interval=0)
+        self.assertEqual(len(reopened.get_client_interactions(self.phone, limit=10)), 4)
+        reopened.close()
+    
+    def test_sqlite_archival_and_ttl(self):
+        """Test the SQLite backend archives, reads through the archive and expires alerts."""
+        self._check_archival(self.sqlite_db)
+    
+    def test_sqlite_failed_retention_archives_nothing(self):
+        """Test a retention run that fails before committing keeps its rows live and the archive untouched."""
+        old = (datetime.now() - timedelta(days=365)).isoformat()
+        self.sqlite_db.add_interaction(self.phone, "sales", "old", "incoming", metadata={"timestamp": old})
+        
+        def fail(*args):
+            raise RuntimeError("boom")
+        
+        self.sqlite_db._trim = fail
+        with self.assertRaises(RuntimeError):
+            self.sqlite_db.apply_retention()
+        self.assertEqual(self.sqlite_db.archive.segments(), [])
+        self.assertEqual(len(self.sqlite_db.query_interactions(phone=self.phone)[0]), 1)
+        
+        del self.sqlite_db._trim
+        self.assertEqual(self.sqlite_db.apply_retention()["archived"], 1)
+        self.assertEqual([i["message"] for i in self.sqlite_db.get_client_interactions(self.phone)], ["old"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests for idempotent webhook ingestion.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from sqlite_database import SQLiteDatabase
+from message_dedup import MessageDeduplicator
+
+class TestMessageDeduplicator(unittest.TestCase):
+    
+    def test_lru_and_metrics(self):
+        """Test retries are caught, old IDs are evicted and the rate is reported."""
+        dedup = MessageDeduplicator(capacity=2)
+        self.assertFalse(dedup.is_duplicate("a"))
+        dedup.remember("a")
+        self.assertTrue(dedup.is_duplicate("a"))
+        
+        dedup.remember("b")
+        dedup.remember("c", duplicate=True)
+        self.assertFalse(dedup.is_duplicate("a"))
+        
+        metrics = dedup.metrics()
+        self.assertEqual(metrics["checked"], 3)
+        self.assertEqual(metrics["duplicates"], 2)
+        self.assertEqual(metrics["lru_size"], 2)
+        self.assertAlmostEqual(metrics["duplicate_rate"], 0.6667)
+
+class TestSeenMessages(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test databases."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"), commit_interval=0)
+        self.sqlite_db = SQLiteDatabase(db_file=os.path.join(self.test_dir, "test.sqlite3"))
+    
+    def tearDown(self):
+        """Clean up test databases."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_mark_message_seen_persists_until_ttl(self):
+        """Test a message ID is accepted once, survives a restart and expires after the TTL."""
+        for db in (self.db, self.sqlite_db):
+            self.assertTrue(db.mark_message_seen("3EB0ABC", "+5511999998888"))
+            self.assertFalse(db.mark_message_seen("3EB0ABC", "+5511999998888"))
+            
+            summary = db.apply_retention(now=datetime.now() + timedelta(days=30))
+            self.assertEqual(summary["expired"]["seen_messages"], 1)
+            self.assertTrue(db.mark_message_seen("3EB0ABC"))
+        
+        reopened = Database(db_file=self.db.db_file, commit_interval=0)
+        self.assertFalse(reopened.mark_message_seen("3EB0ABC"))
+        reopened.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Tests for the sharded JSON storage backend.
+"""
+import unittest
+import tempfile
+import shutil
+from sharded_database import ShardedDatabase, shard_index
+
+class TestShardedDatabase(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = ShardedDatabase(shard_dir=self.test_dir, shard_count=4, commit_interval=0)
+        self.phones = [f"+55119999900{i:02d}" for i in range(8)]
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_phone_data_lives_in_its_shard(self):
+        """Test a conversation's writes only touch the phone's shard."""
+        phone = self.phones[0]
+        with self.db.transaction():
+            self.db.add_lead(phone, "Teste")
+            self.db.convert_lead_to_client(phone)
+            self.db.add_interaction(phone, "sales", "oi", "incoming")
+        
+        owner = self.db.shards[shard_index(phone, 4)]
+        self.assertEqual(owner.get_client(phone)["status"], "active")
+        for shard in self.db.shards:
+            if shard is not owner:
+                self.assertEqual(shard.version()[1], 0)
+        self.assertEqual(self.db.get_conversion_stats()["active_subscriptions"], 1)
+        
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.update_client(phone, {"status": "inactive"})
+                raise RuntimeError("boom")
+        self.assertEqual(self.db.get_client(phone)["status"], "active")
+        
+        with self.assertRaises(ValueError):
+            ShardedDatabase(shard_dir=self.test_dir, shard_count=8)
+    
+    def test_merged_pages_cover_every_shard(self):
+        """Test global keyset pages walk all shards once, ties included."""
+        for i, phone in enumerate(self.phones):
+            self.db.add_lead(phone, f"Lead {i}")
+            self.db.add_interaction(phone, "sales", f"msg {i}", "incoming",
+                                    metadata={"timestamp": "2025-10-30T12:00:00" if i < 5 else f"2025-10-30T12:00:0{i}"})
+        
+        seen, cursor = [], None
+        while True:
+            page, cursor = self.db.query_interactions(before=cursor, limit=3)
+            seen.extend(i["message"] for i in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen[:3], ["msg 7", "msg 6", "msg 5"])
+        self.assertEqual(sorted(seen), sorted(f"msg {i}" for i in range(8)))
+        
+        names, cursor = [], None
+        while True:
+            leads, cursor = self.db.query_leads(before=cursor, limit=3)
+            names.extend(lead["name"] for lead in leads)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(names), sorted(f"Lead {i}" for i in range(8)))
+    
+    def test_events_since_merges_shard_feeds(self):
+        """Test the composite cursor resumes every shard's feed without skipping or repeating."""
+        phones = [phone for phone in self.phones if shard_index(phone, 4) != shard_index(self.phones[0], 4)][:1]
+        phones = [self.phones[0]] + phones
+        for n in range(3):
+            for phone in phones:
+                self.db.add_interaction(phone, "user", f"{phone} {n}", "incoming")
+        
+        events = self.db.events_since(0)
+        self.assertEqual([e["record"]["message"] for e in events],
+                         [f"{phone} {n}" for n in range(3) for phone in phones])
+        self.assertEqual(events[-1]["seq"], self.db.events_cursor())
+        
+        first = self.db.events_since(0, limit=2)
+        self.assertEqual(len(first), 2)
+        rest = self.db.events_since(first[-1]["seq"])
+        self.assertEqual(first + rest, events)
+        self.assertEqual(self.db.events_since(events[-1]["seq"]), [])
+        
+        self.db.add_lead(phones[1], "Lead")
+        self.assertEqual([e["type"] for e in self.db.events_since(events[-1]["seq"])], ["lead_upserted"])
+        with self.assertRaises(ValueError):
+            self.db.events_since("1.2")
+    
+    def test_load_merges_shards(self):
+        """Test the read-only whole document merges every shard."""
+        for phone in self.phones:
+            self.db.add_lead(phone, "Lead")
+        data = self.db._load()
+        self.assertEqual(len(data["leads"]), 8)
+        self.assertEqual(data["leads"][f"lead_{self.phones[3]}"]["name"], "Lead")
+    
+    def test_subscription_lives_in_the_phone_shard(self):
+        """Test subscription reads and writes go to the phone's shard."""
+        phone = self.phones[5]
+        self.db.add_lead(phone, "Lead")
+        self.db.convert_lead_to_client(phone)
+        with self.db.transaction(phone):
+            self.assertTrue(self.db.update_subscription(phone, {"status": "cancelled"}))
+        self.assertEqual(self.db.get_subscription(phone)["status"], "cancelled")
+        self.assertFalse(self.db.update_subscription(self.phones[6], {"status": "cancelled"}))
+        
+        shard = self.db.shards[shard_index(phone, self.db.shard_count)]
+        self.assertEqual(shard.get_subscription(phone)["status"], "cancelled")
+
+if __name__ == '__main__':
+    unittest.main()
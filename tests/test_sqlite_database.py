@@ -0,0 +1,195 @@
+"""
+Tests for the SQLite storage backend and the JSON -> SQLite migrator.
+"""
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from database import Database
+from sqlite_database import SQLiteDatabase, migrate_json_to_sqlite
+
+class TestSQLiteDatabase(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = SQLiteDatabase(db_file=os.path.join(self.test_dir, "test.sqlite3"))
+    
+    def tearDown(self):
+        """Clean up test database."""
+        shutil.rmtree(self.test_dir)
+    
+    def test_lead_to_client_flow(self):
+        """Test lead creation, update and conversion."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        self.db.update_lead(phone, {"status": "qualified"})
+        self.assertEqual(self.db.get_lead(phone)["status"], "qualified")
+        
+        client_id = self.db.convert_lead_to_client(phone)
+        self.assertEqual(client_id, f"client_{phone}")
+        self.assertEqual(self.db.get_client(phone)["status"], "active")
+        self.assertEqual(self.db.get_lead(phone)["status"], "converted")
+        
+        stats = self.db.get_conversion_stats()
+        self.assertEqual(stats["total_leads"], 1)
+        self.assertEqual(stats["converted_leads"], 1)
+        self.assertEqual(stats["active_subscriptions"], 1)
+        self.assertEqual(stats["monthly_revenue"], 47.00)
+        self.assertEqual(self.db.rebuild_stats(), {})
+    
+    def test_subscription_updates(self):
+        """Test subscription writes are per record and versioned."""
+        phone = "+5511999998888"
+        self.assertFalse(self.db.update_subscription(phone, {"status": "cancelled"}))
+        self.db.save_subscription(phone, {"client_id": f"client_{phone}", "price": 47.00, "status": "active"})
+        with self.db.transaction(phone):
+            self.assertTrue(self.db.update_subscription(phone, {"status": "cancelled"}))
+        
+        subscription = self.db.get_subscription(phone)
+        self.assertEqual(subscription["status"], "cancelled")
+        self.assertEqual(subscription["version"], 2)
+        self.assertEqual(self.db.get_conversion_stats()["active_subscriptions"], 0)
+    
+    def test_externalize_payloads(self):
+        """Test inline webhook payloads are replaced by references in place."""
+        phone = "+5511999998888"
+        self.db.add_interaction(phone, "user", "oi", metadata={"webhook_data": {"phone": phone}})
+        self.db.add_interaction(phone, "user", "tudo bem?")
+        stored = {}
+        
+        def put(payload):
+            stored["ref"] = payload
+            return "ref"
+        
+        self.assertEqual(self.db.externalize_payloads(put), 1)
+        self.assertEqual(stored, {"ref": {"phone": phone}})
+        interaction = self.db.get_client_interactions(phone)[1]
+        self.assertNotIn("webhook_data", interaction)
+        self.assertEqual(interaction["payload_ref"], "ref")
+        self.assertEqual(self.db.payload_refs(), {"ref"})
+    
+    def test_interactions_ordering(self):
+        """Test per-phone interactions come back newest first."""
+        phone = "+5511999998888"
+        for i in range(5):
+            self.db.add_interaction(phone, "sales", f"msg {i}", "incoming")
+        self.db.add_interaction("+5511000000000", "sales", "other", "incoming")
+        
+        interactions = self.db.get_client_interactions(phone, limit=3)
+        self.assertEqual([i["message"] for i in interactions], ["msg 4", "msg 3", "msg 2"])
+        
+        since = self.db.get_messages_since(phone, datetime.min.isoformat())
+        self.assertEqual(len(since), 5)
+        self.assertEqual(since[0]["message"], "msg 0")
+    
+    def test_query_interactions_pages(self):
+        """Test keyset pages over interactions and leads."""
+        phone = "+5511999998888"
+        for i in range(5):
+            self.db.add_interaction(phone, "sales", f"in {i}", "incoming")
+            self.db.add_interaction(phone, "sales", f"out {i}", "outgoing")
+        
+        page, cursor = self.db.query_interactions(phone=phone, direction="incoming", limit=3)
+        self.assertEqual([i["message"] for i in page], ["in 4", "in 3", "in 2"])
+        page, cursor = self.db.query_interactions(phone=phone, direction="incoming", before=cursor, limit=3)
+        self.assertEqual([i["message"] for i in page], ["in 1", "in 0"])
+        self.assertIsNone(cursor)
+        
+        for i in range(3):
+            self.db.add_lead(f"+551100000000{i}", f"Lead {i}")
+        leads, cursor = self.db.query_leads(limit=2)
+        self.assertEqual([l["name"] for l in leads], ["Lead 2", "Lead 1"])
+        self.assertEqual([l["name"] for l in self.db.query_leads(before=cursor)[0]], ["Lead 0"])
+    
+    def test_buffer_expiry_and_locking(self):
+        """Test expired buffer detection and lock acquisition."""
+        phone = "+14079897162"
+        now = datetime.now()
+        expired_time = (now - timedelta(seconds=20)).isoformat()
+        self.db.upsert_message_buffer(phone, expired_time, expired_time)
+        
+        expired = self.db.get_expired_buffers(now.isoformat())
+        self.assertEqual([b["phone"] for b in expired], [phone])
+        
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "p1"))
+        self.assertFalse(self.db.acquire_buffer_lock(phone, "p2"))
+        self.assertEqual(self.db.get_expired_buffers(now.isoformat()), [])
+        
+        self.db.release_buffer_lock(phone)
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "p3"))
+        
+        version = self.db.get_message_buffer(phone)["version"]
+        self.assertFalse(self.db.acquire_buffer_lock(phone, "p4", expected_version=version - 1))
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "p4", expected_version=version))
+        
+        self.db.delete_message_buffer(phone)
+        self.assertIsNone(self.db.get_message_buffer(phone))
+    
+    def test_buffer_pending_queue(self):
+        """Test flushing a turn's messages keeps the ones queued after it started."""
+        phone = "+14079897162"
+        now = datetime.now().isoformat()
+        for text in ("a", "b"):
+            self.db.upsert_message_buffer(phone, now, now, pending_message={"message": text, "timestamp": now})
+        self.assertTrue(self.db.acquire_buffer_lock(phone, "p1"))
+        
+        self.assertTrue(self.db.flush_message_buffer(phone, 1))
+        buffer = self.db.get_message_buffer(phone)
+        self.assertEqual([m["message"] for m in buffer["pending"]], ["b"])
+        self.assertFalse(buffer["processing"])
+        self.assertFalse(self.db.flush_message_buffer(phone, 1))
+        self.assertIsNone(self.db.get_message_buffer(phone))
+    
+    def test_transaction_rollback(self):
+        """Test a failing transaction rolls back every statement."""
+        phone = "+5511999998888"
+        self.db.add_lead(phone, "Teste")
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.convert_lead_to_client(phone)
+                raise RuntimeError("boom")
+        self.assertIsNone(self.db.get_client(phone))
+        self.assertEqual(self.db.get_lead(phone)["status"], "new")
+    
+    def test_migrate_from_json(self):
+        """Test one-shot migration keeps every collection."""
+        json_file = os.path.join(self.test_dir, "database.json")
+        source = Database(db_file=json_file)
+        source.add_lead("+5511911111111", "Lead")
+        source.convert_lead_to_client("+5511911111111")
+        source.add_interaction("+5511911111111", "sales", "oi", "incoming")
+        source.create_alert("test", "+5511911111111", "details")
+        source.close()
+        
+        sqlite_file = os.path.join(self.test_dir, "migrated.sqlite3")
+        counts = migrate_json_to_sqlite(json_file, sqlite_file)
+        self.assertEqual(counts["leads"], 1)
+        self.assertEqual(counts["interactions"], 1)
+        
+        migrated = SQLiteDatabase(sqlite_file)
+        reopened = Database(db_file=json_file)
+        original = reopened._load()
+        reopened.close()
+        loaded = migrated._load()
+        for collection in ("clients", "leads", "subscriptions", "interactions", "system_alerts"):
+            self.assertEqual(loaded[collection], original[collection])
+        
+        with self.assertRaises(ValueError):
+            migrate_json_to_sqlite(json_file, sqlite_file)
+    
+    def test_migrate_includes_journaled_appends(self):
+        """Test records only in the JSON journal (appends since the last compaction) are migrated."""
+        json_file = os.path.join(self.test_dir, "database.json")
+        source = Database(db_file=json_file)
+        source.add_interaction("+5511911111111", "sales", "oi", "incoming")
+        source.create_alert("test", "+5511911111111", "details")
+        source.close()
+        
+        counts = migrate_json_to_sqlite(json_file, os.path.join(self.test_dir, "migrated.sqlite3"))
+        self.assertEqual(counts["interactions"], 1)
+        self.assertEqual(counts["system_alerts"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""
+Tests for the asyncio turn engine (TURN_ENGINE=asyncio).
+"""
+import unittest
+import os
+import tempfile
+import shutil
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from database import Database
+from buffer_manager import BufferManager
+from turn_pipeline import AsyncTurnEngine
+
+class TestAsyncTurnEngine(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up an engine with far more turn slots than threads."""
+        self.engine = AsyncTurnEngine(max_turns=100, sync_workers=2)
+        self.engine.start()
+    
+    def tearDown(self):
+        """Stop the engine."""
+        self.engine.stop()
+    
+    def test_waiting_turns_do_not_hold_threads(self):
+        """Test 100 turns waiting on I/O at once finish together on one loop thread."""
+        threads_before = threading.active_count()
+        
+        async def turn(n):
+            await asyncio.sleep(0.3)
+            return n
+        
+        started = time.time()
+        futures = [self.engine.submit(turn, n) for n in range(100)]
+        self.assertEqual(sorted(f.result(5) for f in futures), list(range(100)))
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(threading.active_count(), threads_before)
+        
+        metrics = self.engine.metrics()
+        self.assertEqual(metrics["turns"], 100)
+        self.assertEqual(metrics["pending_turns"] + metrics["active_turns"], 0)
+    
+    def test_sync_adapter_and_turn_cap(self):
+        """Test blocking calls run off the loop and no more than max_turns turns run at once."""
+        engine = AsyncTurnEngine(max_turns=2, sync_workers=2)
+        engine.start()
+        running, peak = [0], [0]
+        
+        async def turn():
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            thread = await engine.run_sync(lambda: (time.sleep(0.05), threading.current_thread().name)[1])
+            running[0] -= 1
+            return thread
+        
+        try:
+            names = [f.result(5) for f in [engine.submit(turn) for _ in range(6)]]
+        finally:
+            engine.stop()
+        self.assertTrue(all(name.startswith("turn-sync") for name in names))
+        self.assertEqual(peak[0], 2)
+
+class TestAsyncBufferFlush(unittest.TestCase):
+    
+    def setUp(self):
+        """Set up test database and an asyncio buffer manager."""
+        self.test_dir = tempfile.mkdtemp()
+        self.db = Database(db_file=os.path.join(self.test_dir, "test_db.json"))
+        self.buffer_manager = BufferManager(database=self.db, engine="asyncio")
+    
+    def tearDown(self):
+        """Clean up test database."""
+        self.buffer_manager.stop()
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+    
+    def test_due_buffers_flushed_as_coroutines(self):
+        """Test every due buffer is processed and cleared by the asyncio engine."""
+        phones = [f"+140798971{n:02d}" for n in range(20)]
+        batches = {}
+        
+        async def process(phone, messages):
+            await asyncio.sleep(0.2)
+            batches[phone] = [m["message"] for m in messages]
+        
+        self.buffer_manager._process_batched_messages_async = process
+        for phone in phones:
+            self.db.upsert_message_buffer(
+                phone=phone,
+                last_message_at=datetime.now().isoformat(),
+                buffer_expires_at=(datetime.now() - timedelta(seconds=1)).isoformat(),
+                processing=False
+            )
+            self.db.add_interaction(phone, "user", f"oi {phone}", "incoming")
+        
+        self.buffer_manager.start()
+        for _ in range(200):
+            # A turn counts once its coroutine returns, just after the buffer is cleared
+            if self.buffer_manager.metrics()["turn_engine"]["turns"] == 20:
+                break
+            time.sleep(0.01)
+        self.assertEqual(batches, {phone: [f"oi {phone}"] for phone in phones})
+        self.assertTrue(all(self.db.get_message_buffer(phone) is None for phone in phones))
+        self.assertEqual(self.buffer_manager.metrics()["turn_engine"]["turns"], 20)
+    
+    def test_database_calls_run_off_the_loop(self):
+        """Test the turn's buffer reads and writes run on the adapter threads."""
+        phone = "+14079897100"
+        threads = set()
+        original = self.db.get_message_buffer
+        
+        def get_message_buffer(buffer_phone):
+            threads.add(threading.current_thread().name)
+            return original(buffer_phone)
+        
+        async def process(phone, messages):
+            pass
+        
+        self.buffer_manager._process_batched_messages_async = process
+        self.db.get_message_buffer = get_message_buffer
+        self.buffer_manager.add_message(phone, "oi")
+        self.db.upsert_message_buffer(phone, datetime.now().isoformat(), datetime.now().isoformat())
+        self.buffer_manager.start()
+        for _ in range(200):
+            if original(phone) is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(original(phone))
+        self.assertNotIn("turn-loop", threads)
+    
+    def test_cancelled_turn_releases_its_lock(self):
+        """Test stopping the engine mid-turn unlocks the buffer for the next start."""
+        phone = "+14079897101"
+        started = threading.Event()
+        
+        async def process(phone, messages):
+            started.set()
+            await asyncio.sleep(10)
+        
+        self.buffer_manager._process_batched_messages_async = process
+        self.buffer_manager.add_message(phone, "oi")
+        self.db.upsert_message_buffer(phone, datetime.now().isoformat(), datetime.now().isoformat())
+        self.buffer_manager.start()
+        self.assertTrue(started.wait(5))
+        self.assertTrue(self.db.get_message_buffer(phone)["processing"])
+        
+        self.buffer_manager.stop()
+        buffer = self.db.get_message_buffer(phone)
+        self.assertFalse(buffer["processing"])
+        self.assertIsNone(buffer.get("locked_by"))
+        self.assertEqual([m["message"] for m in buffer["pending"]], ["oi"])
+
+if __name__ == '__main__':
+    unittest.main()
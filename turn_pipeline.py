@@ -0,0 +1,126 @@
+"""
+Asyncio turn engine - runs conversation turns as coroutines.
+
+With TURN_ENGINE=asyncio the buffer manager hands due buffers to an
+AsyncTurnEngine instead of its thread pool. The engine owns one event
+loop on a dedicated thread; a turn waiting on OpenAI or Z-API is a parked
+coroutine rather than a blocked thread, so ASYNC_MAX_TURNS conversations
+can be in flight at once. Blocking code (agents without an async path)
+is awaited through run_sync(), which runs it on a few adapter threads.
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+from config import ASYNC_MAX_TURNS, ASYNC_SYNC_WORKERS
+
+logger = logging.getLogger(__name__)
+
+class AsyncTurnEngine:
+    """Event loop thread plus adapter threads, with at most max_turns turns running at once."""
+    
+    def __init__(self, max_turns: int = ASYNC_MAX_TURNS, sync_workers: int = ASYNC_SYNC_WORKERS):
+        self.max_turns = max_turns
+        self.sync_workers = sync_workers
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.active = 0
+        self.turns = 0
+        self.failed = 0
+    
+    def start(self):
+        """Start the event loop thread."""
+        if self.loop is not None:
+            return
+        
+        self.executor = ThreadPoolExecutor(max_workers=self.sync_workers, thread_name_prefix="turn-sync")
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, args=(ready,), name="turn-loop", daemon=True)
+        self.thread.start()
+        ready.wait()
+        logger.info(f"Async turn engine started ({self.max_turns} turns, {self.sync_workers} adapter threads)")
+    
+    def stop(self, timeout: float = 2.0):
+        """Cancel unfinished turns and stop the loop."""
+        if self.loop is None:
+            return
+        
+        try:
+            asyncio.run_coroutine_threadsafe(self._cancel_turns(), self.loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"Async turns did not stop cleanly: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.loop.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        logger.info("Async turn engine stopped")
+    
+    def submit(self, turn: Callable[..., Awaitable], *args) -> Future:
+        """Schedule turn(*args) on the loop, from any thread; returns a concurrent.futures.Future."""
+        if self.loop is None:
+            raise RuntimeError("Async turn engine is not running")
+        with self.lock:
+            self.pending += 1
+        return asyncio.run_coroutine_threadsafe(self._turn(turn, *args), self.loop)
+    
+    async def run_sync(self, function: Callable, *args):
+        """Await a blocking call on the adapter threads (the sync-agent adapter)."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
+    
+    def metrics(self) -> Dict:
+        with self.lock:
+            return {
+                "engine": "asyncio",
+                "max_turns": self.max_turns,
+                "sync_workers": self.sync_workers,
+                "pending_turns": self.pending,
+                "active_turns": self.active,
+                "turns": self.turns,
+                "failed_turns": self.failed
+            }
+    
+    def _run_loop(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_turns)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+    
+    async def _turn(self, turn: Callable[..., Awaitable], *args):
+        started = False
+        try:
+            async with self._semaphore:
+                with self.lock:
+                    self.pending -= 1
+                    self.active += 1
+                started = True
+                return await turn(*args)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                if started:
+                    self.active -= 1
+                    self.turns += 1
+                else:
+                    self.pending -= 1
+    
+    async def _cancel_turns(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
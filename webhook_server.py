@@ -1,6 +1,9 @@
 from flask import Flask, request, jsonify
 from database import db
 from buffer_manager import buffer_manager
+from db_retention import RetentionJob
+from db_blobs import blob_store
+from message_dedup import message_dedup
 from config import ALLOWED_PHONE_NUMBER, TESTING_MODE
 import logging
 import threading
@@ -10,9 +13,13 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# Archives old interactions, expires old logs and collects unused payload blobs in the background
+retention_job = RetentionJob(db, blob_store=blob_store)
+
 # Start buffer manager on startup
 with app.app_context():
     buffer_manager.start()
+    retention_job.start()
 
 def _normalize_phone(phone: str) -> str:
     """Normalize phone number."""
@@ -71,15 +78,34 @@ def webhook():
                 "blocked": True
             }), 200
         
+        # Z-API retry of a message this worker already stored
+        message_id = data.get('messageId')
+        if message_id and message_dedup.is_duplicate(message_id):
+            return jsonify({
+                "success": True,
+                "message": "Duplicate",
+                "duplicate": True
+            }), 200
+        
         # Add message to buffer (returns immediately)
         result = buffer_manager.add_message(
             phone=phone,
             message=message,
             metadata={
-                "webhook_data": data,
+                # Raw payload is stored once on disk; fetch it with blob_store.get(ref)
+                "payload_ref": blob_store.put(data),
+                "message_id": message_id,
                 "source": "zapi_webhook"
             }
         )
+        if message_id:
+            message_dedup.remember(message_id, duplicate=result.get("duplicate", False))
+        if result.get("duplicate"):
+            return jsonify({
+                "success": True,
+                "message": "Duplicate",
+                "duplicate": True
+            }), 200
         
         # Return immediate response to Z-API (< 1 second)
         return jsonify({
@@ -122,13 +148,17 @@ def health():
         "testing_mode": TESTING_MODE,
         "buffer_manager": {
             "running": buffer_manager.running,
-            "worker_alive": buffer_manager.worker_thread.is_alive() if buffer_manager.worker_thread else False
+            "worker_alive": buffer_manager.worker_thread.is_alive() if buffer_manager.worker_thread else False,
+            "scheduler": buffer_manager.metrics()
         },
         "zapi": whatsapp.health_check(),
+        "webhook_dedup": message_dedup.metrics(),
         "database": {
             "status": "connected"
         }
     }
+    if hasattr(db, "lock_metrics"):
+        health_data["database"]["locks"] = db.lock_metrics()
     
     return jsonify(health_data), 200
 
@@ -1,4 +1,5 @@
 import requests
+import httpx
 import logging
 from typing import Optional, Dict
 from config import Z_API_BASE_URL, TESTING_MODE, ALLOWED_PHONE_NUMBER
@@ -212,4 +213,77 @@ class WhatsAppAPI:
         except requests.exceptions.RequestException as e:
             return {"success": False, "error": str(e)}
 
+class AsyncWhatsAppAPI:
+    """
+    Non-blocking Z-API sender for the asyncio turn pipeline (see turn_pipeline).
+    
+    Same access control, testing-mode mock and results as the WhatsAppAPI
+    it wraps. Requests share one httpx.AsyncClient, so many conversations
+    can wait on Z-API at once without holding a thread each.
+    """
+    
+    def __init__(self, api: WhatsAppAPI):
+        self.api = api
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def _http(self) -> httpx.AsyncClient:
+        # Created on first use, inside the event loop that will drive it
+        if self._client is None:
+            self._client = httpx.AsyncClient()
+        return self._client
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _post(self, endpoint: str, payload: Dict, timeout: float) -> Dict:
+        response = await self._http().post(f"{self.api.base_url}/{endpoint}", json=payload, timeout=timeout)
+        response.raise_for_status()
+        return {"success": True, "data": response.json()}
+    
+    async def send_text(self, phone: str, message: str) -> Dict:
+        """Send text message via Z-API."""
+        phone = self.api._normalize_phone(phone)
+        
+        if not self.api._check_access_control(phone):
+            return {
+                "success": False,
+                "error": "Access denied: Phone number not in allow-list"
+            }
+        
+        if self.api.testing_mode:
+            return self.api.mock.send_text(phone, message)
+        
+        try:
+            return await self._post("send-text", {"phone": phone, "message": message}, timeout=10)
+        except httpx.HTTPError as e:
+            logger.error(f"Z-API error: {e}")
+            return {"success": False, "error": str(e)}
+    
+    async def send_typing_indicator(self, phone: str) -> Dict:
+        """Send typing indicator via Z-API."""
+        return await self._send_indicator(phone, "typing")
+    
+    async def send_viewed_indicator(self, phone: str) -> Dict:
+        """Send viewed indicator via Z-API."""
+        return await self._send_indicator(phone, "viewed")
+    
+    async def _send_indicator(self, phone: str, endpoint: str) -> Dict:
+        phone = self.api._normalize_phone(phone)
+        
+        if not self.api._check_access_control(phone):
+            return {"success": False, "error": "Access denied"}
+        
+        if self.api.testing_mode:
+            indicator = self.api.mock.send_typing_indicator if endpoint == "typing" else self.api.mock.send_viewed_indicator
+            return indicator(phone)
+        
+        try:
+            return await self._post(endpoint, {"phone": phone}, timeout=5)
+        except httpx.HTTPError:
+            # If endpoint doesn't exist, just log and return success
+            logger.debug(f"{endpoint.capitalize()} indicator endpoint not available")
+            return {"success": True, "data": {"status": "simulated"}}
+
 whatsapp = WhatsAppAPI()